@@ -0,0 +1,92 @@
+'''
+compares the per instance memory cost of the slotted Server model with the
+__dict__ based layout it replaced
+
+usage: python benchmarks/memory.py [number of servers]
+'''
+import os
+import sys
+import gc
+from copy import deepcopy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'src'))
+from zabuza.services.compute import Server
+try:
+  import json
+except ImportError:
+  import simplejson as json
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None #python 2, fall back to sys.getsizeof accounting
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+  'server.json')
+
+class DictServer(object):
+  '''
+  the layout of Server before it used __slots__: every field in a per
+  instance __dict__ plus a per instance list of attribute names
+  '''
+  def __init__(self, server):
+    for slot in Server.__slots__:
+      setattr(self, slot, getattr(server, slot))
+    self.attributes = list(Server.attributes)
+
+def payloads(count):
+  '''
+  count distinct server payloads modelled on data/server.json
+  '''
+  template = json.loads(open(DATA).read())['server']
+  for index in range(count):
+    payload = deepcopy(template)
+    payload['id'] = '%s-%08d'%(template['id'][:27], index)
+    yield payload
+
+def shallow_size(instance):
+  '''
+  bytes owned by an instance itself, excluding the field values it shares
+  with every other layout
+  '''
+  size = sys.getsizeof(instance)
+  if hasattr(instance, '__dict__'):
+    size += sys.getsizeof(instance.__dict__)
+    size += sys.getsizeof(instance.__dict__.get('attributes', ()))
+  return size
+
+def traced_size(build, servers):
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  instances = [build(server) for server in servers]
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return (after - before) / float(len(instances))
+
+def measure(count):
+  servers = [Server.create_server(**payload) for payload in payloads(count)]
+  results = {
+    'count': count,
+    'dict_bytes_per_server': shallow_size(DictServer(servers[0])),
+    'slots_bytes_per_server': shallow_size(servers[0]),
+  }
+  if tracemalloc is not None:
+    def copy_slots(server):
+      clone = Server.__new__(Server)
+      clone.__setstate__(server.__getstate__())
+      return clone
+    results['dict_traced_bytes_per_server'] = traced_size(DictServer, servers)
+    results['slots_traced_bytes_per_server'] = traced_size(copy_slots, servers)
+  return results
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  results = measure(count)
+  for key in sorted(results):
+    print('%-32s %s'%(key, results[key]))
+  saving = 1 - results['slots_bytes_per_server'] / \
+    float(results['dict_bytes_per_server'])
+  print('%-32s %.0f%%'%('per instance saving', saving * 100))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,197 @@
+'''
+offline micro benchmarks of the model construction and parsing hot paths:
+building servers from api payloads, service catalogs from keystone
+responses, tokens from their ISO-8601 dates, server reprs and endpoint
+urls. Nothing is sent over the network.
+
+usage: python benchmarks/models.py [-s 10000,100000] [-r 5] [-o results.json]
+                                   [-c baseline.json]
+
+Results are written as json so runs of different versions can be compared,
+either by hand or with --compare.
+'''
+import os
+import sys
+import gc
+import time
+import platform
+import optparse
+from copy import deepcopy
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+  '..', 'src'))
+from zabuza.openstack import ServiceCatalog, Token, Endpoint
+from zabuza.services.compute import Server
+from zabuza import codec
+from zabuza.columns import to_columns, numpy
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data',
+  'server.json')
+clock = getattr(time, 'perf_counter', time.time)
+
+def server_payloads(count):
+  '''
+  count distinct server payloads modelled on data/server.json
+  '''
+  template = json.loads(open(DATA).read())['server']
+  payloads = []
+  for index in range(count):
+    payload = deepcopy(template)
+    payload['id'] = '%s-%08d'%(template['id'][:27], index)
+    payload['name'] = 'node-%d'%index
+    payloads.append(payload)
+  return payloads
+
+def service_catalog(regions):
+  '''
+  a keystone service catalog with the usual services in every region
+  '''
+  services = []
+  for atype, name, port in [('compute', 'nova', 8774), ('image', 'glance', 9292),
+      ('identity', 'keystone', 5000), ('volume', 'cinder', 8776),
+      ('network', 'neutron', 9696), ('object-store', 'swift', 8080)]:
+    endpoints = []
+    for index in range(regions):
+      base = 'https://%s-%d.example.com:%d'%(name, index, port)
+      endpoints.append({'id': '%s-%d'%(name, index), 'region': 'r%d'%index,
+        'publicURL': base + '/v2/t1', 'internalURL': base + '/v2/t1',
+        'adminURL': base + '/v2/t1'})
+    services.append({'type': atype, 'name': name, 'endpoints': endpoints})
+  return services
+
+#
+# The benchmarks, each takes the number of items to process and returns a
+# function doing the work once
+#
+def bench_create_server(size):
+  payloads = server_payloads(size)
+  return lambda: [Server.create_server(**payload) for payload in payloads]
+
+def bench_from_json_lazy(size):
+  payloads = server_payloads(size)
+  return lambda: [Server.from_json(payload, lazy=True) for payload in payloads]
+
+def bench_decode_listing(size):
+  body = json.dumps({'servers': server_payloads(size)}).encode('utf-8')
+  return lambda: codec.loads(body)['servers']
+
+def bench_stream_listing(size):
+  body = json.dumps({'servers': server_payloads(size)}).encode('utf-8')
+  chunks = lambda: (body[i:i + 65536] for i in range(0, len(body), 65536))
+  return lambda: list(codec.StreamedListing(chunks(), 'servers'))
+
+def bench_service_catalog(size):
+  catalog = service_catalog(10)
+  return lambda: [ServiceCatalog(serviceCatalog=catalog) for _ in range(size)]
+
+def bench_token_parsing(size):
+  tokens = [{'id': 'token-%d'%index, 'tenant': {},
+             'expires': '2014-03-11T14:%02d:21Z'%(index % 60),
+             'issued_at': '2014-03-10T14:47:21.383780'}
+            for index in range(size)]
+  return lambda: [Token(**token) for token in tokens]
+
+def bench_server_repr(size):
+  servers = [Server.create_server(**payload)
+             for payload in server_payloads(size)]
+  return lambda: [repr(server) for server in servers]
+
+def bench_to_columns(size):
+  servers = [Server.create_server(**payload)
+             for payload in server_payloads(size)]
+  return lambda: to_columns(servers)
+
+def bench_fetch_url(size):
+  endpoint = Endpoint(id='e1', type='compute', name='nova', region='r1',
+    publicURL='https://nova.example.com:8774/v2/t1')
+  ids = ['%08d'%index for index in range(size)]
+  return lambda: [endpoint.fetch_url(['servers', server_id])
+                  for server_id in ids]
+
+BENCHMARKS = [
+  ('Server.create_server', bench_create_server, True),
+  ('Server.from_json lazy', bench_from_json_lazy, True),
+  ('codec.loads listing', bench_decode_listing, True),
+  ('StreamedListing', bench_stream_listing, True),
+  ('ServiceCatalog', bench_service_catalog, False),
+  ('Token', bench_token_parsing, False),
+  ('Server.__repr__', bench_server_repr, True),
+  ('Endpoint.fetch_url', bench_fetch_url, False),
+]
+if numpy is not None:
+  BENCHMARKS.append(('columns.to_columns', bench_to_columns, True))
+
+def run(name, setup, size, repeat):
+  '''
+  time the work of a benchmark repeat times, garbage collection disabled
+  '''
+  work = setup(size)
+  timings = []
+  for _ in range(repeat):
+    gc.collect()
+    gc.disable()
+    try:
+      started = clock()
+      work()
+      timings.append(clock() - started)
+    finally:
+      gc.enable()
+  best = min(timings)
+  return {'name': name, 'size': size, 'repeat': repeat, 'best': best,
+          'mean': sum(timings) / len(timings),
+          'per_item_us': best / size * 1e6}
+
+def compare(results, baseline):
+  '''
+  print how every benchmark did against the same one in a baseline run
+  '''
+  previous = dict(((r['name'], r['size']), r) for r in baseline['results'])
+  for result in results['results']:
+    before = previous.get((result['name'], result['size']))
+    if before is None:
+      continue
+    print('%-24s %8d %+7.1f%%'%(result['name'], result['size'],
+      (result['best'] / before['best'] - 1) * 100))
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('-s', '--sizes', dest='sizes', default='10000,100000',
+    help='comma separated numbers of servers to benchmark with')
+  parser.add_option('-r', '--repeat', dest='repeat', type='int', default=5,
+    help='runs of every benchmark, the best one is reported')
+  parser.add_option('-o', '--output', dest='output',
+    default='benchmark-results.json', help='file results are written to')
+  parser.add_option('-c', '--compare', dest='compare', default=None,
+    help='results file of a previous run to compare against')
+  parser.add_option('-b', '--benchmark', dest='only', default=None,
+    help='only run benchmarks whose name contains this')
+  options, _ = parser.parse_args()
+  sizes = [int(size) for size in options.sizes.split(',')]
+
+  results = {'python': platform.python_version(), 'json': codec.backend(),
+             'implementation': platform.python_implementation(),
+             'platform': platform.platform(), 'time': time.time(),
+             'results': []}
+  for name, setup, scaled in BENCHMARKS:
+    if options.only and options.only not in name:
+      continue
+    #catalogs, tokens and urls are built per call, not per server, so fewer
+    #of them are meaningful
+    for size in (sizes if scaled else [max(1, sizes[0] // 10)]):
+      result = run(name, setup, size, options.repeat)
+      results['results'].append(result)
+      print('%-24s %8d %10.4fs %8.2fus/item'%(name, size, result['best'],
+        result['per_item_us']))
+
+  with open(options.output, 'w') as output:
+    output.write(json.dumps(results, indent=2, sort_keys=True))
+  print('results written to %s'%options.output)
+  if options.compare:
+    print('change against %s:'%options.compare)
+    compare(results, json.loads(open(options.compare).read()))
+
+if __name__ == '__main__':
+  main()
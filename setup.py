@@ -18,6 +18,7 @@ def main():
     from setuptools import setup, find_packages
     SETUPTOOLS_METADATA = dict(
       install_requires = ['setuptools', 'simplejson', 'requests', 'python-dateutil'],
+      extras_require = {'async': ['aiohttp'], 'analytics': ['numpy']},
       include_package_data = True,
       package_dir={'':'src'},
       packages=find_packages(where='src'),
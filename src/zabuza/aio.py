@@ -0,0 +1,256 @@
+'''
+asyncio flavours of the openstack User and Api objects, for use from event
+loop based applications. They share the Server, Token and ServiceCatalog
+models of the blocking implementation.
+
+Requires python 3.5+ and aiohttp.
+'''
+import asyncio
+import logging
+from .openstack import User, Api
+from .services.compute import Server
+from .concurrency import BatchReport
+try:
+  import aiohttp
+except ImportError:
+  aiohttp = None
+try:
+  from json import loads, dumps
+except ImportError:
+  from simplejson import loads, dumps
+
+class AsyncUser(User):
+  '''
+  An openstack user authenticating through coroutines. All http calls made
+  as this user (and every AsyncApi object built on it) share one aiohttp
+  session and so its keep-alive connections.
+  '''
+  def __init__(self, auth_url, username=None, password=None, token=None,
+    tenant_name=None, token_cache=None, limit=100, limit_per_host=0):
+    '''
+    Args:
+      limit:
+        maximum number of connections open at once, 0 for no limit [Optional]
+      limit_per_host:
+        maximum number of connections open to one endpoint host, 0 for no
+        limit [Optional]
+
+    the remaining args are the same as the ones of User.
+    '''
+    if aiohttp is None:
+      raise ImportError('AsyncUser requires aiohttp to be installed')
+    User.__init__(self, auth_url, username=username, password=password,
+      token=token, tenant_name=tenant_name, token_cache=token_cache)
+    self.limit = limit
+    self.limit_per_host = limit_per_host
+    self._session = None
+    self._async_auth_lock = None
+
+  @property
+  def session(self):
+    '''
+    the aiohttp session of this user, created on first use
+    '''
+    if self._session is None or self._session.closed:
+      connector = aiohttp.TCPConnector(limit=self.limit,
+        limit_per_host=self.limit_per_host)
+      self._session = aiohttp.ClientSession(connector=connector)
+    return self._session
+
+  async def authenticate(self):
+    '''
+    Re-authenticate with the API by getting a brand spanking new token
+    '''
+    post_data = self._authentication_body()
+    async with self.session.post(self.auth_url, data=dumps(post_data),
+        headers={'content-type':'application/json'}) as response:
+      if response.status == 200:
+        data_dict = loads(await response.text())
+        self._update_token(data_dict)
+        self._update_user(data_dict)
+        self._store_cached_token(data_dict)
+      else:
+        response.raise_for_status()
+
+  async def ensure_authenticated(self):
+    '''
+    Make sure this user holds an unexpired token. Concurrent coroutines wait
+    on a single authentication instead of each going to keystone.
+    '''
+    if self.is_authenticated():
+      return
+    if self._async_auth_lock is None:
+      self._async_auth_lock = asyncio.Lock()
+    async with self._async_auth_lock:
+      if not self.is_authenticated():
+        await self.authenticate()
+
+  async def close(self):
+    '''
+    close all connections held on behalf of this user
+    '''
+    if self._session is not None:
+      await self._session.close()
+      self._session = None
+
+class AsyncApi(object):
+  '''
+  Coroutine based counterpart of Api, supporting the most common server
+  operations. Thousands of calls can be in flight at once on one thread.
+  '''
+  def __init__(self, auth_url, username=None, password=None, token=None,
+    tenant_name=None, user=None, token_cache=None):
+    '''
+    Args are the same as the ones of Api, except that a given user must be
+    an AsyncUser.
+    '''
+    if user:
+      assert isinstance(user, AsyncUser)
+      self.user = user
+    else:
+      self.user = AsyncUser(auth_url, username=username, password=password,
+        token=token, tenant_name=tenant_name, token_cache=token_cache)
+    self.errors = []
+
+  #request construction is shared with the blocking implementation
+  _read_user_data = Api._read_user_data
+  _server_parameters = Api._server_parameters
+  _servers_detail_parameters = Api._servers_detail_parameters
+
+  async def verify_credentials(self):
+    '''
+    returns a boolean indicating if we hold or could get a valid token
+    '''
+    try:
+      await self.user.ensure_authenticated()
+    except Exception as ex:
+      self.errors.append(str(ex))
+      return False
+    return True
+
+  async def create_server(self, server, user_data_file=None, user=None,
+                          compute_type='compute', key_name=None):
+    '''
+    Create a new server, see Api.create_server
+    '''
+    user = user or self.user
+    await user.ensure_authenticated()
+    url = user.endpoint_manager(compute_type).fetch_url(['servers'])
+    parameters = self._server_parameters(server,
+      user_data=self._read_user_data(user_data_file), key_name=key_name)
+    logging.debug('now creating server %s at url %s'%(parameters, url))
+    json_data = await self._request('POST', url, user=user,
+      success_codes=(202,), data=dumps(parameters))
+    server.update_properties(**json_data['server'])
+
+  async def get_server_detail(self, server=None, server_id=None, user=None,
+                              compute_type='compute'):
+    '''
+    Get details of a specific server, see Api.get_server_detail
+    '''
+    user = user or self.user
+    await user.ensure_authenticated()
+    if not server:
+      if not server_id or server_id == '':
+        raise Exception('either a server or server_id must be specified')
+    server_id = server_id or server.id
+    url = user.endpoint_manager(compute_type).fetch_url(['servers', server_id])
+    json_data = await self._request('GET', url, user=user)
+    return Server.create_server(**json_data['server'])
+
+  async def get_servers_detail(self, flavor=None, name=None, marker=None,
+                               limit=None, status=None, changes_since=None,
+                               host=None, user=None, compute_type='compute'):
+    '''
+    Get details of all servers, see Api.get_servers_detail
+    '''
+    user = user or self.user
+    await user.ensure_authenticated()
+    url = user.endpoint_manager(compute_type).fetch_url(['servers', 'detail'])
+    parameters = self._servers_detail_parameters(flavor=flavor, name=name,
+      marker=marker, limit=limit, status=status, changes_since=changes_since,
+      host=host)
+    json_data = await self._request('GET', url, user=user, params=parameters)
+    return [Server.create_server(**server_json)
+            for server_json in json_data['servers']]
+
+  async def delete_server(self, server=None, server_id=None, user=None,
+                          compute_type='compute'):
+    '''
+    Delete a deployed server, see Api.delete_server
+    '''
+    user = user or self.user
+    await user.ensure_authenticated()
+    if not server or not isinstance(server, Server):
+      if not server_id or server_id == '':
+        raise Exception('you must specify a server object or a server_id for deletion')
+    server_id = server_id or server.id
+    url = user.endpoint_manager(compute_type).fetch_url(['servers', server_id])
+    logging.debug('now deleting server with id %s using url %s'%(server_id, url))
+    await self._request('DELETE', url, user=user, success_codes=(204,))
+
+  async def delete_servers(self, servers=[], server_ids=[], user=None,
+                           compute_type='compute', workers=100):
+    '''
+    Delete many servers, at most `workers` at a time. Returns a BatchReport
+    just like Api.delete_servers
+    '''
+    user = user or self.user
+    report = BatchReport()
+    ids = []
+    for server in servers:
+      if not isinstance(server, Server) or not server.id or server.id == 'null':
+        report.add(server, 'failed',
+          error=Exception('server %s has no id to delete by'%server))
+      else:
+        ids.append(server.id)
+    ids.extend(server_ids)
+
+    await user.ensure_authenticated()
+    semaphore = asyncio.Semaphore(workers)
+    async def delete(server_id):
+      async with semaphore:
+        try:
+          await self.delete_server(server_id=server_id, user=user,
+            compute_type=compute_type)
+        except Exception as ex:
+          if getattr(ex, 'status', None) == 404:
+            report.add(server_id, 'gone', error=ex)
+          else:
+            logging.debug('failed deleting server %s: %s'%(server_id, ex))
+            report.add(server_id, 'failed', error=ex)
+        else:
+          report.add(server_id, 'deleted')
+    unique_ids, seen = [], set()
+    for server_id in ids:
+      if server_id not in seen:
+        seen.add(server_id)
+        unique_ids.append(server_id)
+    await asyncio.gather(*[delete(server_id) for server_id in unique_ids])
+    return report
+
+  async def close(self):
+    '''
+    release all connections used by this api object
+    '''
+    await self.user.close()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *exc_info):
+    await self.close()
+
+  async def _request(self, method, url, user=None, success_codes=(200,),
+                     **kwargs):
+    user = user or self.user
+    headers = {'content-type':'application/json',
+               'X-Auth-Token':str(user.token)}
+    async with user.session.request(method, url, headers=headers,
+                                    **kwargs) as response:
+      if response.status not in success_codes:
+        logging.debug('response failed with status code %s'%response.status)
+        response.raise_for_status()
+      logging.debug('%s returned status code %s'%(method, response.status))
+      body = await response.text()
+      return loads(body) if body else None
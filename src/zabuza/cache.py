@@ -0,0 +1,214 @@
+import os
+import time
+import errno
+import logging
+import tempfile
+import threading
+from hashlib import sha1
+try:
+  from collections import OrderedDict
+except ImportError:
+  from ordereddict import OrderedDict #python 2.6
+try:
+  import fcntl
+except ImportError:
+  fcntl = None #no advisory locking available, e.g on windows
+try:
+  from json import loads, dumps
+except ImportError:
+  from simplejson import loads, dumps
+
+#
+# Caches that let zabuza skip redundant round trips to openstack
+#
+class TokenCache(object):
+  '''
+  An on disk cache of keystone authentication responses (token, user info
+  and the raw service catalog) keyed by auth_url, username and tenant.
+
+  It is safe to share between concurrent processes: readers and writers
+  serialize on a lock file and entries are replaced atomically, so a reader
+  never sees a partially written entry.
+  '''
+  def __init__(self, directory=None, min_ttl=300):
+    '''
+    Args:
+      directory:
+        where cache entries are kept. defaults to ~/.zabuza/tokens [Optional]
+      min_ttl:
+        seconds a cached token must still be valid for to be used, entries
+        expiring sooner are treated as missing [Optional]
+    '''
+    self.directory = directory or os.path.join(os.path.expanduser('~'),
+      '.zabuza', 'tokens')
+    self.min_ttl = min_ttl
+
+  def key(self, auth_url, username, tenant_name):
+    return sha1('\n'.join([auth_url or '', username or '',
+      tenant_name or '']).encode('utf-8')).hexdigest()
+
+  def load(self, auth_url, username, tenant_name):
+    '''
+    returns the cached keystone response for this user or None if there is
+    no usable (present, readable and unexpired) entry
+    '''
+    from .openstack import Token
+    path = self._path(self.key(auth_url, username, tenant_name))
+    try:
+      with self._locked(path, exclusive=False):
+        with open(path) as entry:
+          data_dict = loads(entry.read())
+      token = Token(**data_dict['access']['token'])
+    except (IOError, OSError):
+      return None
+    except (ValueError, KeyError, TypeError) as ex:
+      logging.debug('ignoring unreadable token cache entry %s: %s'%(path, ex))
+      return None
+    if token.expires_in() < self.min_ttl:
+      logging.debug('cached token in %s is expired or about to'%path)
+      return None
+    return data_dict
+
+  def store(self, auth_url, username, tenant_name, data_dict):
+    '''
+    save a keystone authentication response for this user
+    '''
+    self._ensure_directory()
+    path = self._path(self.key(auth_url, username, tenant_name))
+    with self._locked(path, exclusive=True):
+      descriptor, temp_path = tempfile.mkstemp(dir=self.directory,
+        prefix='.tmp-')
+      try:
+        with os.fdopen(descriptor, 'w') as entry:
+          entry.write(dumps(data_dict))
+          entry.flush()
+          os.fsync(entry.fileno())
+        os.rename(temp_path, path)
+      except Exception:
+        os.unlink(temp_path)
+        raise
+
+  def invalidate(self, auth_url, username, tenant_name):
+    path = self._path(self.key(auth_url, username, tenant_name))
+    with self._locked(path, exclusive=True):
+      try:
+        os.unlink(path)
+      except OSError as ex:
+        if ex.errno != errno.ENOENT:
+          raise
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + '.json')
+
+  def _ensure_directory(self):
+    try:
+      os.makedirs(self.directory, 0o700)
+    except OSError as ex:
+      if ex.errno != errno.EEXIST:
+        raise
+
+  def _locked(self, path, exclusive=True):
+    return _FileLock(path + '.lock', exclusive=exclusive)
+
+class ResponseCache(object):
+  '''
+  A bounded in memory cache of api responses. Entries expire ttl seconds
+  after being stored, and the least recently used entry is evicted once
+  max_size entries are held. Hits and misses are counted to help size it.
+  '''
+  def __init__(self, ttl=30, max_size=1024):
+    '''
+    Args:
+      ttl:
+        seconds an entry stays valid for [Optional]
+      max_size:
+        maximum number of entries held [Optional]
+    '''
+    self.ttl = ttl
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key):
+    '''
+    the cached value for key, or None if missing or expired
+    '''
+    now = time.time()
+    with self._lock:
+      entry = self._entries.pop(key, None)
+      if entry is None or entry[0] <= now:
+        self.misses += 1
+        return None
+      self._entries[key] = entry #most recently used again
+      self.hits += 1
+      return entry[1]
+
+  def set(self, key, value):
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = (time.time() + self.ttl, value)
+      while len(self._entries) > self.max_size:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+
+  def invalidate(self, key):
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def invalidate_where(self, predicate):
+    '''
+    drop every entry whose key satisfies predicate
+    '''
+    with self._lock:
+      for key in [key for key in self._entries if predicate(key)]:
+        del self._entries[key]
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'size': len(self._entries),
+            'hit_rate': self.hits / float(lookups) if lookups else 0.0}
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+class _FileLock(object):
+  '''
+  an advisory lock on a file, held for the duration of a with block
+  '''
+  def __init__(self, path, exclusive=True):
+    self.path = path
+    self.exclusive = exclusive
+    self._file = None
+
+  def __enter__(self):
+    if fcntl is None:
+      return self
+    if not os.path.isdir(os.path.dirname(self.path)):
+      raise IOError(errno.ENOENT, 'no cache directory', self.path)
+    self._file = open(self.path, 'a')
+    fcntl.flock(self._file.fileno(),
+      fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH)
+    return self
+
+  def __exit__(self, *exc_info):
+    if self._file is not None:
+      fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+      self._file.close()
+      self._file = None
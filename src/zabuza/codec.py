@@ -0,0 +1,177 @@
+import re
+import codecs
+try:
+  import json as _json
+except ImportError:
+  import simplejson as _json
+
+#
+# Decoding (and encoding) of api payloads. The fastest installed json
+# backend is used unless one is chosen with use(), and large listings can
+# be decoded item by item straight off the response stream.
+#
+def _standard_backend():
+  return _json.loads, _json.dumps
+
+def _orjson_backend():
+  import orjson
+  return orjson.loads, lambda value: orjson.dumps(value).decode('utf-8')
+
+def _ujson_backend():
+  import ujson
+  return ujson.loads, ujson.dumps
+
+BACKENDS = {
+  'orjson': _orjson_backend,
+  'ujson': _ujson_backend,
+  'json': _standard_backend,
+}
+PREFERENCE = ('orjson', 'ujson', 'json')
+_backend = None
+
+def use(name=None):
+  '''
+  Switch the json backend used to decode and encode payloads, e.g 'orjson'
+  or 'json'. The fastest installed one is picked if name is None.
+  Returns the name of the backend now in use.
+  '''
+  global _backend
+  if name is not None and name not in BACKENDS:
+    raise ValueError('unknown json backend %s, expected one of %s'%(
+      name, ', '.join(sorted(BACKENDS))))
+  for candidate in ([name] if name else PREFERENCE):
+    try:
+      functions = BACKENDS[candidate]()
+    except ImportError:
+      if name:
+        raise
+      continue
+    _backend = (candidate,) + functions
+    return candidate
+
+def register(name, loads, dumps):
+  '''
+  make another json implementation available to use(), loads must accept
+  bytes and dumps must return a string
+  '''
+  BACKENDS[name] = lambda: (loads, dumps)
+
+def _current():
+  #picked on first use, importing a backend takes a while
+  if _backend is None:
+    use()
+  return _backend
+
+def backend():
+  return _current()[0]
+
+def loads(data):
+  return (_backend or _current())[1](data)
+
+def dumps(value):
+  return (_backend or _current())[2](value)
+
+_WHITESPACE = re.compile(r'\s*')
+_SEPARATORS = re.compile(r'[\s,]*')
+
+class StreamedListing(object):
+  '''
+  Decodes a json object incrementally from chunks of bytes, e.g
+  response.iter_content(), yielding the elements of one of its arrays (the
+  'servers' of a listing) one at a time as soon as each is complete. About
+  one chunk and one element are held in memory rather than the whole body
+  and every element decoded at once.
+
+  The other members of the object are decoded into `fields` as they are
+  met, so the ones following the array (e.g 'servers_links') are only there
+  once iteration is over.
+
+  Elements are decoded with the standard library decoder, the only one able
+  to resume from an offset in a partial document.
+  '''
+  def __init__(self, chunks, key):
+    '''
+    Args:
+      chunks:
+        an iterable of utf-8 encoded bytes holding a json object [Required]
+      key:
+        name of the array whose elements are yielded [Required]
+    '''
+    self.key = key
+    self.fields = {}
+    self.count = 0
+    self._chunks = iter(chunks)
+    self._text = codecs.getincrementaldecoder('utf-8')()
+    self._decoder = _json.JSONDecoder()
+    self._buffer = u''
+    self._position = 0
+
+  def __iter__(self):
+    self._expect(u'{')
+    while True:
+      if self._peek(skip=_SEPARATORS) == u'}':
+        return
+      key = self._value()
+      self._expect(u':')
+      if key == self.key and self._peek() == u'[':
+        self._position += 1
+        while self._peek(skip=_SEPARATORS) != u']':
+          self.count += 1
+          yield self._value()
+        self._position += 1
+      else:
+        self.fields[key] = self._value()
+
+  def close(self):
+    '''
+    stop decoding and release the chunks, e.g to close their response
+    '''
+    close = getattr(self._chunks, 'close', None)
+    if close is not None:
+      close()
+
+  def _more(self):
+    '''
+    append the next chunk to the buffer, dropping what was consumed already
+    '''
+    for chunk in self._chunks:
+      text = self._text.decode(chunk)
+      if text:
+        self._buffer = self._buffer[self._position:] + text
+        self._position = 0
+        return True
+    return False
+
+  def _peek(self, skip=_WHITESPACE):
+    '''
+    the next character that skip does not match
+    '''
+    while True:
+      self._position = skip.match(self._buffer, self._position).end()
+      if self._position < len(self._buffer):
+        return self._buffer[self._position]
+      if not self._more():
+        raise ValueError('json ended unexpectedly')
+
+  def _expect(self, token):
+    if self._peek() != token:
+      raise ValueError('expected %r at character %s of json'%(token,
+        self._position))
+    self._position += 1
+
+  def _value(self):
+    '''
+    decode the next json value, reading more chunks while it is incomplete
+    '''
+    self._peek()
+    while True:
+      try:
+        value, end = self._decoder.raw_decode(self._buffer, self._position)
+      except ValueError:
+        if not self._more():
+          raise
+        continue
+      #a number ending the buffer may go on in the next chunk
+      if end < len(self._buffer) or not self._more():
+        self._position = end
+        return value
@@ -0,0 +1,143 @@
+'''
+Columnar NumPy export of servers, for fleet analytics over many thousands
+of servers: counts by flavor, status or availability zone, age histograms
+from creation times...
+
+Requires numpy.
+'''
+from datetime import datetime
+from .inventory import utc, reference_id
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+#exported fields, and which of them are dictionary encoded
+CATEGORICAL_FIELDS = ('status', 'flavor', 'image', 'host_id',
+                      'availability_zone', 'tenant_id')
+TIMESTAMP_FIELDS = ('created', 'updated')
+FIELDS = ('id',) + CATEGORICAL_FIELDS + TIMESTAMP_FIELDS
+
+class Categorical(object):
+  '''
+  A dictionary encoded column: every value is stored as an int32 code
+  indexing categories, with -1 standing for a missing value.
+  '''
+  def __init__(self, codes, categories):
+    self.codes = codes
+    self.categories = categories
+
+  def values(self):
+    '''
+    the decoded values, None where missing
+    '''
+    lookup = numpy.array(list(self.categories) + [None], dtype=object)
+    return lookup[self.codes] #code -1 picks the trailing None
+
+  def counts(self):
+    '''
+    the number of servers for every category, as a dict
+    '''
+    present = self.codes[self.codes >= 0]
+    totals = numpy.bincount(present, minlength=len(self.categories))
+    return dict(zip(self.categories, totals.tolist()))
+
+  def __len__(self):
+    return len(self.codes)
+
+  def __repr__(self):
+    return '<Categorical %s values, %s categories>'%(len(self.codes),
+      len(self.categories))
+
+def to_columns(servers, fields=FIELDS):
+  '''
+  Export servers as a dict of field name to column: an array of strings
+  for id, a Categorical for the fields in CATEGORICAL_FIELDS (flavor and
+  image by id) and datetime64[s] arrays in UTC for created and updated,
+  NaT where unknown.
+
+  Args:
+    servers:
+      an iterable of Server objects, e.g a ServerCollection [Required]
+    fields:
+      the fields to export [Optional]
+  '''
+  _require_numpy()
+  servers = list(servers)
+  columns = {}
+  for field in fields:
+    values = [getattr(server, field) for server in servers]
+    if field in ('flavor', 'image'):
+      values = [reference_id(value) for value in values]
+    if field in CATEGORICAL_FIELDS:
+      columns[field] = encode(values)
+    elif field in TIMESTAMP_FIELDS:
+      columns[field] = timestamps(values)
+    else:
+      columns[field] = numpy.array(['' if v is None else v for v in values],
+        dtype=str)
+  return columns
+
+def to_arrays(servers, fields=FIELDS):
+  '''
+  Export servers as one NumPy structured array, a record per server, with
+  the codes of the categorical fields. Returns the array along with a dict
+  of the categories of every categorical field.
+
+  Args are the same as the ones of to_columns.
+  '''
+  columns = to_columns(servers, fields=fields)
+  dtype, categories = [], {}
+  for field in fields:
+    column = columns[field]
+    if isinstance(column, Categorical):
+      categories[field] = column.categories
+      column = columns[field] = column.codes
+    dtype.append((field, column.dtype))
+  records = numpy.empty(len(columns[fields[0]]) if fields else 0, dtype=dtype)
+  for field in fields:
+    records[field] = columns[field]
+  return records, categories
+
+def encode(values):
+  '''
+  dictionary encode values into a Categorical, categories in sorted order
+  '''
+  _require_numpy()
+  categories = sorted(set(value for value in values if value is not None))
+  index = dict((category, code) for code, category in enumerate(categories))
+  index[None] = -1
+  codes = numpy.fromiter((index[value] for value in values), dtype=numpy.int32,
+    count=len(values))
+  return Categorical(codes, categories)
+
+def timestamps(values):
+  '''
+  ISO-8601 timestamps as a datetime64[s] array in UTC, NaT where missing.
+
+  Timestamps in UTC (ending in Z or without offset, as nova issues them)
+  are parsed by NumPy in one go, only the others go through dateutil.
+  '''
+  _require_numpy()
+  strings, others = [], []
+  for position, value in enumerate(values):
+    if not value:
+      strings.append('NaT')
+    elif isinstance(value, datetime) or _has_offset(value):
+      strings.append('NaT')
+      others.append(position)
+    else:
+      strings.append(value)
+  text = numpy.char.rstrip(numpy.array(strings, dtype=str), 'Z')
+  parsed = text.astype('datetime64[us]').astype('datetime64[s]')
+  for position in others:
+    parsed[position] = numpy.datetime64(utc(values[position]), 's')
+  return parsed
+
+def _has_offset(value):
+  #offsets follow the time, past the dashes of the date
+  return value.find('+', 10) >= 0 or value.find('-', 10) >= 0
+
+def _require_numpy():
+  if numpy is None:
+    raise ImportError('columnar export requires numpy to be installed')
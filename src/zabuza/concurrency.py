@@ -0,0 +1,267 @@
+import threading
+try:
+  from Queue import Queue, Empty, Full
+except ImportError:
+  from queue import Queue, Empty, Full
+
+#
+# Small threading helpers shared by the api implementations
+#
+class BackgroundCall(object):
+  '''
+  Runs a function in a daemon thread and hands back its result (or raises
+  its exception) when asked for it.
+  '''
+  def __init__(self, func, *args, **kwargs):
+    self._result = None
+    self._error = None
+    self._thread = threading.Thread(target=self._run,
+      args=(func, args, kwargs))
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self, func, args, kwargs):
+    try:
+      self._result = func(*args, **kwargs)
+    except Exception as ex:
+      self._error = ex
+
+  def done(self):
+    return not self._thread.is_alive()
+
+  def result(self, timeout=None):
+    '''
+    wait for the call to finish and return what it returned
+    '''
+    self._thread.join(timeout)
+    if self._thread.is_alive():
+      raise RuntimeError('background call did not finish in %s seconds'%timeout)
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+class _Flight(object):
+  __slots__ = ('done', 'result', 'error')
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class SingleFlight(object):
+  '''
+  Collapses concurrent calls made with the same key into one: the first
+  caller runs the function while later callers wait for it and all receive
+  its result (or its exception).
+  '''
+  def __init__(self):
+    self.calls = 0
+    self.shared = 0
+    self._flights = {}
+    self._lock = threading.Lock()
+
+  def do(self, key, func, *args, **kwargs):
+    with self._lock:
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight()
+        self.calls += 1
+      else:
+        self.shared += 1
+    if not leader:
+      flight.done.wait()
+      if flight.error is not None:
+        raise flight.error
+      return flight.result
+    try:
+      flight.result = func(*args, **kwargs)
+      return flight.result
+    except Exception as ex:
+      flight.error = ex
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.done.set()
+
+def run_concurrently(func, items, workers=4):
+  '''
+  Call func on every item using at most `workers` threads.
+
+  Yields (item, result, error) tuples in completion order, error being None
+  when the call succeeded. Items not yet started when the caller stops
+  iterating are skipped.
+  '''
+  items = list(items)
+  if not items:
+    return
+  assert workers >= 1
+  pending, done = Queue(), Queue()
+  for item in items:
+    pending.put(item)
+  stopped = threading.Event()
+
+  def work():
+    while not stopped.is_set():
+      try:
+        item = pending.get_nowait()
+      except Empty:
+        return
+      try:
+        done.put((item, func(item), None))
+      except Exception as ex:
+        done.put((item, None, ex))
+
+  for _ in range(min(workers, len(items))):
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    thread.start()
+  try:
+    for _ in range(len(items)):
+      yield done.get()
+  finally:
+    stopped.set()
+
+class FanOut(object):
+  '''
+  Merges several iterables into one stream: each is consumed in a thread of
+  its own and their values are yielded in the order they arrive, so a slow
+  source does not hold the others back.
+
+  A source raising does not stop the others. Once iteration is over, report
+  holds a result per source, keyed like the source: 'done' with the number
+  of values it produced, or 'failed' with its error.
+  '''
+  def __init__(self, sources, workers=None, buffer_size=1000):
+    '''
+    Args:
+      sources:
+        a list of (key, iterable) pairs. Generators only start running in
+        their thread [Required]
+      workers:
+        number of sources consumed at once, all of them by default [Optional]
+      buffer_size:
+        values held waiting for the consumer before sources are paused
+        [Optional]
+    '''
+    self.sources = list(sources)
+    self.workers = workers or len(self.sources)
+    self.buffer_size = buffer_size
+    self.report = BatchReport()
+
+  def __iter__(self):
+    if not self.sources:
+      return
+    pending, arrived = Queue(), Queue(self.buffer_size)
+    for source in self.sources:
+      pending.put(source)
+    stopped = threading.Event()
+
+    def put(entry):
+      #a consumer that stopped iterating leaves the buffer full
+      while not stopped.is_set():
+        try:
+          arrived.put(entry, timeout=0.1)
+          return True
+        except Full:
+          pass
+      return False
+
+    def work():
+      while not stopped.is_set():
+        try:
+          key, iterable = pending.get_nowait()
+        except Empty:
+          return
+        count = 0
+        values = iter(iterable)
+        try:
+          for value in values:
+            if not put((key, 'value', value)):
+              return
+            count += 1
+          put((key, 'done', count))
+        except Exception as ex:
+          put((key, 'failed', ex))
+        finally:
+          close = getattr(values, 'close', None)
+          if close is not None:
+            close()
+
+    for _ in range(min(self.workers, len(self.sources))):
+      thread = threading.Thread(target=work)
+      thread.daemon = True
+      thread.start()
+    finished = 0
+    try:
+      while finished < len(self.sources):
+        key, kind, value = arrived.get()
+        if kind == 'value':
+          yield value
+        elif kind == 'done':
+          finished += 1
+          self.report.add(key, 'done', value=value)
+        else:
+          finished += 1
+          self.report.add(key, 'failed', error=value)
+    finally:
+      stopped.set()
+
+class ItemResult(object):
+  '''
+  Outcome of one operation out of a batch
+  '''
+  def __init__(self, key, status, value=None, error=None):
+    self.key = key
+    self.status = status
+    self.value = value
+    self.error = error
+
+  def __repr__(self):
+    return '<ItemResult %s: %s%s>'%(self.key, self.status,
+      ' (%s)'%self.error if self.error else '')
+
+class BatchReport(object):
+  '''
+  Per item outcome of a batch operation e.g deleting many servers.
+  '''
+  def __init__(self, failure_statuses=('failed',)):
+    self.results = []
+    self._failure_statuses = failure_statuses
+    self._lock = threading.Lock()
+
+  def add(self, key, status, value=None, error=None):
+    result = ItemResult(key, status, value=value, error=error)
+    with self._lock:
+      self.results.append(result)
+    return result
+
+  def by_status(self, status):
+    return [result for result in self.results if result.status == status]
+
+  @property
+  def failures(self):
+    return [result for result in self.results
+            if result.status in self._failure_statuses]
+
+  @property
+  def succeeded(self):
+    return [result for result in self.results
+            if result.status not in self._failure_statuses]
+
+  @property
+  def ok(self):
+    return not self.failures
+
+  def __iter__(self):
+    return iter(self.results)
+
+  def __len__(self):
+    return len(self.results)
+
+  def __repr__(self):
+    counts = {}
+    for result in self.results:
+      counts[result.status] = counts.get(result.status, 0) + 1
+    return '<BatchReport %s>'%counts
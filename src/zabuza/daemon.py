@@ -0,0 +1,248 @@
+'''
+A resident process keeping an authenticated user, its service catalog and
+its connection pool warm, taking commands from short lived clients (e.g
+tools/zserver.py) over a local unix socket. Requests and replies are single
+lines of json:
+
+  {"command": "show", "arguments": {"server_id": "..."}}
+  {"ok": true, "result": {...}}
+
+This module only imports what a client needs, the api is imported by the
+daemon itself.
+'''
+import os
+import time
+import errno
+import socket
+import logging
+import threading
+from . import codec
+try:
+  import SocketServer as socketserver
+except ImportError:
+  import socketserver
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.zabuza',
+  'zserver.sock')
+
+class DaemonError(Exception):
+  '''
+  a command failed in the daemon, the message holds its error
+  '''
+
+def server_dict(server):
+  '''
+  the fields of a Server as api json, which Server.from_json accepts
+  '''
+  return server.to_json()
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+  '''
+  serves the commands sent over one client connection, one per line
+  '''
+  def handle(self):
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      try:
+        request = codec.loads(line)
+        reply = {'ok': True, 'result': self.server.dispatch(
+          request['command'], request.get('arguments') or {})}
+      except Exception as ex:
+        logging.debug('daemon command failed: %s'%ex)
+        reply = {'ok': False, 'error': '%s: %s'%(type(ex).__name__, ex)}
+      self.wfile.write((codec.dumps(reply) + '\n').encode('utf-8'))
+      self.wfile.flush()
+
+class ZabuzaDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  '''
+  Serves api commands on a unix socket, readable and writable by the
+  current user only, on behalf of one authenticated Api object.
+
+  Commands are ping, list, show, create, delete and stop, each being a
+  do_<command> method taking the arguments sent by the client.
+  '''
+  daemon_threads = True
+
+  def __init__(self, api, path=None):
+    '''
+    Args:
+      api:
+        an Api object, best created with a refresh_window so its token
+        never expires while the daemon waits for commands [Required]
+      path:
+        where the socket is created. defaults to ~/.zabuza/zserver.sock
+        [Optional]
+    '''
+    self.api = api
+    self.path = path or DEFAULT_SOCKET
+    self.started = time.time()
+    _prepare_socket_path(self.path)
+    umask = os.umask(0o077)
+    try:
+      socketserver.UnixStreamServer.__init__(self, self.path, _CommandHandler)
+    finally:
+      os.umask(umask)
+
+  def dispatch(self, command, arguments):
+    handler = getattr(self, 'do_%s'%command, None)
+    if handler is None:
+      raise ValueError('unknown command %s'%command)
+    return handler(**arguments)
+
+  def serve(self):
+    '''
+    serve commands until stopped, then remove the socket
+    '''
+    logging.debug('zabuza daemon listening on %s'%self.path)
+    try:
+      self.serve_forever()
+    finally:
+      self.server_close()
+      try:
+        os.unlink(self.path)
+      except OSError:
+        pass
+
+  def do_ping(self):
+    user = self.api.user
+    return {'pid': os.getpid(), 'uptime': time.time() - self.started,
+            'authenticated': user.is_authenticated(),
+            'auth_url': user.auth_url, 'username': user.credentials.username,
+            'tenant_name': user.tenant_name}
+
+  def do_list(self, **filters):
+    return [server_dict(server)
+            for server in self.api.iter_servers_detail(**filters)]
+
+  def do_show(self, server_id):
+    return server_dict(self.api.get_server_detail(server_id=server_id))
+
+  def do_create(self, image, flavor, name, count=1, **kwargs):
+    from .services.compute import Server
+    server = Server.create_server_for_deployment(image, flavor, name)
+    if count > 1:
+      report = self.api.create_servers(template=server, count=count, **kwargs)
+      return [server_dict(result.value) if result.error is None
+              else {'name': result.value.name, 'error': str(result.error)}
+              for result in report]
+    self.api.create_server(server, **kwargs)
+    return [server_dict(server)]
+
+  def do_delete(self, server_ids, workers=4):
+    report = self.api.delete_servers(server_ids=server_ids, workers=workers)
+    return [{'id': result.key, 'status': result.status,
+             'error': str(result.error) if result.error else None}
+            for result in report]
+
+  def do_stop(self):
+    #shutdown waits for serve_forever to return, so not from its thread
+    stopper = threading.Thread(target=self.shutdown)
+    stopper.daemon = True
+    stopper.start()
+    return True
+
+def _prepare_socket_path(path):
+  '''
+  create the socket directory, and remove a socket left behind by a daemon
+  that is gone. Raises if a live daemon already listens on path.
+  '''
+  directory = os.path.dirname(path)
+  try:
+    os.makedirs(directory, 0o700)
+  except OSError as ex:
+    if ex.errno != errno.EEXIST:
+      raise
+  if not os.path.exists(path):
+    return
+  if DaemonClient(path).available():
+    raise Exception('a zabuza daemon is already listening on %s'%path)
+  os.unlink(path)
+
+class DaemonClient(object):
+  '''
+  Sends commands to a ZabuzaDaemon over one connection, opened on first use
+  '''
+  def __init__(self, path=None, timeout=300):
+    '''
+    Args:
+      path:
+        socket of the daemon. defaults to ~/.zabuza/zserver.sock [Optional]
+      timeout:
+        seconds to wait for a reply [Optional]
+    '''
+    self.path = path or DEFAULT_SOCKET
+    self.timeout = timeout
+    self._socket = None
+    self._file = None
+
+  def available(self):
+    '''
+    whether a daemon answers on the socket
+    '''
+    if not os.path.exists(self.path):
+      return False
+    try:
+      self.call('ping')
+    except (socket.error, DaemonError):
+      return False
+    finally:
+      self.close()
+    return True
+
+  def serves(self, auth_url=None, username=None, tenant_name=None):
+    '''
+    whether a daemon answers on the socket and acts as the given user, only
+    the credentials given are compared
+    '''
+    if not os.path.exists(self.path):
+      return False
+    try:
+      identity = self.call('ping')
+    except (socket.error, DaemonError):
+      self.close()
+      return False
+    expected = {'auth_url': auth_url, 'username': username,
+                'tenant_name': tenant_name}
+    return all(identity.get(key) == value
+               for key, value in expected.items() if value)
+
+  def call(self, command, **arguments):
+    '''
+    run a command in the daemon and return its result, raises a DaemonError
+    if it failed there
+    '''
+    if self._socket is None:
+      self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self._socket.settimeout(self.timeout)
+      try:
+        self._socket.connect(self.path)
+      except socket.error:
+        self.close()
+        raise
+      self._file = self._socket.makefile('rb')
+    request = {'command': command, 'arguments': arguments}
+    self._socket.sendall((codec.dumps(request) + '\n').encode('utf-8'))
+    line = self._file.readline()
+    if not line:
+      self.close()
+      raise DaemonError('the daemon closed the connection')
+    reply = codec.loads(line)
+    if not reply['ok']:
+      raise DaemonError(reply['error'])
+    return reply['result']
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -0,0 +1,371 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from .lazy import LazyModule
+
+_dateutil_parser = LazyModule('dateutil.parser')
+_dateutil_tz = LazyModule('dateutil.tz')
+
+#
+# In memory views over the servers of a tenant
+#
+def utc(value):
+  '''
+  a naive UTC datetime from a datetime or ISO-8601 string, naive values are
+  taken to be UTC already as openstack issues them
+  '''
+  if not isinstance(value, datetime):
+    value = _dateutil_parser.parse(value)
+  if value.tzinfo is not None:
+    value = value.astimezone(_dateutil_tz.tzutc()).replace(tzinfo=None)
+  return value
+
+def reference_id(value):
+  '''
+  the id of a flavor or image reference, which the api returns either as
+  an id string or as a dict holding the id and links
+  '''
+  if isinstance(value, dict):
+    return value.get('id')
+  return value
+
+class ServerCollection(object):
+  '''
+  Servers held in memory with hash indexes on the fields fleets are usually
+  queried by, so queries are answered by intersecting sets of ids rather
+  than scanning every server.
+
+  Indexed fields are status, host_id, availability_zone, tenant_id, flavor
+  (by id), image (by id) and metadata keys and key/value pairs. After
+  changing a server it holds, add it again to update the indexes.
+  '''
+  INDEXED_FIELDS = ('status', 'host_id', 'availability_zone', 'tenant_id',
+                    'flavor', 'image')
+
+  def __init__(self, servers=()):
+    self._servers = {}
+    self._indexes = dict((field, {}) for field in self.INDEXED_FIELDS)
+    self._metadata_keys = {}
+    self._metadata_items = {}
+    self._indexed = {} #server id to the index entries it was filed under
+    self._lock = threading.RLock()
+    for server in servers:
+      self.add(server)
+
+  def add(self, server):
+    '''
+    add a server, or replace the one with the same id, and index it
+    '''
+    with self._lock:
+      if server.id in self._servers:
+        self._unindex(server.id)
+      self._servers[server.id] = server
+      entries = []
+      for field in self.INDEXED_FIELDS:
+        value = getattr(server, field)
+        if field in ('flavor', 'image'):
+          value = reference_id(value)
+        if value is not None:
+          entries.append((self._indexes[field], value))
+      for key, value in (server.metadata or {}).items():
+        entries.append((self._metadata_keys, key))
+        entries.append((self._metadata_items, (key, value)))
+      for index, value in entries:
+        index.setdefault(value, set()).add(server.id)
+      self._indexed[server.id] = entries
+
+  update = add
+
+  def remove(self, server_id):
+    '''
+    drop a server and its index entries, returns the server if present
+    '''
+    with self._lock:
+      if server_id not in self._servers:
+        return None
+      self._unindex(server_id)
+      return self._servers.pop(server_id)
+
+  def _unindex(self, server_id):
+    for index, value in self._indexed.pop(server_id, []):
+      ids = index.get(value)
+      if ids is not None:
+        ids.discard(server_id)
+        if not ids:
+          del index[value]
+
+  def query(self, **criteria):
+    '''
+    Servers matching all the criteria e.g
+      query(status='ERROR', host_id='abc')
+      query(availability_zone='nova-2', metadata={'role': 'db'})
+      query(status=['ERROR', 'SHUTOFF']).where(has_metadata='owner')
+
+    A list, tuple or set value matches any of its values. Fields that are
+    not indexed (e.g name) are checked against the indexed matches.
+    '''
+    return ServerQuery(self, list(criteria.items()))
+
+  def values(self, field):
+    '''
+    the distinct indexed values of a field with their number of servers
+    '''
+    with self._lock:
+      return dict((value, len(ids))
+                  for value, ids in self._indexes[field].items())
+
+  def _ids_for(self, field, value):
+    '''
+    ids of servers matching one criterion, None if the field is not indexed
+    '''
+    if field == 'metadata':
+      groups = [self._metadata_items.get(item, set()) for item in value.items()]
+      return set.intersection(*groups) if groups else set(self._servers)
+    if field == 'has_metadata':
+      index = self._metadata_keys
+    elif field in self._indexes:
+      index = self._indexes[field]
+    else:
+      return None
+    if isinstance(value, (list, tuple, set, frozenset)):
+      ids = set()
+      for item in value:
+        ids |= index.get(item, set())
+      return ids
+    return set(index.get(value, ()))
+
+  def to_columns(self, fields=None):
+    '''
+    the servers as NumPy columns, see columns.to_columns
+    '''
+    from .columns import to_columns, FIELDS
+    return to_columns(self, fields=fields or FIELDS)
+
+  def to_arrays(self, fields=None):
+    '''
+    the servers as a NumPy structured array, see columns.to_arrays
+    '''
+    from .columns import to_arrays, FIELDS
+    return to_arrays(self, fields=fields or FIELDS)
+
+  def get(self, server_id, default=None):
+    return self._servers.get(server_id, default)
+
+  def __getitem__(self, server_id):
+    return self._servers[server_id]
+
+  def __contains__(self, server_id):
+    return server_id in self._servers
+
+  def __iter__(self):
+    return iter(list(self._servers.values()))
+
+  def __len__(self):
+    return len(self._servers)
+
+class ServerQuery(object):
+  '''
+  A composable query over a ServerCollection, evaluated when iterated
+  '''
+  def __init__(self, collection, criteria):
+    self.collection = collection
+    self.criteria = criteria #a list of (field, value) pairs
+
+  def where(self, **criteria):
+    '''
+    a narrower query also matching the given criteria
+    '''
+    return ServerQuery(self.collection,
+      self.criteria + list(criteria.items()))
+
+  @property
+  def ids(self):
+    '''
+    the set of ids of matching servers
+    '''
+    collection = self.collection
+    with collection._lock:
+      groups, unindexed = [], []
+      for field, value in self.criteria:
+        ids = collection._ids_for(field, value)
+        if ids is None:
+          unindexed.append((field, value))
+        else:
+          groups.append(ids)
+      if groups:
+        groups.sort(key=len)
+        matches = groups[0].intersection(*groups[1:])
+      else:
+        matches = set(collection._servers)
+      for field, value in unindexed:
+        matches = set(server_id for server_id in matches
+          if self._matches(getattr(collection._servers[server_id], field), value))
+      return matches
+
+  def _matches(self, actual, expected):
+    if isinstance(expected, (list, tuple, set, frozenset)):
+      return actual in expected
+    return actual == expected
+
+  def __iter__(self):
+    for server_id in self.ids:
+      server = self.collection.get(server_id)
+      if server is not None:
+        yield server
+
+  def __len__(self):
+    return len(self.ids)
+
+  def all(self):
+    return list(self)
+
+  def to_columns(self, fields=None):
+    '''
+    the matching servers as NumPy columns, see columns.to_columns
+    '''
+    from .columns import to_columns, FIELDS
+    return to_columns(self, fields=fields or FIELDS)
+
+  def to_arrays(self, fields=None):
+    '''
+    the matching servers as a NumPy structured array, see columns.to_arrays
+    '''
+    from .columns import to_arrays, FIELDS
+    return to_arrays(self, fields=fields or FIELDS)
+
+class ServerInventory(object):
+  '''
+  The servers of a tenant, kept current by fetching only the servers that
+  changed since the previous sync (including deleted ones) instead of
+  listing the whole fleet every time.
+
+  The servers are held in a ServerCollection, so they can be queried by
+  their indexed fields.
+  '''
+  DELETED_STATUSES = ('DELETED', 'SOFT_DELETED')
+
+  def __init__(self, api, overlap=1, page_size=None, lazy=False,
+               compute_type='compute', **filters):
+    '''
+    Args:
+      api:
+        an Api object to list servers with [Required]
+      overlap:
+        seconds the sync watermark is moved back by, so changes made in the
+        same second as the last sync are not missed [Optional]
+      page_size:
+        number of servers fetched per page [Optional]
+      lazy:
+        keep LazyServers rather than fully decoded ones [Optional]
+      compute_type:
+        type of compute, e.g compute or computev3 [Optional]
+
+    any other keyword args (flavor, name, status, host) filter the servers
+    tracked and are passed on to every listing. Note that nova does not
+    report servers that stopped matching a filter, so those are only
+    dropped by a reload.
+    '''
+    self.api = api
+    self.overlap = timedelta(seconds=overlap)
+    self.page_size = page_size
+    self.lazy = lazy
+    self.compute_type = compute_type
+    self.filters = filters
+    self.watermark = None
+    self.collection = ServerCollection()
+    self._lock = threading.Lock()
+    self._loaded = False
+
+  def refresh(self):
+    '''
+    Bring the inventory up to date: a full listing the first time, only
+    the servers changed since the watermark afterwards.
+
+    Returns a dict with the 'added', 'changed' and 'removed' server ids.
+    '''
+    with self._lock:
+      started = datetime.utcnow()
+      changes = {'added': [], 'changed': [], 'removed': []}
+      if not self._loaded:
+        previous = self.collection
+        self.collection = ServerCollection(self._listing())
+        changes['added'] = [s.id for s in self.collection]
+        changes['removed'] = [s.id for s in previous
+                              if s.id not in self.collection]
+        latest = self._latest(self.collection)
+        self._loaded = True
+      else:
+        changed = list(self._listing(changes_since=self.watermark))
+        latest = self._latest(changed)
+        for server in changed:
+          self._merge(server, changes)
+      if latest is not None:
+        self.watermark = max(latest - self.overlap, self.watermark or latest)
+      elif self.watermark is None:
+        #nothing to go by from the api yet, fall back to our own clock
+        self.watermark = started - self.overlap
+      logging.debug('inventory synced, %s servers, watermark %s, changes %s'%(
+        len(self.collection), self.watermark,
+        dict((k, len(v)) for k, v in changes.items())))
+      return changes
+
+  def reload(self):
+    '''
+    forget the watermark so the next refresh lists the whole fleet again
+    '''
+    with self._lock:
+      self._loaded = False
+      self.watermark = None
+    return self.refresh()
+
+  def get(self, server_id, default=None):
+    return self.collection.get(server_id, default)
+
+  def query(self, **criteria):
+    '''
+    query the current fleet, see ServerCollection.query
+    '''
+    return self.collection.query(**criteria)
+
+  @property
+  def servers(self):
+    '''
+    a snapshot of the current fleet as a dict of server id to server
+    '''
+    return dict((server.id, server) for server in self.collection)
+
+  def __contains__(self, server_id):
+    return server_id in self.collection
+
+  def __iter__(self):
+    return iter(self.collection)
+
+  def __len__(self):
+    return len(self.collection)
+
+  def _listing(self, changes_since=None):
+    return self.api.iter_servers_detail(changes_since=changes_since,
+      page_size=self.page_size, lazy=self.lazy,
+      compute_type=self.compute_type, **self.filters)
+
+  def _merge(self, server, changes):
+    known = server.id in self.collection
+    if server.status in self.DELETED_STATUSES:
+      if known:
+        self.collection.remove(server.id)
+        changes['removed'].append(server.id)
+      return
+    self.collection.add(server)
+    changes['changed' if known else 'added'].append(server.id)
+
+  def _latest(self, servers):
+    '''
+    the most recent update time of the given servers as told by the api
+    '''
+    latest = None
+    for server in servers:
+      if server.updated:
+        updated = utc(server.updated)
+        if latest is None or updated > latest:
+          latest = updated
+    return latest
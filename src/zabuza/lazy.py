@@ -0,0 +1,25 @@
+import sys
+
+class LazyModule(object):
+  '''
+  Stands in for a module that is only imported when one of its attributes
+  is first used, so importing zabuza stays cheap for short lived processes
+  that never reach the code needing it.
+  '''
+  def __init__(self, name):
+    self.__dict__['_name'] = name
+    self.__dict__['_module'] = None
+
+  def _load(self):
+    module = self.__dict__['_module']
+    if module is None:
+      __import__(self._name)
+      module = self.__dict__['_module'] = sys.modules[self._name]
+    return module
+
+  def __getattr__(self, attribute):
+    return getattr(self._load(), attribute)
+
+  def __repr__(self):
+    state = 'loaded' if self.__dict__['_module'] is not None else 'not loaded'
+    return '<LazyModule %s (%s)>'%(self._name, state)
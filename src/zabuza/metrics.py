@@ -0,0 +1,167 @@
+import threading
+from bisect import bisect_left
+
+#
+# Sinks for the metrics recorded by User and Api objects. Any object with
+# request() and event() methods taking the same arguments can be used.
+#
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+class CallbackMetrics(object):
+  '''
+  Hands every measurement to a function, e.g to forward them to statsd.
+  The function is called with the kind of measurement ('request' or
+  'event') and a dict of its fields.
+  '''
+  def __init__(self, callback):
+    self.callback = callback
+
+  def request(self, operation, host, method, status, elapsed, sent=0,
+              received=0):
+    self.callback('request', {'operation': operation, 'host': host,
+      'method': method, 'status': status, 'elapsed': elapsed, 'sent': sent,
+      'received': received})
+
+  def event(self, name, operation=None, host=None, value=1):
+    self.callback('event', {'name': name, 'operation': operation,
+      'host': host, 'value': value})
+
+class _Series(object):
+  __slots__ = ('buckets', 'count', 'total', 'statuses', 'sent', 'received')
+
+  def __init__(self, size):
+    self.buckets = [0] * size
+    self.count = 0
+    self.total = 0.0
+    self.statuses = {}
+    self.sent = 0
+    self.received = 0
+
+class InMemoryMetrics(object):
+  '''
+  Aggregates measurements in memory, per operation, endpoint host and http
+  method: a latency histogram, response counts by status and the bytes
+  sent and received. Events (retries, re-authentications...) are counted
+  and their values summed per name, operation and host.
+  '''
+  def __init__(self, buckets=DEFAULT_BUCKETS):
+    '''
+    Args:
+      buckets:
+        sorted upper bounds in seconds of the latency histogram buckets
+        [Optional]
+    '''
+    self.buckets = tuple(buckets)
+    self._series = {}
+    self._events = {}
+    self._lock = threading.Lock()
+
+  def request(self, operation, host, method, status, elapsed, sent=0,
+              received=0):
+    key = (operation, host, method)
+    with self._lock:
+      series = self._series.get(key)
+      if series is None:
+        series = self._series[key] = _Series(len(self.buckets) + 1)
+      series.buckets[bisect_left(self.buckets, elapsed)] += 1
+      series.count += 1
+      series.total += elapsed
+      series.statuses[status] = series.statuses.get(status, 0) + 1
+      series.sent += sent
+      series.received += received
+
+  def event(self, name, operation=None, host=None, value=1):
+    key = (name, operation, host)
+    with self._lock:
+      count, total = self._events.get(key, (0, 0))
+      self._events[key] = (count + 1, total + value)
+
+  def snapshot(self):
+    '''
+    a copy of everything recorded so far as a dict of 'requests' and
+    'events' lists. Histogram buckets are cumulative, keyed by their upper
+    bound with '+Inf' holding the total count.
+    '''
+    with self._lock:
+      requests = []
+      for (operation, host, method), series in sorted(self._series.items(),
+          key=lambda item: tuple(str(part) for part in item[0])):
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + ('+Inf',), series.buckets):
+          cumulative += count
+          buckets.append((bound, cumulative))
+        requests.append({'operation': operation, 'host': host,
+          'method': method, 'count': series.count, 'sum': series.total,
+          'buckets': buckets, 'statuses': dict(series.statuses),
+          'sent': series.sent, 'received': series.received})
+      events = [{'name': name, 'operation': operation, 'host': host,
+                 'count': count, 'sum': total}
+                for (name, operation, host), (count, total)
+                in sorted(self._events.items(),
+                  key=lambda item: tuple(str(part) for part in item[0]))]
+    return {'requests': requests, 'events': events}
+
+  def reset(self):
+    with self._lock:
+      self._series.clear()
+      self._events.clear()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+class PrometheusMetrics(InMemoryMetrics):
+  '''
+  In memory metrics rendered in the Prometheus text exposition format,
+  e.g to be served from a /metrics page.
+  '''
+  def __init__(self, buckets=DEFAULT_BUCKETS, prefix='zabuza'):
+    InMemoryMetrics.__init__(self, buckets=buckets)
+    self.prefix = prefix
+
+  def render(self):
+    snapshot = self.snapshot()
+    name = lambda suffix: '%s_%s'%(self.prefix, suffix)
+    lines = ['# TYPE %s histogram'%name('request_duration_seconds')]
+    for series in snapshot['requests']:
+      labels = _labels(operation=series['operation'], host=series['host'],
+        method=series['method'])
+      for bound, count in series['buckets']:
+        lines.append('%s_bucket{%s,le="%s"} %s'%(
+          name('request_duration_seconds'), labels, bound, count))
+      lines.append('%s_sum{%s} %s'%(name('request_duration_seconds'), labels,
+        series['sum']))
+      lines.append('%s_count{%s} %s'%(name('request_duration_seconds'), labels,
+        series['count']))
+    lines.append('# TYPE %s counter'%name('responses_total'))
+    for series in snapshot['requests']:
+      for status, count in sorted(series['statuses'].items(),
+                                  key=lambda item: str(item[0])):
+        lines.append('%s{%s} %s'%(name('responses_total'), _labels(
+          operation=series['operation'], host=series['host'],
+          method=series['method'], status=status), count))
+    for direction in ('sent', 'received'):
+      metric = name('bytes_%s_total'%direction)
+      lines.append('# TYPE %s counter'%metric)
+      for series in snapshot['requests']:
+        lines.append('%s{%s} %s'%(metric, _labels(
+          operation=series['operation'], host=series['host'],
+          method=series['method']), series[direction]))
+    for suffix, field in (('events_total', 'count'), ('events_sum', 'sum')):
+      lines.append('# TYPE %s counter'%name(suffix))
+      for event in snapshot['events']:
+        lines.append('%s{%s} %s'%(name(suffix), _labels(event=event['name'],
+          operation=event['operation'], host=event['host']), event[field]))
+    return '\n'.join(lines) + '\n'
+
+def _labels(**labels):
+  escape = lambda value: ('%s'%('' if value is None else value)).replace(
+    '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return ','.join('%s="%s"'%(key, escape(labels[key]))
+                  for key in sorted(labels))
@@ -1,15 +1,52 @@
-import requests
+import re
+import string
 import logging
 import base64
-from random import choice
+import threading
+import time
 from traceback import format_exc
-from datetime import datetime
-from dateutil.parser import parse as dateparser
-from services.compute import Server
+from datetime import datetime, timedelta
+from .services.compute import Server
+from .concurrency import BackgroundCall, BatchReport, SingleFlight
+from .concurrency import run_concurrently, FanOut
+from .selection import RandomSelector
+from .retry import RetryPolicy, CircuitOpenError, retry_after
+from .inventory import utc
+from . import codec
+from .lazy import LazyModule
 try:
   from json import loads, dumps
 except ImportError:
   from simplejson  import loads, dumps
+try:
+  from urlparse import urlparse
+except ImportError:
+  from urllib.parse import urlparse
+
+#requests and dateutil are slow to import, load them when first needed
+requests = LazyModule('requests')
+_dateutil_parser = LazyModule('dateutil.parser')
+_dateutil_tz = LazyModule('dateutil.tz')
+
+def dateparser(value):
+  return _dateutil_parser.parse(value)
+
+#filters of get_servers_detail a listing can be sharded on
+SHARD_FILTERS = ('flavor', 'name', 'status', 'host')
+
+def name_prefix_shards(characters=string.ascii_lowercase + string.digits):
+  '''
+  Filters splitting a servers listing by the first character of server
+  names, for get_servers_detail(shards=...). Nova matches names as regular
+  expressions, the last shard catches names starting with any character
+  that is not in characters so every named server is listed.
+  '''
+  escaped = [re.escape(character) for character in characters]
+  return ([{'name': '^' + character} for character in escaped] +
+          [{'name': '^[^%s]'%''.join(escaped)}])
+
+def tzutc():
+  return _dateutil_tz.tzutc()
 
 class Endpoint(object):
   '''
@@ -44,7 +81,11 @@ class Endpoint(object):
 
   @property
   def region(self):
-    return self._expires
+    return self._region
+
+  @property
+  def admin_url(self):
+    return self._admin_url
 
   @property
   def internal_url(self):
@@ -62,17 +103,27 @@ class Endpoint(object):
   def name(self):
     return self._name
 
-  def fetch_url(self, path):
+  def url_for(self, interface='public'):
+    '''
+    base url of this endpoint for an interface: public, internal or admin
+    '''
+    return {'public': self._public_url,
+            'internal': self._internal_url,
+            'admin': self._admin_url}[interface]
+
+  def fetch_url(self, path, interface='public'):
     '''
     Construct a proper url given a path
     Args:
       path:
         a list of all string tokens in a path e.g [foo, bar, vim] which
         corresponds to <base_url>/foo/bar/vim
+      interface:
+        which url of the endpoint to use: public, internal or admin
     '''
     if type(path) != list:
       path = [path]
-    return '/'.join([self._public_url]+path)
+    return '/'.join([self.url_for(interface)]+path)
 
   def __eq__(self, other):
     assert isinstance(other, Endpoint)
@@ -93,19 +144,51 @@ class Endpoint(object):
     
     return True
 
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash((self.id, self.public_url))
+
+  def __repr__(self):
+    return '<Endpoint %s %s %s>'%(self._type, self._region, self._public_url)
+
+class _NoRegion(object):
+  '''
+  region of the endpoints keystone lists without one
+  '''
+  def __repr__(self):
+    return 'NO_REGION'
+
+  def __reduce__(self):
+    #unpickles to the module's instance, catalog indexes are keyed by it
+    return 'NO_REGION'
+
+NO_REGION = _NoRegion()
 
 class ServiceCatalog(object):
   '''
   A representation of a service catalog.
   Allows you to retrieve endpoints of a specific service
+
+  Endpoints are indexed by service type, region and interface. When several
+  endpoints could serve a call, the selector decides which one does: by
+  default at random, or see selection.LatencyAwareSelector to prefer the
+  fastest healthy endpoint.
   '''
+  INTERFACES = ('public', 'internal', 'admin')
+
   def __init__(self, *args, **kwargs):
     '''
     Expected keyword arguments:
     service_catalog: a service catalog list object returned by keystone 
+    selector: an endpoint selection strategy [Optional]
     '''
     #break if there is no endpoints key
     self._catalog = dict()
+    self._index = dict()
+    base_urls = set()
+    self.selector = kwargs.get('selector') or RandomSelector()
     sc = kwargs.get('service_catalog') or kwargs.get('serviceCatalog')
     assert sc is not None
     for service in sc:
@@ -113,22 +196,165 @@ class ServiceCatalog(object):
       if atype not in self._catalog:
         self._catalog[atype] = []
       for endpoint in service['endpoints']:
-        self._catalog[atype].append(Endpoint(name=aname, type=atype, **endpoint))
-
-  def get_endpoint_for(self, service_type, region=None):
+        endpoint = Endpoint(name=aname, type=atype, **endpoint)
+        self._catalog[atype].append(endpoint)
+        for interface in self.INTERFACES:
+          url = endpoint.url_for(interface)
+          if not url:
+            continue
+          #None looks up endpoints of any region, NO_REGION those without one
+          region = NO_REGION if endpoint.region is None else endpoint.region
+          for region in (region, None):
+            self._index.setdefault((atype, region, interface), []).append(endpoint)
+          base_urls.add(url.rstrip('/'))
+    #longest first, so the most specific base url matches a request url
+    self._base_urls = sorted(base_urls, key=len, reverse=True)
+
+  def get_endpoints_for(self, service_type, region=None, interface='public'):
     '''
-    Supported service_types include:
-      s3, volumev2, network, compute, computev3
+    all endpoints of a service type, optionally only those of a region,
+    which have a url for the interface
     '''
     if service_type not in self._catalog:
       logging.debug('here is service catalog: %s'%self._catalog)
       logging.debug('here is service_type %s'%service_type)
       raise ValueError('Unrecognized service type endpoint specified')
-    selector = lambda endpoints: choice(endpoints)
-    if not region:
-      return selector(self._catalog[service_type])
-    else:
-      return filter(lambda x: x.region == region, self._catalog[service_type])
+    return list(self._index.get((service_type, region, interface), []))
+
+  def get_endpoint_for(self, service_type, region=None, interface='public'):
+    '''
+    Supported service_types include:
+      s3, volumev2, network, compute, computev3
+
+    region None picks among the endpoints of every region, NO_REGION among
+    the endpoints listed without a region
+    '''
+    endpoints = self._index.get((service_type, region, interface))
+    if not endpoints:
+      self.get_endpoints_for(service_type) #raises for unknown types
+      raise ValueError('no %s %s endpoint in region %s'%(interface,
+        service_type, region))
+    if len(endpoints) == 1:
+      return endpoints[0]
+    #several services may register the same url, map back within this list
+    by_url = dict((endpoint.url_for(interface).rstrip('/'), endpoint)
+                  for endpoint in endpoints)
+    urls = [endpoint.url_for(interface).rstrip('/') for endpoint in endpoints]
+    return by_url[self.selector.select(urls)]
+
+  def regions(self, service_type):
+    '''
+    the regions a service type has endpoints in, None standing first for
+    endpoints without a region
+    '''
+    return sorted(set(endpoint.region
+                      for endpoint in self.get_endpoints_for(service_type)),
+                  key=lambda region: (region is not None, region))
+
+  def record(self, url, elapsed, failed=False):
+    '''
+    tell the selector how a call to a url went: how many seconds it took,
+    and whether it failed with a connection error or server side error
+    '''
+    for base_url in self._base_urls:
+      if url.startswith(base_url):
+        self.selector.record(base_url, elapsed, failed=failed)
+        return
+
+class ConnectionPool(object):
+  '''
+  A pool of keep-alive http connections shared by a user and every Api
+  object built on top of it, so that consecutive calls to keystone or nova
+  reuse already established tcp/tls connections.
+  '''
+  def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False,
+    host_limits=None):
+    '''
+    Args:
+      pool_connections:
+        number of distinct endpoint hosts to keep connection pools for
+      pool_maxsize:
+        maximum number of connections kept alive per endpoint host
+      pool_block:
+        if True, block when all connections to a host are in use instead
+        of opening (and then discarding) an extra connection
+      host_limits:
+        dict of url prefix to maximum connections for that endpoint e.g
+        {'https://nova.example.com:8774': 50} [Optional]
+    '''
+    self.pool_connections = pool_connections
+    self.pool_maxsize = pool_maxsize
+    self.pool_block = pool_block
+    self.host_limits = dict(host_limits or {})
+    self._session = None
+    self._lock = threading.Lock()
+
+  @property
+  def session(self):
+    '''
+    the underlying requests session, created on first use
+    '''
+    if self._session is None:
+      with self._lock:
+        if self._session is None:
+          self._session = self._create_session()
+    return self._session
+
+  def _create_session(self):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+      pool_connections=self.pool_connections,
+      pool_maxsize=self.pool_maxsize,
+      pool_block=self.pool_block)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    for prefix, limit in self.host_limits.items():
+      session.mount(prefix, requests.adapters.HTTPAdapter(pool_connections=1,
+        pool_maxsize=limit, pool_block=self.pool_block))
+    return session
+
+  def request(self, method, url, **kwargs):
+    '''
+    Issue an http request over a pooled connection. Takes the same keyword
+    arguments as requests.request
+    '''
+    return self.session.request(method, url, **kwargs)
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def delete(self, url, **kwargs):
+    return self.request('DELETE', url, **kwargs)
+
+  def close(self):
+    '''
+    close all pooled connections. The pool can still be used afterwards, new
+    connections will simply be established again.
+    '''
+    with self._lock:
+      session, self._session = self._session, None
+    if session is not None:
+      session.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __getstate__(self):
+    #live connections and locks do not survive pickling
+    state = self.__dict__.copy()
+    state['_session'] = None
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
 
 class Token(object):
   '''
@@ -164,6 +390,17 @@ class Token(object):
   def tenant(self):
     return self._tenant
 
+  def expires_in(self):
+    '''
+    seconds left until this token expires, negative once it has. Expiry
+    times without a timezone are taken to be UTC as keystone issues them.
+    '''
+    expires = self._expires
+    if expires.tzinfo is not None:
+      expires = expires.astimezone(tzutc()).replace(tzinfo=None)
+    delta = expires - datetime.utcnow()
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
   def __str__(self):
     return self._id
 
@@ -208,8 +445,45 @@ class User(object):
   An abstract representation of an openstack user.
   Handles authentication of current user.
   '''
+  #never schedule background refreshes closer together than this (seconds)
+  MIN_REFRESH_INTERVAL = 1.0
+
   def __init__(self, auth_url, username=None, password=None, token=None,
-    tenant_name=None):
+    tenant_name=None, pool=None, token_cache=None, refresh_window=None,
+    endpoint_selector=None, retry_policy=None, metrics=None,
+    rate_limiter=None):
+    '''
+    Args:
+      pool:
+        a ConnectionPool used for all http calls made as this user, it is
+        shared with every Api object using this user. [Optional]
+      token_cache:
+        a TokenCache. if it holds a valid token for this auth_url, username
+        and tenant the user starts out authenticated without contacting
+        keystone, and new tokens are saved to it. [Optional]
+      refresh_window:
+        seconds before token expiry at which a new token is fetched in the
+        background, so calls never wait on keystone. Disabled if None.
+        [Optional]
+      endpoint_selector:
+        strategy choosing between endpoints of a service, e.g a
+        selection.LatencyAwareSelector. Random by default. [Optional]
+      retry_policy:
+        a retry.RetryPolicy deciding which failed calls made as this user
+        are retried and when, and holding the circuit breakers of the API
+        nodes. Defaults to RetryPolicy() [Optional]
+      metrics:
+        a sink from the metrics module (or any object with the same request
+        and event methods) recording latency, status codes, bytes, retries
+        and authentications of every call made as this user. Nothing is
+        measured if None [Optional]
+      rate_limiter:
+        a ratelimit.RateLimiter every call made as this user waits on, so
+        all threads and Api objects sharing the user stay under its limits.
+        Calls rejected by rate limiting (413, 429) hold back the following
+        ones. Waits are recorded as rate_limit_wait metrics events
+        [Optional]
+    '''
     self._credentials = PasswordCredential(username, password)
     if type(token) == Token:
       self._token = token
@@ -225,7 +499,19 @@ class User(object):
     self._name = None
     self._roles = []
     self._catalog = None
-
+    self.pool = pool or ConnectionPool()
+    self.token_cache = token_cache
+    self.refresh_window = refresh_window
+    self.endpoint_selector = endpoint_selector
+    self.retry_policy = retry_policy or RetryPolicy()
+    self.metrics = metrics
+    self.rate_limiter = rate_limiter
+    self._auth_lock = threading.RLock()
+    self._refresh_timer = None
+    if token_cache and not self._token:
+      self._load_cached_token()
+    if self.is_authenticated():
+      self._schedule_refresh()
 
   def _get_credentials(self):
     return self._credentials
@@ -274,7 +560,7 @@ class User(object):
     return success.
     '''
     if self.token:
-      return self.token.expires.replace(tzinfo=None) > datetime.now()
+      return self.token.expires_in() > 0
     else:
       return False
 
@@ -285,31 +571,241 @@ class User(object):
     Raises appropriate errors if authentication failed otherwise proceeds as
     normal.
     '''
+    with self._auth_lock:
+      post_data = self._authentication_body()
+      if self.metrics is not None:
+        self.metrics.event('reauthenticate' if self._token else 'authenticate',
+          operation='authenticate', host=urlparse(self.auth_url).netloc)
+      #issuing a token has no side effect, so it is safe to retry
+      response = self.request('POST', self.auth_url, idempotent=True,
+        operation='authenticate', data=codec.dumps(post_data),
+        headers={'content-type':'application/json'})
+      if response.status_code == requests.codes.ok:
+        data_dict = codec.loads(response.content)
+        self._update_token(data_dict)
+        self._update_user(data_dict)
+        self._store_cached_token(data_dict)
+        self._schedule_refresh()
+      else:
+        response.raise_for_status()
+
+  def ensure_authenticated(self):
+    '''
+    Make sure this user holds an unexpired token, authenticating if it does
+    not. Concurrent callers wait on a single authentication instead of each
+    going to keystone.
+    '''
+    if self.is_authenticated():
+      return
+    with self._auth_lock:
+      #another thread may have authenticated while we waited on the lock
+      if not self.is_authenticated():
+        self.authenticate()
+
+  def close(self):
+    '''
+    release all pooled connections held on behalf of this user and stop
+    refreshing its token in the background
+    '''
+    self._cancel_refresh()
+    self.pool.close()
+
+  def _schedule_refresh(self, delay=None):
+    '''
+    arrange for the token to be renewed refresh_window seconds before expiry
+    '''
+    if self.refresh_window is None or not self.token:
+      return
+    if delay is None:
+      remaining = self.token.expires_in()
+      #tokens shorter lived than the window are renewed halfway through
+      delay = max(remaining - self.refresh_window, remaining / 2.0)
+    delay = max(delay, self.MIN_REFRESH_INTERVAL)
+    self._cancel_refresh()
+    logging.debug('refreshing token in %s seconds'%delay)
+    self._refresh_timer = threading.Timer(delay, self._refresh_in_background)
+    self._refresh_timer.daemon = True
+    self._refresh_timer.start()
+
+  def _cancel_refresh(self):
+    timer, self._refresh_timer = self._refresh_timer, None
+    if timer is not None:
+      timer.cancel()
+
+  def _refresh_in_background(self):
+    try:
+      self.authenticate()
+    except Exception as ex:
+      logging.debug('background token refresh failed: %s'%ex)
+      remaining = self.token.expires_in() if self.token else 0
+      if remaining > 0:
+        self._schedule_refresh(delay=remaining / 2.0)
+
+  def __getstate__(self):
+    #locks and timers do not survive pickling
+    state = self.__dict__.copy()
+    del state['_auth_lock']
+    state['_refresh_timer'] = None
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._auth_lock = threading.RLock()
+    if self.is_authenticated():
+      self._schedule_refresh()
+
+  def request(self, method, url, idempotent=None, operation=None, pool=None,
+              **kwargs):
+    '''
+    Issue an http request as this user over its connection pool, retrying
+    it as the retry policy allows. Raises a CircuitOpenError without
+    calling out while the API node of url is deemed unhealthy.
+
+    Args:
+      pool:
+        a ConnectionPool to send the request over instead of the one of
+        this user [Optional]
+      idempotent:
+        whether the request may safely be sent more than once, decided from
+        the http method if None [Optional]
+      operation:
+        name of the logical operation the request is made for, metrics are
+        grouped by it [Optional]
+    '''
+    policy = self.retry_policy
+    if idempotent is None:
+      idempotent = policy.is_idempotent(method)
+    breaker = policy.breaker_for(url)
+    attempt = 0
+    while True:
+      if breaker is not None and not breaker.allow():
+        if self.metrics is not None:
+          self.metrics.event('circuit_open', operation=operation,
+            host=urlparse(url).netloc)
+        raise CircuitOpenError('%s is failing, not calling it for now'%url)
+      if self.rate_limiter is not None:
+        waited = self.rate_limiter.acquire(method, url)
+        if waited and self.metrics is not None:
+          self.metrics.event('rate_limit_wait', operation=operation,
+            host=urlparse(url).netloc, value=waited)
+      response, error = None, None
+      try:
+        response = self._send(method, url, operation=operation, pool=pool,
+          **kwargs)
+      except requests.exceptions.RequestException as ex:
+        error = ex
+      failed = error is not None or response.status_code >= 500
+      if breaker is not None:
+        breaker.record(failed)
+      delay = policy.delay(attempt, idempotent, response=response, error=error)
+      if (self.rate_limiter is not None and response is not None and
+          response.status_code in policy.REJECTED_STATUSES):
+        #over the limit already, hold back the calls of every thread
+        self.rate_limiter.pause(method, url,
+          retry_after(response) or delay or 0)
+      if delay is None:
+        if error is not None:
+          raise error
+        return response
+      if response is not None:
+        response.close() #hand the connection back before waiting
+      attempt += 1
+      if self.metrics is not None:
+        self.metrics.event('retry', operation=operation,
+          host=urlparse(url).netloc)
+      logging.debug('retrying %s %s in %.2f seconds, attempt %s failed with %s'%(
+        method, url, delay, attempt, error or response.status_code))
+      time.sleep(delay)
+
+  def _send(self, method, url, operation=None, pool=None, **kwargs):
+    '''
+    one http call, letting the service catalog and metrics know how the
+    endpoint performed
+    '''
+    started = time.time()
+    try:
+      response = (pool or self.pool).request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+      elapsed = time.time() - started
+      self._record(url, elapsed, failed=True)
+      if self.metrics is not None:
+        self._measure(operation, method, url, 'error', elapsed,
+          kwargs.get('data'))
+      raise
+    elapsed = time.time() - started
+    self._record(url, elapsed, failed=response.status_code >= 500)
+    if self.metrics is not None:
+      self._measure(operation, method, url, response.status_code, elapsed,
+        kwargs.get('data'), response)
+    return response
+
+  def _measure(self, operation, method, url, status, elapsed, data=None,
+               response=None):
+    received = 0
+    if response is not None:
+      length = response.headers.get('content-length')
+      if length and length.isdigit():
+        received = int(length)
+      elif response._content_consumed:
+        #never read a streamed body here, its consumer is about to
+        received = len(response.content)
+    self.metrics.request(operation, urlparse(url).netloc, method, status,
+      elapsed, sent=len(data) if data else 0, received=received)
+
+  def _record(self, url, elapsed, failed=False):
+    if self._catalog is not None:
+      self._catalog.record(url, elapsed, failed=failed)
+
+  def endpoint_manager(self, service_name, **kwargs):
+    '''
+    convenience function for service catalog's get_endpoint_for func
+    '''
+    return self._catalog.get_endpoint_for(service_name, **kwargs)
+
+  def regions(self, service_name):
+    '''
+    convenience function for service catalog's regions func
+    '''
+    return self._catalog.regions(service_name)
+
+  def _authentication_body(self):
+    '''
+    construct the keystone token request for this user
+    '''
     if not self._can_authenticate():
       raise AttributeError('Either token or credentials must be available')
     post_data = {'auth': {}}
-    if self.token:
-      post_data['auth']['token'] = token
-    else:
+    if self.credentials.is_valid():
       post_data['auth']['passwordCredentials'] = self.credentials.python_dict
+    else:
+      post_data['auth']['token'] = {'id': str(self.token)}
 
     post_data['auth']['tenantName'] = self.tenant_name
     logging.debug('authenticate data: %s'%dumps(post_data))
-    response = requests.post(self.auth_url, 
-      data=dumps(post_data),
-      headers={'content-type':'application/json'})
-    if response.status_code == requests.codes.ok:
-      data_dict = response.json()
-      self._update_token(data_dict)
-      self._update_user(data_dict)
-    else:
-      response.raise_for_status()
-    
-  def endpoint_manager(self, service_name, **kwargs):
+    return post_data
+
+  def _load_cached_token(self):
     '''
-    convenience function for service catalog's get_endpoint_for func
+    restore token, user info and service catalog from the token cache
     '''
-    return self._catalog.get_endpoint_for(service_name, **kwargs)
+    if not self.credentials.username:
+      return
+    data_dict = self.token_cache.load(self.auth_url,
+      self.credentials.username, self.tenant_name)
+    if data_dict:
+      logging.debug('using cached token for %s'%self.credentials.username)
+      self._update_token(data_dict)
+      self._update_user(data_dict)
+
+  def _store_cached_token(self, data_dict):
+    if not self.token_cache or not self.credentials.username:
+      return
+    try:
+      self.token_cache.store(self.auth_url, self.credentials.username,
+        self.tenant_name, data_dict)
+    except (IOError, OSError) as ex:
+      #a cache we cannot write to should never fail authentication
+      logging.debug('could not cache token: %s'%ex)
 
   def _update_token(self, data_dict):
     token_info = data_dict['access']['token']
@@ -326,7 +822,8 @@ class User(object):
     self._name = user_info.get('name', None)
     self._username = user_info.get('username', None)
     self._roles = user_info.get('roles', None)
-    self._catalog = ServiceCatalog(**data_dict['access'])
+    self._catalog = ServiceCatalog(selector=self.endpoint_selector,
+      **data_dict['access'])
 
   def _can_authenticate(self):
     '''
@@ -334,14 +831,10 @@ class User(object):
     present:
       username, password / token, tenant_name
     '''
-    if not self.token:
-      logging.debug('no token available, checking if credentials valid')
-      if not self.credentials.is_valid():
-        logging.debug('credentials invalid')
+    if not self.credentials.is_valid():
+      logging.debug('credentials invalid, checking for an unexpired token')
+      if not self.is_authenticated():
         return False
-    else:
-      logging.debug('a token is available, checking if unexpired')
-      return self.is_authenticated()
 
     if not self.tenant_name:
       return False
@@ -361,7 +854,9 @@ class Api(object):
   '''
 
   def __init__(self, auth_url, username=None, password=None, token=None,
-    tenant_name=None, user=None):
+    tenant_name=None, user=None, pool=None, token_cache=None,
+    refresh_window=None, detail_cache=None, coalesce_reads=True,
+    metrics=None, rate_limiter=None):
     '''
     The base API object representing virtually all openstack service calls.
 
@@ -378,6 +873,31 @@ class Api(object):
         what tenant will I be running under
       user:
         a user object previously generated [Optional]
+      pool:
+        a ConnectionPool this object makes its http calls with, leaving the
+        user and other Api objects on their own pool. By default the pool of
+        the user is used and so shared by all Api objects of that user. The
+        pool is not closed by close(), it belongs to the caller [Optional]
+      token_cache:
+        a TokenCache to reuse tokens from across processes. only used when
+        no user object is given [Optional]
+      refresh_window:
+        seconds before expiry at which tokens are renewed in the background.
+        only used when no user object is given [Optional]
+      detail_cache:
+        a cache.ResponseCache for get_server_detail responses. Entries are
+        dropped when the server is created or deleted through this object
+        [Optional]
+      coalesce_reads:
+        if True, identical GETs (same url, parameters and token) issued
+        concurrently share a single http call. Each caller decodes its own
+        copy of the response [Optional]
+      metrics:
+        a metrics sink, see User. only used when no user object is given
+        [Optional]
+      rate_limiter:
+        a ratelimit.RateLimiter, see User. only used when no user object is
+        given [Optional]
 
       Note, either the username and password or token must be specified unless
       you have provided a user object
@@ -387,7 +907,16 @@ class Api(object):
       self.user = user
     else:
       self.user = User(auth_url, username=username, password=password,
-        token=token, tenant_name=tenant_name)
+        token=token, tenant_name=tenant_name, token_cache=token_cache,
+        refresh_window=refresh_window, metrics=metrics,
+        rate_limiter=rate_limiter)
+    #only a user created here is this object's to close
+    self._owns_user = not user
+    if pool:
+      assert isinstance(pool, ConnectionPool)
+    self.pool = pool
+    self.detail_cache = detail_cache
+    self.reads = SingleFlight() if coalesce_reads else None
     self.errors = []
 
   def verify_credentials(self):
@@ -401,7 +930,7 @@ class Api(object):
       return True
     else:
       try:
-        self.user.authenticate()
+        self.user.ensure_authenticated()
       except Exception as ex:
         exc = format_exc()
         self.errors.append(exc)
@@ -430,10 +959,141 @@ class Api(object):
     '''
     user = user or self.user
     self._assert_preconditions(user=user)
-    endpoint = self.user.endpoint_manager(compute_type)
+    endpoint = user.endpoint_manager(compute_type)
     url = endpoint.fetch_url(['servers'])
+    parameters = self._server_parameters(server,
+      user_data=self._read_user_data(user_data_file), key_name=key_name)
+
+    logging.debug('now creating server %s at url %s'%(parameters, url))
+    json_data = self._post_url(url, parameters, user=user,
+      operation='create_server')
+    logging.debug('returned data was %s'%json_data)
+    server.update_properties(**json_data['server'])
+    self.invalidate_server(server.id)
+
+  def create_servers(self, servers=None, template=None, count=None,
+                     min_count=None, max_count=None, user_data_file=None,
+                     user=None, compute_type='compute', key_name=None,
+                     workers=4):
+    '''
+    Create many servers at once.
 
-    #now, construct parameters
+    Args:
+      servers:
+        a list of server objects, recommended to create with the
+        create_server_for_deployment factory method in Server object. [Optional]
+      template:
+        a server object to create count copies of, copies are named
+        <name>-1 .. <name>-<count> [Optional]
+      count:
+        how many copies of template to create [Optional]
+      min_count:
+        minimum number of copies of template nova must be able to create,
+        done server side in a single request [Optional]
+      max_count:
+        maximum number of copies of template nova should create, done server
+        side in a single request [Optional]
+      user_data_file:
+        file path to a user data file, shared by all servers
+      user:
+        a user object that has been authenticated
+      compute_type:
+        type of compute, e.g compute or computev3
+      key_name:
+        name of ssh_key to be included in servers for initial login
+      workers:
+        maximum number of create requests in flight at once [Optional]
+
+    Returns a BatchReport where every server is either 'created', with value
+    set to the populated server object, or 'failed' with the error set.
+
+    Note that servers created server side (min_count / max_count) are listed
+    back by reservation id and so carry no admin password.
+    '''
+    user = user or self.user
+    self._assert_preconditions(user=user)
+    user_data = self._read_user_data(user_data_file)
+    endpoint = user.endpoint_manager(compute_type)
+    url = endpoint.fetch_url(['servers'])
+
+    if min_count or max_count:
+      assert template is not None, 'min_count/max_count require a template'
+      return self._create_reservation(url, template, user_data=user_data,
+        key_name=key_name, min_count=min_count or 1,
+        max_count=max_count or min_count, user=user, compute_type=compute_type)
+
+    if template is not None:
+      assert count, 'a template requires a count'
+      servers = [Server.create_server_for_deployment(template.image,
+                  template.flavor, '%s-%s'%(template.name, index + 1),
+                  metadata=dict(template.metadata or {}),
+                  availability_zone=template.availability_zone,
+                  security_group=template.security_group_name)
+                 for index in range(count)]
+    if not servers:
+      raise Exception('either servers or a template and count must be specified')
+
+    def create(index):
+      server = servers[index]
+      parameters = self._server_parameters(server, user_data=user_data,
+        key_name=key_name)
+      json_data = self._post_url(url, parameters, user=user,
+        operation='create_server')
+      server.update_properties(**json_data['server'])
+      self.invalidate_server(server.id)
+      return server
+
+    report = BatchReport()
+    for index, server, error in run_concurrently(create, range(len(servers)),
+                                                 workers):
+      if error is None:
+        report.add(index, 'created', value=server)
+      else:
+        logging.debug('failed creating server %s: %s'%(servers[index].name, error))
+        report.add(index, 'failed', value=servers[index], error=error)
+    report.results.sort(key=lambda result: result.key)
+    return report
+
+  def _create_reservation(self, url, template, user_data=None, key_name=None,
+                          min_count=1, max_count=1, user=None,
+                          compute_type='compute'):
+    '''
+    create copies of template with a single multiple create request, then
+    list the servers of the returned reservation
+    '''
+    parameters = self._server_parameters(template, user_data=user_data,
+      key_name=key_name)
+    parameters['server']['min_count'] = min_count
+    parameters['server']['max_count'] = max_count
+    parameters['server']['return_reservation_id'] = True
+    logging.debug('now creating servers %s at url %s'%(parameters, url))
+    json_data = self._post_url(url, parameters, user=user,
+      operation='create_servers')
+    reservation_id = json_data['reservation_id']
+
+    endpoint = user.endpoint_manager(compute_type)
+    listing = self._get_url(endpoint.fetch_url(['servers', 'detail']),
+      parameters={'reservation_id': reservation_id}, user=user,
+      operation='create_servers')
+    report = BatchReport()
+    for server_json in listing['servers']:
+      report.add(server_json['id'], 'created',
+        value=Server.create_server(**server_json))
+    return report
+
+  def _read_user_data(self, user_data_file):
+    '''
+    read and base64 encode a user data file
+    '''
+    if not user_data_file:
+      return None
+    with open(user_data_file, 'rb') as user_data:
+      return base64.b64encode(user_data.read()).decode('ascii')
+
+  def _server_parameters(self, server, user_data=None, key_name=None):
+    '''
+    construct the create request body of a server
+    '''
     parameters = {'server': {}}
     parameters['server']['flavorRef'] = server.flavor
     parameters['server']['imageRef'] = server.image
@@ -444,18 +1104,14 @@ class Api(object):
       parameters['server']['metadata'] = server.metadata
     if server.security_group_name:
       parameters['server']['security_group'] = server.security_group_name
-    if user_data_file:
-      parameters['server']['user_data'] = base64.b64encode(open(user_data_file).read())
+    if user_data:
+      parameters['server']['user_data'] = user_data
     if key_name:
       parameters['server']['key_name'] = key_name
+    return parameters
 
-    logging.debug('now creating server %s at url %s'%(parameters, url))
-    json_data = self._post_url(url, parameters)
-    logging.debug('returned data was %s'%json_data)
-    server.update_properties(**json_data['server'])
-  
   def get_server_detail(self, server=None, server_id=None, user=None,
-                        compute_type='compute'):
+                        compute_type='compute', lazy=False):
     '''
     Get details of a specific server. 
 
@@ -468,6 +1124,8 @@ class Api(object):
         a user object that has been authenticated
       compute_type:
         type of compute, e.g compute or computev3
+      lazy:
+        return a LazyServer, decoding fields only as they are read [Optional]
 
     Note that either the server or server_id must be specified.
     '''
@@ -481,13 +1139,24 @@ class Api(object):
     endpoint = user.endpoint_manager(compute_type)
     url = endpoint.fetch_url(['servers', server_id])
 
+    cache_key = (endpoint.url_for('public'), server_id)
+    if self.detail_cache is not None:
+      #cached as json so every hit decodes a payload of its own, servers
+      #hand out their nested metadata and addresses as is
+      cached = self.detail_cache.get(cache_key)
+      if cached is not None:
+        return Server.from_json(codec.loads(cached), lazy=lazy)
+
     logging.debug('now fetching details of a specific server with url %s'%(url))
-    json_data = self._get_url(url)
-    return Server.create_server(**json_data['server']) 
+    json_data = self._get_url(url, user=user, operation='get_server_detail')
+    if self.detail_cache is not None:
+      self.detail_cache.set(cache_key, codec.dumps(json_data['server']))
+    return Server.from_json(json_data['server'], lazy=lazy)
 
   def get_servers_detail(self, flavor=None, name=None, marker=None,
-                        limit=None, status=None, changes_since=None, host=None, 
-                        user=None, compute_type='compute'):
+                        limit=None, status=None, changes_since=None, host=None,
+                        user=None, compute_type='compute', lazy=False,
+                        shards=None, workers=4):
     '''
     Get details of all servers.
     
@@ -507,24 +1176,232 @@ class Api(object):
       host:
         host on which these servers are deployed on [Optional]
       changes_since:
-        a date or timestamp string when the server last changed status [Optional]
+        a datetime or ISO-8601 string, only servers changed since then
+        (deleted ones included) are returned [Optional]
       user:
         an authenticated user this request should be executed as
       compute_type:
         type of compute, e.g compute or computev3
+      lazy:
+        return LazyServers, decoding fields only as they are read. Cheaper
+        when only a few fields of each server are needed [Optional]
+      shards:
+        list every server by splitting the listing into partitions, each a
+        dict of filters (flavor, name, status or host) added to the ones
+        above, which are paginated in parallel and merged. True shards by
+        name prefix, see name_prefix_shards. Only servers matched by one
+        of the shards are returned, limit is their page size [Optional]
+      workers:
+        number of shards listed at once [Optional]
     '''
     user = user or self.user
+    if shards:
+      return self._sharded_servers_detail(shards, workers, flavor=flavor,
+        name=name, marker=marker, limit=limit, status=status,
+        changes_since=changes_since, host=host, user=user,
+        compute_type=compute_type, lazy=lazy)
     self._assert_preconditions(user=user)
     endpoint = user.endpoint_manager(compute_type)
     url = endpoint.fetch_url(['servers', 'detail'])
+    parameters = self._servers_detail_parameters(flavor=flavor, name=name,
+      marker=marker, limit=limit, status=status, changes_since=changes_since,
+      host=host)
+
+    logging.debug('now fetching details with url %s and options %s'%(url, parameters))
+    json_data = self._get_url(url, parameters=parameters, user=user,
+      operation='get_servers_detail')
+    servers = []
+    for server_json in json_data['servers']:
+      servers.append(Server.from_json(server_json, lazy=lazy))
+    return servers
+
+  def _sharded_servers_detail(self, shards, workers, marker=None, limit=None,
+                              user=None, **filters):
+    '''
+    list every server of the shards concurrently. A server found by
+    several shards (e.g its status changed during the scan) is kept once,
+    as last updated.
+    '''
+    if shards is True:
+      shards = name_prefix_shards()
+    if marker:
+      raise Exception('a sharded listing cannot start from a marker')
+    for shard in shards:
+      for key in shard:
+        if key not in SHARD_FILTERS:
+          raise ValueError('cannot shard on %s, expected one of %s'%(key,
+            ', '.join(SHARD_FILTERS)))
+        if filters.get(key):
+          raise ValueError('cannot both filter and shard on %s'%key)
+    #authenticate once up front rather than racing from every worker
+    self._assert_preconditions(user=user)
+
+    def scan(index):
+      arguments = dict(filters)
+      arguments.update(shards[index])
+      return list(self.iter_servers_detail(page_size=limit, user=user,
+        **arguments))
+
+    pages = [None] * len(shards)
+    for index, servers, error in run_concurrently(scan, range(len(shards)),
+                                                  workers):
+      if error is not None:
+        logging.debug('failed listing shard %s: %s'%(shards[index], error))
+        raise error
+      pages[index] = servers
+    merged, order = {}, []
+    for servers in pages:
+      for server in servers:
+        known = merged.get(server.id)
+        if known is None:
+          order.append(server.id)
+        elif (known.updated or '') >= (server.updated or ''):
+          continue
+        merged[server.id] = server
+    return [merged[server_id] for server_id in order]
+
+  def iter_servers_detail(self, flavor=None, name=None, marker=None,
+                          page_size=None, status=None, changes_since=None,
+                          host=None, prefetch=False, user=None,
+                          compute_type='compute', lazy=False, stream=False,
+                          endpoint=None):
+    '''
+    Iterate over details of all servers, following marker based pagination
+    so only one page (two when prefetching) is held in memory at a time.
 
-    #construct filtering parameters
+    Takes the same filtering args as get_servers_detail, and:
+
+    Args:
+      marker:
+        UUID of the server after which iteration starts [Optional]
+      page_size:
+        integer, number of servers requested per page. Defaults to the
+        maximum page size of the compute service [Optional]
+      prefetch:
+        if True, the next page is fetched in the background while the
+        servers of the current page are being consumed [Optional]
+      lazy:
+        yield LazyServers, decoding fields only as they are read [Optional]
+      stream:
+        if True, servers are decoded one at a time while their page is
+        being downloaded instead of once the whole page is in memory.
+        prefetch is ignored when streaming [Optional]
+      endpoint:
+        the compute Endpoint to list servers from, instead of one picked
+        from the service catalog [Optional]
+    '''
+    user = user or self.user
+    self._assert_preconditions(user=user)
+    endpoint = endpoint or user.endpoint_manager(compute_type)
+    url = endpoint.fetch_url(['servers', 'detail'])
+    parameters = self._servers_detail_parameters(flavor=flavor, name=name,
+      limit=page_size, status=status, changes_since=changes_since, host=host)
+
+    def fetch_page(page_marker):
+      self._assert_preconditions(user=user)
+      page_parameters = dict(parameters)
+      if page_marker:
+        page_parameters['marker'] = page_marker
+      logging.debug('now fetching page with url %s and options %s'%(url, page_parameters))
+      if stream:
+        return self._stream_url(url, 'servers', parameters=page_parameters,
+          user=user, operation='iter_servers_detail')
+      return self._get_url(url, parameters=page_parameters, user=user,
+        operation='iter_servers_detail')
+
+    while stream:
+      listing, last_id = fetch_page(marker), None
+      try:
+        for server_json in listing:
+          last_id = server_json['id']
+          yield Server.from_json(server_json, lazy=lazy)
+      finally:
+        listing.close()
+      if not self._has_next_page(listing.count,
+          listing.fields.get('servers_links'), page_size):
+        return
+      marker = last_id
+
+    json_data = fetch_page(marker)
+    while True:
+      page = json_data['servers']
+      next_marker, pending = None, None
+      if self._has_next_page(len(page), json_data.get('servers_links'),
+                             page_size):
+        next_marker = page[-1]['id']
+        if prefetch:
+          pending = BackgroundCall(fetch_page, next_marker)
+      json_data = None
+      for server_json in page:
+        yield Server.from_json(server_json, lazy=lazy)
+      if not next_marker:
+        return
+      json_data = pending.result() if pending else fetch_page(next_marker)
+
+  def iter_servers_detail_by_region(self, regions=None, workers=None,
+                                    user=None, compute_type='compute',
+                                    **kwargs):
+    '''
+    List the servers of every region at once: the compute endpoint of each
+    region is paginated in a thread of its own and servers are yielded as
+    they arrive, tagged with the endpoint they were listed from (see
+    Server.endpoint and Server.region).
+
+    Returns a FanOut to iterate over. A region failing does not stop the
+    others, once iteration is over its report holds a result per region:
+    'done' with the number of servers listed, or 'failed' with the error.
+
+    Takes the filtering and paging args of iter_servers_detail, and:
+
+    Args:
+      regions:
+        names of the regions to list, all regions of the service catalog
+        by default. None stands for the endpoints without a region [Optional]
+      workers:
+        number of regions listed at once, all of them by default [Optional]
+    '''
+    user = user or self.user
+    #authenticate once up front rather than racing from every region
+    self._assert_preconditions(user=user)
+    regions = regions or user.regions(compute_type)
+
+    def listing(region):
+      endpoint = user.endpoint_manager(compute_type,
+        region=NO_REGION if region is None else region)
+      for server in self.iter_servers_detail(user=user, endpoint=endpoint,
+          compute_type=compute_type, **kwargs):
+        server.endpoint = endpoint
+        yield server
+
+    return FanOut([(region, listing(region)) for region in regions],
+      workers=workers)
+
+  def _has_next_page(self, count, links, page_size):
+    '''
+    decide from a page of a servers listing, its number of servers and its
+    links, whether another page should be requested
+    '''
+    if not count:
+      return False
+    for link in links or []:
+      if link.get('rel') == 'next':
+        return True
+    return bool(page_size) and count >= page_size
+
+  def _servers_detail_parameters(self, flavor=None, name=None, marker=None,
+                                 limit=None, status=None, changes_since=None,
+                                 host=None):
+    '''
+    construct filtering parameters of a servers/detail listing
+    '''
     parameters = {}
     if flavor:
       parameters['flavor'] = flavor
     if name:
       parameters['name'] = name
-    if limit: #TODO: support for next batch of servers?
+    if marker:
+      parameters['marker'] = marker
+    if limit:
       try:
         assert type(limit) is int
       except AssertionError:
@@ -536,14 +1413,10 @@ class Api(object):
     if status:
       parameters['status'] = status
     if changes_since:
-      parameters['changes_since'] = str(dateparser.parse(changes_since))
-
-    logging.debug('now fetching details with url %s and options %s'%(url, parameters))
-    json_data = self._get_url(url, parameters=parameters)
-    servers = []
-    for server_json in json_data['servers']:
-      servers.append(Server.create_server(**server_json))
-    return servers
+      if not isinstance(changes_since, datetime):
+        changes_since = dateparser(changes_since)
+      parameters['changes-since'] = changes_since.isoformat()
+    return parameters
 
   def delete_server(self, server=None, server_id=None, user=None,
                     compute_type='compute'):
@@ -564,7 +1437,7 @@ class Api(object):
     '''
     user = user or self.user
     self._assert_preconditions(user=user)
-    if not server or type(server) != Server:
+    if not server or not isinstance(server, Server):
       if not server_id or server_id == '':
         raise Exception('you must specify a server object or a server_id for deletion')
     
@@ -573,9 +1446,11 @@ class Api(object):
     url = endpoint.fetch_url(['servers', server_id])
 
     logging.debug('now deleting server with id %s using url %s'%(server_id, url))
-    response = requests.delete(url,
-                            headers={'content-type':'application/json',
-                                      'X-Auth-Token':str(self.user.token)})
+    try:
+      response = self._request('DELETE', url, user=user,
+        operation='delete_server')
+    finally:
+      self.invalidate_server(server_id)
     if response.status_code == requests.codes.no_content:
       logging.debug('delete_url returned status code %s'%response.status_code)
     else:
@@ -583,8 +1458,8 @@ class Api(object):
       response.raise_for_status()
 
 
-  def delete_servers(self, servers=[], server_ids=[], user=None, 
-                    compute_type='compute'):
+  def delete_servers(self, servers=[], server_ids=[], user=None,
+                    compute_type='compute', workers=1):
     '''
     A convenience function that deletes an array of servers.
 
@@ -592,52 +1467,241 @@ class Api(object):
       servers:
         a collection of server objects. [Optional]
       server_ids:
-        an collection of server objects. [Optional]
+        an collection of server id strings. [Optional]
       user:
         a user that has been authenticated
       compute_type:
         type of compute, e.g compute or computev3
+      workers:
+        number of deletions to run concurrently [Optional]
+
+    Note that either servers or server_ids must be specified, a server present
+    in both is only deleted once.
+
+    Returns a BatchReport keyed by server id where every server is either
+    'deleted', 'gone' (it no longer existed) or 'failed' with the error set.
+    A failure does not stop the remaining deletions.
+    '''
+    user = user or self.user
+    report = BatchReport()
+    ids = []
+    for server in servers:
+      if not isinstance(server, Server) or not server.id or server.id == 'null':
+        report.add(server, 'failed',
+          error=Exception('server %s has no id to delete by'%server))
+      else:
+        ids.append(server.id)
+    ids.extend(server_ids)
+
+    unique_ids, seen = [], set()
+    for server_id in ids:
+      if server_id not in seen:
+        seen.add(server_id)
+        unique_ids.append(server_id)
+
+    #authenticate once up front rather than racing from every worker
+    self._assert_preconditions(user=user)
+    delete = lambda server_id: self.delete_server(server_id=server_id,
+      user=user, compute_type=compute_type)
+    for server_id, _, error in run_concurrently(delete, unique_ids, workers):
+      status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+      if error is None:
+        report.add(server_id, 'deleted')
+      elif status_code == requests.codes.not_found:
+        report.add(server_id, 'gone', error=error)
+      else:
+        logging.debug('failed deleting server %s: %s'%(server_id, error))
+        report.add(server_id, 'failed', error=error)
+    return report
+
+  def wait_for_status(self, servers, target='ACTIVE',
+                      failure_statuses=('ERROR',), timeout=600, interval=2,
+                      max_interval=30, backoff=1.5, user=None,
+                      compute_type='compute'):
+    '''
+    Wait for servers to reach a terminal status, polling with a single
+    servers/detail listing per cycle however many servers are waited on.
+    The first listing is a full one, later ones only ask for the servers
+    changed since (which includes deleted servers).
+
+    Yields the freshly listed details of each server as soon as it reaches
+    a target or failure status. A server deleted while being waited on is
+    yielded with its status set to DELETED.
 
-    Note that either servers or server_ids must be specified.
+    Args:
+      servers:
+        a collection of server objects or server id strings [Required]
+      target:
+        a status, or a list of statuses, to wait for [Optional]
+      failure_statuses:
+        statuses after which a server will not reach the target [Optional]
+      timeout:
+        seconds to wait in total, an Exception naming the servers still
+        pending is raised once exceeded [Optional]
+      interval:
+        seconds between polls while servers are changing [Optional]
+      max_interval:
+        longest pause between polls [Optional]
+      backoff:
+        factor the pause grows by after every poll where no server changed
+        [Optional]
+      user:
+        a user that has been authenticated [Optional]
+      compute_type:
+        type of compute, e.g compute or computev3 [Optional]
     '''
-    #really just a convenience function. does nothing on its own.
+    if not isinstance(target, (list, tuple, set, frozenset)):
+      target = [target]
+    terminal = set(target) | set(failure_statuses)
+    pending = {}
     for server in servers:
-      self.delete_server(server=server, server_id=None, user=user,
-        compute_type=compute_type)
+      if not isinstance(server, Server):
+        server = Server.create_server(id=server)
+      pending[server.id] = server
+    deadline = time.time() + timeout
+    delay = interval
+    watermark = None
+    while pending:
+      progressed, listed = False, set()
+      latest = None
+      for server in self.iter_servers_detail(changes_since=watermark,
+                                             user=user,
+                                             compute_type=compute_type):
+        if server.updated:
+          updated = utc(server.updated)
+          latest = updated if latest is None else max(latest, updated)
+        known = pending.get(server.id)
+        if known is None:
+          continue
+        listed.add(server.id)
+        if server.status != known.status:
+          progressed = True
+        if server.status in terminal or server.status == 'DELETED':
+          del pending[server.id]
+          yield server
+        else:
+          pending[server.id] = server
+      if watermark is None:
+        #a full listing, servers missing from it are gone already
+        for server_id in [i for i in pending if i not in listed]:
+          progressed = True
+          server = pending.pop(server_id)
+          server.status = 'DELETED'
+          yield server
+      if latest is not None:
+        #step back a second, changes made in the same second are not missed
+        latest = latest - timedelta(seconds=1)
+        watermark = max(latest, watermark or latest)
+      elif watermark is None:
+        watermark = datetime.utcnow() - timedelta(seconds=1)
+      if not pending:
+        return
+      remaining = deadline - time.time()
+      if remaining <= 0:
+        raise Exception('timed out after %s seconds waiting for servers %s'%(
+          timeout, ', '.join(sorted(pending))))
+      delay = interval if progressed else min(delay * backoff, max_interval)
+      logging.debug('%s servers pending, polling again in %s seconds'%(
+        len(pending), delay))
+      time.sleep(min(delay, remaining))
+
+  def invalidate_server(self, server_id):
+    '''
+    drop cached details of a server, for every endpoint it was fetched from
+    '''
+    if self.detail_cache is not None:
+      self.detail_cache.invalidate_where(lambda key: key[1] == server_id)
 
-    for server_id in server_ids:
-      self.delete_server(server=None, server_id=server_id, user=user,
-        compute_type=compute_type)
+  def close(self):
+    '''
+    release the connections and background refresh of the user this api
+    object created. A user (or pool) given to it is shared with others and
+    left to its owner to close
+    '''
+    if self._owns_user:
+      self.user.close()
 
-  def _get_url(self, url, parameters={}, success_codes=[requests.codes.ok]):
-    response = requests.get(url, params=parameters,
-                            headers={'content-type':'application/json',
-                                     'X-Auth-Token':str(self.user.token)})
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _request(self, method, url, user=None, **kwargs):
+    user = user or self.user
+    headers = {'content-type':'application/json',
+               'X-Auth-Token':str(user.token)}
+    return user.request(method, url, headers=headers, pool=self.pool, **kwargs)
+
+  def _get_url(self, url, parameters={}, success_codes=(200,),
+               user=None, operation=None):
+    if self.reads is None:
+      return self._decode(self._fetch_body(url, parameters, success_codes,
+        user, operation))
+    user = user or self.user
+    #lists of values are sent as repeated parameters
+    key = (url, tuple(sorted((name, tuple(value) if isinstance(value,
+      (list, tuple)) else value) for name, value in parameters.items())),
+      str(user.token))
+    try:
+      hash(key)
+    except TypeError:
+      return self._decode(self._fetch_body(url, parameters, success_codes,
+        user, operation))
+    #callers share the body, each decodes objects of its own from it
+    return self._decode(self.reads.do(key, self._fetch_body, url, parameters,
+      success_codes, user, operation))
+
+  def _decode(self, body):
+    return None if body is None else codec.loads(body)
+
+  def _fetch_body(self, url, parameters, success_codes, user, operation=None):
+    response = self._request('GET', url, user=user, params=parameters,
+      operation=operation)
     if response.status_code in success_codes:
       logging.debug('get_url returned status code %s'%response.status_code)
-      return response.json()
+      return response.content
     else:
       logging.debug('response failed with status code %s'%response.status_code)
       response.raise_for_status()
      
-  def _post_url(self, url, value):
-    response = requests.post(url, data=dumps(value),
-                              headers={'content-type': 'application/json',
-                                        'X-Auth-Token':str(self.user.token)})
+  def _post_url(self, url, value, user=None, operation=None):
+    response = self._request('POST', url, user=user,
+      data=codec.dumps(value), operation=operation)
     if response.status_code == requests.codes.accepted:
       logging.debug('post_url returned status code %s'%response.status_code)
-      return response.json()
+      return codec.loads(response.content)
     else:
       logging.debug('response failed with status code %s'%response.status_code)
       response.raise_for_status()
 
+  def _stream_url(self, url, key, parameters={}, user=None, operation=None,
+                  chunk_size=65536):
+    '''
+    GET a listing without buffering its body, returns a StreamedListing of
+    the elements of its `key` array. Not coalesced with other reads, since
+    the listing can only be iterated once.
+    '''
+    response = self._request('GET', url, user=user, params=parameters,
+      stream=True, operation=operation)
+    if response.status_code != requests.codes.ok:
+      logging.debug('response failed with status code %s'%response.status_code)
+      response.close()
+      response.raise_for_status()
+    def chunks():
+      try:
+        for chunk in response.iter_content(chunk_size):
+          yield chunk
+      finally:
+        response.close()
+    return codec.StreamedListing(chunks(), key)
+
   def _assert_preconditions(self, user=None):
     '''
     check authentication preconditions
     '''
     if user:
-      if not user.is_authenticated():
-        user.authenticate()
+      user.ensure_authenticated()
     else:
       raise Exception("you must provide a valid user")
 
@@ -0,0 +1,158 @@
+import time
+import threading
+try:
+  from urlparse import urlparse
+except ImportError:
+  from urllib.parse import urlparse
+
+clock = getattr(time, 'monotonic', time.time)
+
+#
+# Staying under the rate limits of the API nodes rather than running into
+# them and backing off
+#
+class TokenBucket(object):
+  '''
+  Lets calls through at `rate` per second on average, and up to `burst` at
+  once after a quiet period. A caller reserves its token and is told how
+  long to wait for it, so concurrent callers queue up one behind the other
+  instead of all being let through and then all backing off.
+  '''
+  def __init__(self, rate, burst=1):
+    if rate <= 0:
+      raise ValueError('rate must be a positive number of calls per second')
+    self.rate = float(rate)
+    self.burst = max(1, burst)
+    self.tokens = float(self.burst)
+    self.updated = clock()
+    self._lock = threading.Lock()
+
+  def _refill(self):
+    now = clock()
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def reserve(self):
+    '''
+    take a token, returns the seconds to wait before using it
+    '''
+    with self._lock:
+      self._refill()
+      self.tokens -= 1
+      return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+  def pause(self, seconds):
+    '''
+    let no call through for seconds, e.g once the server rejected one
+    '''
+    with self._lock:
+      self._refill()
+      self.tokens = min(self.tokens, -seconds * self.rate)
+
+class RateLimiter(object):
+  '''
+  Client side rate limits, token buckets consulted by User.request before
+  every call. Give one to a user to keep all the calls made as that user,
+  from any thread and any Api object sharing it, under the limits.
+
+  Limits are set per http method, per API node (host and port) or both,
+  the most specific one applying to a call:
+
+    limiter = RateLimiter(rate=10, burst=20)
+    limiter.limit('POST', rate=1, burst=5)
+    limiter.limit('DELETE', rate=2, burst=10)
+    limiter.limit('GET', host='nova.example.com:8774', rate=50, burst=50)
+
+  Every API node has buckets of its own. A limit without a method is one
+  budget for all the methods that have no limit of their own.
+  '''
+  def __init__(self, rate=None, burst=None):
+    '''
+    Args:
+      rate:
+        default calls per second to every API node, unlimited if None
+        [Optional]
+      burst:
+        calls let through at once by the default limit [Optional]
+    '''
+    self._limits = {}
+    self._buckets = {}
+    self._lock = threading.Lock()
+    if rate is not None:
+      self.limit(rate=rate, burst=burst)
+
+  def limit(self, method=None, host=None, rate=None, burst=None):
+    '''
+    Args:
+      method:
+        http method the limit applies to, e.g POST. all if None [Optional]
+      host:
+        host (and port, as in urls) of the API node the limit applies to.
+        all if None [Optional]
+      rate:
+        calls per second, None removes the limit [Optional]
+      burst:
+        calls let through at once after a quiet period, defaults to one
+        second worth of calls [Optional]
+    '''
+    key = (method.upper() if method else None, host)
+    with self._lock:
+      if rate is None:
+        self._limits.pop(key, None)
+      else:
+        self._limits[key] = (rate, burst or max(1, int(rate)))
+      #buckets are rebuilt from the limits in effect
+      self._buckets.clear()
+
+  def bucket_for(self, method, url):
+    '''
+    the bucket a call is taken from, None if it is not limited
+    '''
+    method, host = method.upper(), urlparse(url).netloc
+    with self._lock:
+      key = (method, host)
+      if key not in self._buckets:
+        self._buckets[key] = self._create_bucket(method, host)
+      return self._buckets[key]
+
+  def _create_bucket(self, method, host):
+    for rule in ((method, host), (None, host), (method, None), (None, None)):
+      if rule in self._limits:
+        #methods without a limit of their own share the bucket of the node
+        shared = (rule[0], host)
+        if shared != (method, host) and shared in self._buckets:
+          return self._buckets[shared]
+        bucket = TokenBucket(*self._limits[rule])
+        self._buckets[shared] = bucket
+        return bucket
+    return None
+
+  def acquire(self, method, url):
+    '''
+    wait until a call may be made, returns the seconds waited
+    '''
+    bucket = self.bucket_for(method, url)
+    if bucket is None:
+      return 0.0
+    wait = bucket.reserve()
+    if wait > 0:
+      time.sleep(wait)
+    return wait
+
+  def pause(self, method, url, seconds):
+    '''
+    hold calls back for seconds, e.g the Retry-After of a rejected call
+    '''
+    bucket = self.bucket_for(method, url)
+    if bucket is not None:
+      bucket.pause(seconds)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    state['_buckets'] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
@@ -0,0 +1,179 @@
+import time
+import random
+import threading
+from .lazy import LazyModule
+try:
+  from urlparse import urlparse
+except ImportError:
+  from urllib.parse import urlparse
+
+requests = LazyModule('requests')
+
+#
+# Retrying overloaded calls without making the overload worse
+#
+class CircuitOpenError(IOError):
+  '''
+  raised instead of calling an endpoint whose circuit breaker is open
+  '''
+
+class CircuitBreaker(object):
+  '''
+  Tracks consecutive failures (connection errors and 5xx responses) of one
+  API node. After `threshold` of them the circuit opens and calls fail fast
+  for reset_timeout seconds, then a single trial call is let through: the
+  circuit closes again if it succeeds and reopens if it fails.
+  '''
+  def __init__(self, threshold=5, reset_timeout=30):
+    self.threshold = threshold
+    self.reset_timeout = reset_timeout
+    self.failures = 0
+    self.opened_at = None
+    self._trial = False
+    self._lock = threading.Lock()
+
+  @property
+  def state(self):
+    if self.opened_at is None:
+      return 'closed'
+    if time.time() - self.opened_at >= self.reset_timeout:
+      return 'half-open'
+    return 'open'
+
+  def allow(self):
+    '''
+    whether a call may go through now
+    '''
+    with self._lock:
+      if self.opened_at is None:
+        return True
+      if time.time() - self.opened_at >= self.reset_timeout and not self._trial:
+        self._trial = True
+        return True
+      return False
+
+  def record(self, failed):
+    with self._lock:
+      if not failed:
+        self.failures = 0
+        self.opened_at = None
+      else:
+        self.failures += 1
+        if self._trial or self.failures >= self.threshold:
+          self.opened_at = time.time()
+          self.failures = 0
+      self._trial = False
+
+class RetryPolicy(object):
+  '''
+  Decides which failed calls are retried and how long to wait before doing
+  so: the Retry-After header when the server sent one, otherwise an
+  exponential backoff with full jitter so clients spread out.
+
+  Idempotent calls (GET, PUT, DELETE...) are retried on connection errors
+  and on 413, 429, 502, 503 and 504 responses. Non idempotent ones (POST)
+  are only retried when the server surely did not act on them: it rejected
+  them by rate limiting (413, 429) or the connection was never made.
+
+  The policy also holds a circuit breaker per API node (scheme, host and
+  port), share one policy between users to share their view of the nodes.
+  '''
+  IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+  RETRY_STATUSES = (413, 429, 502, 503, 504)
+  REJECTED_STATUSES = (413, 429)
+
+  def __init__(self, max_retries=3, backoff=0.5, max_backoff=30,
+               max_retry_after=60, breaker_threshold=5, breaker_reset=30):
+    '''
+    Args:
+      max_retries:
+        retries after the first attempt, 0 to never retry [Optional]
+      backoff:
+        seconds the backoff starts from, doubled on every retry [Optional]
+      max_backoff:
+        longest backoff in seconds [Optional]
+      max_retry_after:
+        a call whose Retry-After asks for a longer wait (in seconds) is not
+        retried, its response is returned as is [Optional]
+      breaker_threshold:
+        consecutive failures opening the circuit of an API node, None to
+        disable circuit breaking [Optional]
+      breaker_reset:
+        seconds an open circuit fails fast before a trial call [Optional]
+    '''
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.max_retry_after = max_retry_after
+    self.breaker_threshold = breaker_threshold
+    self.breaker_reset = breaker_reset
+    self._breakers = {}
+    self._lock = threading.Lock()
+
+  def is_idempotent(self, method):
+    return method.upper() in self.IDEMPOTENT_METHODS
+
+  def breaker_for(self, url):
+    '''
+    the circuit breaker of the API node serving url, None if disabled
+    '''
+    if self.breaker_threshold is None:
+      return None
+    parsed = urlparse(url)
+    key = (parsed.scheme, parsed.netloc)
+    with self._lock:
+      breaker = self._breakers.get(key)
+      if breaker is None:
+        breaker = self._breakers[key] = CircuitBreaker(
+          threshold=self.breaker_threshold, reset_timeout=self.breaker_reset)
+      return breaker
+
+  def delay(self, attempt, idempotent, response=None, error=None):
+    '''
+    seconds to wait before retrying a call that failed `attempt` times
+    already (counting from 0), or None if it should not be retried
+    '''
+    if attempt >= self.max_retries:
+      return None
+    if error is not None:
+      if isinstance(error, CircuitOpenError):
+        return None
+      if not idempotent and not isinstance(error,
+          requests.exceptions.ConnectTimeout):
+        return None
+    elif response is not None:
+      statuses = self.RETRY_STATUSES if idempotent else self.REJECTED_STATUSES
+      if response.status_code not in statuses:
+        return None
+      wait = retry_after(response)
+      if wait is not None:
+        return wait if wait <= self.max_retry_after else None
+    return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    state['_breakers'] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+def retry_after(response):
+  '''
+  the seconds to wait asked for by the Retry-After header of a response,
+  given either as a number of seconds or as an http date
+  '''
+  value = response.headers.get('Retry-After')
+  if not value:
+    return None
+  try:
+    return max(0.0, float(value))
+  except ValueError:
+    pass
+  from email.utils import parsedate_tz, mktime_tz
+  parsed = parsedate_tz(value)
+  if parsed is None:
+    return None
+  return max(0.0, mktime_tz(parsed) - time.time())
@@ -0,0 +1,106 @@
+import time
+import random
+import threading
+
+#
+# Strategies picking which of several equivalent endpoints a call goes to
+#
+class RandomSelector(object):
+  '''
+  Spreads calls uniformly over the endpoints, ignoring how they perform.
+  '''
+  def select(self, urls):
+    return random.choice(urls)
+
+  def record(self, url, elapsed, failed=False):
+    pass
+
+class _EndpointStats(object):
+  __slots__ = ('latency', 'failures', 'ejected_until')
+
+  def __init__(self):
+    self.latency = None
+    self.failures = 0
+    self.ejected_until = 0
+
+class LatencyAwareSelector(object):
+  '''
+  Prefers the endpoint with the lowest recent latency, tracked as an
+  exponentially weighted moving average (EWMA) per endpoint. Endpoints
+  failing several calls in a row are ejected for a while, then given
+  another chance.
+  '''
+  def __init__(self, alpha=0.3, failure_threshold=3, ejection_time=30,
+               explore=0.05):
+    '''
+    Args:
+      alpha:
+        weight of the newest latency sample in the moving average [Optional]
+      failure_threshold:
+        consecutive failures (connection errors or 5xx) after which an
+        endpoint is ejected [Optional]
+      ejection_time:
+        seconds an ejected endpoint receives no calls [Optional]
+      explore:
+        fraction of calls sent to a random healthy endpoint, so a slow
+        endpoint that recovered gets noticed [Optional]
+    '''
+    self.alpha = alpha
+    self.failure_threshold = failure_threshold
+    self.ejection_time = ejection_time
+    self.explore = explore
+    self._stats = {}
+    self._lock = threading.Lock()
+
+  def select(self, urls):
+    now = time.time()
+    with self._lock:
+      stats = [(url, self._stats.get(url) or _EndpointStats()) for url in urls]
+    healthy = [(url, stat) for url, stat in stats if stat.ejected_until <= now]
+    if not healthy:
+      #everything is ejected, try whichever comes back soonest
+      return min(stats, key=lambda pair: pair[1].ejected_until)[0]
+    unmeasured = [url for url, stat in healthy if stat.latency is None]
+    if unmeasured:
+      return random.choice(unmeasured)
+    if len(healthy) > 1 and random.random() < self.explore:
+      return random.choice(healthy)[0]
+    return min(healthy, key=lambda pair: pair[1].latency)[0]
+
+  def record(self, url, elapsed, failed=False):
+    with self._lock:
+      stat = self._stats.get(url)
+      if stat is None:
+        stat = self._stats[url] = _EndpointStats()
+      if failed:
+        stat.failures += 1
+        if stat.failures >= self.failure_threshold:
+          stat.ejected_until = time.time() + self.ejection_time
+          stat.failures = 0
+        return
+      stat.failures = 0
+      if stat.latency is None:
+        stat.latency = elapsed
+      else:
+        stat.latency += self.alpha * (elapsed - stat.latency)
+
+  def latency(self, url):
+    '''
+    the moving average latency of an endpoint in seconds, None if unknown
+    '''
+    stat = self._stats.get(url)
+    return stat.latency if stat else None
+
+  def is_ejected(self, url):
+    stat = self._stats.get(url)
+    return bool(stat) and stat.ejected_until > time.time()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state['_lock']
+    state['_stats'] = {}
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
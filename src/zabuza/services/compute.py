@@ -6,10 +6,54 @@ except ImportError:
 #
 # Provides the models required by the compute api
 #
+
+#api json keys each server field is read from, in order of preference
+FIELD_KEYS = {
+  '_admin_pass': ('admin_pass', 'adminPass'),
+  '_access_ipv4': ('access_ipv4', 'accessIPv4'),
+  '_access_ipv6': ('access_ipv6', 'accessIPv6'),
+  '_addresses': ('addresses',),
+  '_created': ('created',),
+  '_flavor': ('flavor',),
+  '_host_id': ('host_id', 'hostId'),
+  '_image': ('image',),
+  '_metadata': ('metadata',),
+  '_name': ('name',),
+  '_progress': ('progress',),
+  '_status': ('status',),
+  '_tenant_id': ('tenantId',),
+  '_updated': ('updated',),
+  '_user_id': ('user_id', 'userId'),
+  '_availability_zone': ('availability_zone', 'availabilityZone'),
+  '_security_group_name': ('security_group_name', 'securityGroupName'),
+}
+
+def decode_field(payload, slot):
+  '''
+  read a server field out of api json the way Server.create_server does:
+  the first non empty key wins and empty values are normalized
+  '''
+  for key in FIELD_KEYS[slot]:
+    value = payload.get(key)
+    if value:
+      return value
+  return {} if slot == '_metadata' else None
+
 class Server(object):
   '''
   An representation of an openstack server
+
+  Servers use __slots__ rather than a per instance __dict__, keeping large
+  inventories of them compact.
   '''
+  #public attributes of a server, in the order they are serialized
+  attributes = ('id', 'admin_pass', 'access_ipv4',
+    'access_ipv6', 'addresses', 'created', 'flavor', 'host_id',
+    'image', 'metadata', 'name', 'progress', 'status', 'tenant_id',
+    'updated', 'user_id', 'availability_zone', 'security_group_name')
+
+  __slots__ = tuple('_' + attribute for attribute in attributes) + ('_endpoint',)
+
   def __init__(self,
                 admin_pass=None,
                 access_ipv4=None,
@@ -70,11 +114,6 @@ class Server(object):
       security_group_name:
         security group currently applied to this server [Optional]
     '''
-    self.attributes = ['id', 'admin_pass', 'access_ipv4',
-    'access_ipv6', 'addresses', 'created', 'flavor', 'host_id',
-    'image', 'metadata', 'name', 'progress', 'status', 'tenant_id',
-    'updated', 'user_id', 'availability_zone', 'security_group_name']
-
     if not kwargs.get('id'):
       raise Exception("you must specify an id for a server at least")
     else:
@@ -97,29 +136,30 @@ class Server(object):
     self._user_id = user_id or None
     self._security_group_name = security_group_name or None
     self._availability_zone = availability_zone or None
+    self._endpoint = None
 
   @classmethod
   def create_server(self, *args, **kwargs):
     if not kwargs.get('id'):
       raise Exception('you must provide an id for a server')
-    return Server(id=kwargs['id'],
-            admin_pass=kwargs.get('admin_pass') or kwargs.get('adminPass'),
-            access_ipv4=kwargs.get('access_ipv4') or kwargs.get('accessIPv4'),
-            access_ipv6=kwargs.get('access_ipv6') or kwargs.get('accessIPv6'),
-            addresses=kwargs.get('addresses'),
-            created=kwargs.get('created'),
-            flavor=kwargs.get('flavor'),
-            host_id=kwargs.get('host_id') or kwargs.get('hostId'),
-            image=kwargs.get('image'),
-            metadata=kwargs.get('metadata'),
-            name=kwargs.get('name'),
-            progress=kwargs.get('progress'),
-            status=kwargs.get('status'),
-            tenant_id=kwargs.get('tenantId'),
-            updated=kwargs.get('updated'),
-            user_id=kwargs.get('user_id') or kwargs.get('userId'),
-            availability_zone=kwargs.get('availability_zone') or kwargs.get('availabilityZone'),
-            security_group_name=kwargs.get('security_group_name') or kwargs.get('securityGroupName'))
+    fields = dict((slot[1:], decode_field(kwargs, slot)) for slot in FIELD_KEYS)
+    return Server(id=kwargs['id'], **fields)
+
+  @classmethod
+  def from_json(self, payload, lazy=False):
+    '''
+    build a server from the json of a compute api response
+
+    Args:
+      payload:
+        a server dict as returned by the api [Required]
+      lazy:
+        if True, return a LazyServer which decodes each field only when it
+        is first read [Optional]
+    '''
+    if lazy:
+      return LazyServer(payload)
+    return Server.create_server(**payload)
 
   @classmethod
   def create_server_for_deployment(self, image, flavor, name, **kwargs):
@@ -154,7 +194,7 @@ class Server(object):
               metadata=kwargs.get('metadata'),
               availability_zone=kwargs.get('availability_zone'),
               user_data=kwargs.get('user_data'),
-              security_group=kwargs.get('security_group'))
+              security_group_name=kwargs.get('security_group'))
 
   def update_properties(self, **kwargs):
     self._id = kwargs.get('id') or self._id
@@ -319,6 +359,21 @@ class Server(object):
                                   set_security_group_name,
                                   doc='string representing the security group name')
 
+  def get_endpoint(self):
+    return self._endpoint
+
+  def set_endpoint(self, value):
+    self._endpoint = value
+
+  endpoint = property(get_endpoint, set_endpoint,
+                      doc='compute Endpoint this server was listed from, if known')
+
+  def get_region(self):
+    return self._endpoint.region if self._endpoint is not None else None
+
+  region = property(get_region,
+                    doc='region of the endpoint this server was listed from')
+
   def __eq__(self, other_server):
     '''
     define non-transient properties of a server for equality determination
@@ -335,6 +390,23 @@ class Server(object):
     #  return False
     return True
 
+  def __getstate__(self):
+    #slotted objects need explicit state to be pickled or copied
+    return dict((slot, getattr(self, slot)) for slot in Server.__slots__)
+
+  def __setstate__(self, state):
+    for slot, value in state.items():
+      setattr(self, slot, value)
+
+  def to_json(self):
+    '''
+    the fields of this server as api json, which from_json accepts back
+    '''
+    payload = {'id': self.id}
+    for slot, keys in FIELD_KEYS.items():
+      payload[keys[0]] = getattr(self, slot[1:])
+    return payload
+
   def __repr__(self):
     rep = dict()
     for attrb in self.attributes:
@@ -343,3 +415,27 @@ class Server(object):
 
   def __str__(self):
     return self.__repr__()
+
+class LazyServer(Server):
+  '''
+  A server wrapping the raw json returned by the api. A field is decoded
+  the first time it is read and kept from then on, which is cheaper than
+  create_server when only a few fields of many servers are looked at.
+  Values are the same as the ones of an eagerly created server.
+  '''
+  __slots__ = ('_raw',)
+
+  def __init__(self, payload):
+    if not payload.get('id'):
+      raise Exception('you must provide an id for a server')
+    self._raw = payload
+    self._id = payload['id']
+    self._endpoint = None
+
+  def __getattr__(self, slot):
+    #only reached for slots that have not been decoded (or set) yet
+    if slot not in FIELD_KEYS:
+      raise AttributeError(slot)
+    value = decode_field(self._raw, slot)
+    setattr(self, slot, value)
+    return value
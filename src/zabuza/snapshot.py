@@ -0,0 +1,406 @@
+'''
+Snapshots of server inventories, written incrementally as listing pages
+stream in and read back without decoding every server:
+
+  * JSONL, one server json per line, for interchange with other tools
+  * a binary file meant to be memory-mapped: the server json blobs one after
+    the other, then columns of dictionary codes for the fields servers are
+    usually filtered on, and an index of server ids sorted for binary search.
+    A server is only decoded when it is asked for, by id or by query.
+
+The binary layout, little endian, every section aligned on 8 bytes:
+
+  MAGIC | json blobs | sections... | directory json | u64 directory size | MAGIC
+
+the directory holding the count of servers and where each section starts.
+'''
+import os
+import sys
+import mmap
+import struct
+import tempfile
+from array import array
+from . import codec
+from .services.compute import Server, decode_field
+from .inventory import reference_id
+
+MAGIC = b'ZBZSNAP1'
+VERSION = 1
+#fields servers are encoded (and can be queried) by in the binary file
+INDEXED_FIELDS = ('status', 'flavor', 'image', 'host_id',
+                  'availability_zone', 'tenant_id', 'name')
+#code of a field a server has no value for
+MISSING = 0xFFFFFFFF
+
+class SnapshotWriter(object):
+  '''
+  Writes servers to a binary snapshot, and optionally to JSONL, one at a
+  time so a listing never has to be held in memory:
+
+    with SnapshotWriter('servers.snap', jsonl_path='servers.jsonl') as out:
+      out.write_all(api.iter_servers_detail(stream=True))
+
+  Files are written next to their destination and renamed into place once
+  complete, a snapshot is never seen half written. They are discarded if
+  the with block raises.
+  '''
+  def __init__(self, path, jsonl_path=None, fields=INDEXED_FIELDS):
+    '''
+    Args:
+      path:
+        where the binary snapshot is written, None to only write JSONL
+        [Required]
+      jsonl_path:
+        where the JSONL snapshot is written [Optional]
+      fields:
+        the fields servers are encoded by for queries [Optional]
+    '''
+    if path is None and jsonl_path is None:
+      raise ValueError('a snapshot needs a binary or a jsonl path')
+    self.path = path
+    self.jsonl_path = jsonl_path
+    self.fields = tuple(fields)
+    self.count = 0
+    self._files = []
+    self._binary = self._open(path) if path else None
+    self._jsonl = self._open(jsonl_path) if jsonl_path else None
+    self._position = 0
+    self._offsets = []
+    self._ids = []
+    self._codes = dict((field, array('I')) for field in self.fields)
+    self._dictionaries = dict((field, {}) for field in self.fields)
+    if self._binary is not None:
+      self._put(MAGIC)
+
+  def _open(self, path):
+    descriptor, temp_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(path)), prefix='.tmp-')
+    output = os.fdopen(descriptor, 'wb')
+    self._files.append((output, temp_path, path))
+    return output
+
+  def _put(self, data):
+    self._binary.write(data)
+    self._position += len(data)
+
+  def write(self, server):
+    '''
+    append a server, either a Server object or its api json
+    '''
+    payload = server if isinstance(server, dict) else server.to_json()
+    if not payload.get('id'):
+      raise Exception('you must provide an id for a server')
+    data = codec.dumps(payload).encode('utf-8')
+    if self._jsonl is not None:
+      self._jsonl.write(data + b'\n')
+    if self._binary is not None:
+      self._offsets.append(self._position)
+      self._put(data)
+      self._ids.append(('%s'%payload['id']).encode('utf-8'))
+      for field in self.fields:
+        self._codes[field].append(self._code(field, payload))
+    self.count += 1
+
+  def write_all(self, servers):
+    '''
+    append every server of an iterable, returns how many were written
+    '''
+    for server in servers:
+      self.write(server)
+    return self.count
+
+  def _code(self, field, payload):
+    value = decode_field(payload, '_' + field)
+    if field in ('flavor', 'image'):
+      value = reference_id(value)
+    if value is None:
+      return MISSING
+    value = '%s'%value
+    dictionary = self._dictionaries[field]
+    code = dictionary.get(value)
+    if code is None:
+      code = dictionary[value] = len(dictionary)
+    return code
+
+  def close(self):
+    '''
+    complete the snapshot files and move them into place
+    '''
+    if not self._files:
+      return
+    if self._binary is not None:
+      self._write_sections()
+    for output, temp_path, path in self._files:
+      output.flush()
+      os.fsync(output.fileno())
+      output.close()
+      os.rename(temp_path, path)
+    self._files = []
+
+  def abort(self):
+    '''
+    discard the snapshot files written so far
+    '''
+    for output, temp_path, _ in self._files:
+      output.close()
+      os.unlink(temp_path)
+    self._files = []
+
+  def _write_sections(self):
+    directory = {'version': VERSION, 'count': self.count,
+                 'fields': list(self.fields), 'columns': {},
+                 'dictionaries': {}}
+    self._offsets.append(self._position)
+    directory['offsets'] = self._section(_pack('Q', self._offsets))
+    directory['ids'] = self._strings(self._ids)
+    order = sorted(range(self.count), key=self._ids.__getitem__)
+    directory['order'] = self._section(_pack('I', order))
+    for field in self.fields:
+      directory['columns'][field] = self._section(_pack('I', self._codes[field]))
+      values = sorted(self._dictionaries[field].items(), key=lambda item: item[1])
+      directory['dictionaries'][field] = self._strings(
+        [value.encode('utf-8') for value, _ in values])
+    footer = codec.dumps(directory).encode('utf-8')
+    self._put(footer)
+    self._put(struct.pack('<Q', len(footer)) + MAGIC)
+
+  def _section(self, data):
+    '''
+    write an aligned section, returns where it starts
+    '''
+    self._put(b'\0' * (-self._position % 8))
+    start = self._position
+    self._put(data)
+    return start
+
+  def _strings(self, values):
+    '''
+    write a table of byte strings: their u32 end offsets, then their bytes
+    '''
+    ends, total = [], 0
+    for value in values:
+      total += len(value)
+      ends.append(total)
+    return {'count': len(values), 'ends': self._section(_pack('I', ends)),
+            'data': self._section(b''.join(values))}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is None:
+      self.close()
+    else:
+      self.abort()
+
+class Snapshot(object):
+  '''
+  A binary snapshot, memory-mapped: servers are looked up by id with a
+  binary search over the sorted id index and filtered on the code columns
+  of the indexed fields, only the servers returned get decoded.
+
+    with Snapshot('servers.snap') as snapshot:
+      server = snapshot.get(server_id)
+      for server in snapshot.query(status='ERROR', flavor=('2', '3')):
+        ...
+  '''
+  def __init__(self, path):
+    '''
+    Args:
+      path:
+        a file written by SnapshotWriter [Required]
+    '''
+    self.path = path
+    self._file = open(path, 'rb')
+    try:
+      self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+    except Exception:
+      self._file.close()
+      raise
+    size = len(self._map)
+    tail = len(MAGIC) + 8
+    if (size < len(MAGIC) + tail or self._map[:len(MAGIC)] != MAGIC or
+        self._map[size - len(MAGIC):] != MAGIC):
+      self.close()
+      raise ValueError('%s is not a complete zabuza snapshot'%path)
+    footer_size = struct.unpack_from('<Q', self._map, size - tail)[0]
+    footer = self._map[size - tail - footer_size:size - tail]
+    self.directory = codec.loads(footer.decode('utf-8'))
+    if self.directory['version'] != VERSION:
+      self.close()
+      raise ValueError('unsupported snapshot version %s'%
+        self.directory['version'])
+    self.fields = tuple(self.directory['fields'])
+    self._dictionaries = {}
+    self._lookups = {}
+
+  def __len__(self):
+    return self.directory['count']
+
+  def __iter__(self):
+    for row in range(len(self)):
+      yield self.server(row)
+
+  def __contains__(self, server_id):
+    return self.row(server_id) is not None
+
+  def ids(self):
+    '''
+    the server ids, in the order servers were written
+    '''
+    return [self._string(self.directory['ids'], row).decode('utf-8')
+            for row in range(len(self))]
+
+  def payload(self, row):
+    '''
+    the api json of the server written at row
+    '''
+    start, end = struct.unpack_from('<QQ', self._map,
+      self.directory['offsets'] + 8 * row)
+    return codec.loads(self._map[start:end])
+
+  def server(self, row, lazy=False):
+    return Server.from_json(self.payload(row), lazy=lazy)
+
+  def row(self, server_id):
+    '''
+    the row of a server, None if it is not in the snapshot
+    '''
+    key = ('%s'%server_id).encode('utf-8')
+    ids, order = self.directory['ids'], self.directory['order']
+    low, high = 0, len(self)
+    while low < high:
+      middle = (low + high) // 2
+      row = struct.unpack_from('<I', self._map, order + 4 * middle)[0]
+      if self._string(ids, row) < key:
+        low = middle + 1
+      else:
+        high = middle
+    if low < len(self):
+      row = struct.unpack_from('<I', self._map, order + 4 * low)[0]
+      if self._string(ids, row) == key:
+        return row
+    return None
+
+  def get(self, server_id, lazy=False):
+    '''
+    the server with this id, None if it is not in the snapshot
+
+    Args:
+      server_id:
+        id of the server [Required]
+      lazy:
+        if True, return a LazyServer [Optional]
+    '''
+    row = self.row(server_id)
+    return None if row is None else self.server(row, lazy=lazy)
+
+  def values(self, field):
+    '''
+    the distinct values of an indexed field, a value's code is its position
+    '''
+    if field not in self._dictionaries:
+      if field not in self.fields:
+        raise ValueError('%s is not indexed in this snapshot'%field)
+      table = self.directory['dictionaries'][field]
+      ends = _unpack('I', self._map[table['ends']:
+                                    table['ends'] + 4 * table['count']])
+      data = self._map[table['data']:table['data'] + (ends[-1] if ends else 0)]
+      self._dictionaries[field] = [data[start:end].decode('utf-8')
+        for start, end in zip([0] + ends[:-1].tolist(), ends)]
+    return self._dictionaries[field]
+
+  def column(self, field):
+    '''
+    the codes of an indexed field for every server, MISSING where unset
+    '''
+    self.values(field)
+    start = self.directory['columns'][field]
+    return _unpack('I', self._map[start:start + 4 * len(self)])
+
+  def counts(self, field):
+    '''
+    the number of servers having each value of an indexed field
+    '''
+    values = self.values(field)
+    totals = [0] * len(values)
+    for code in self.column(field):
+      if code != MISSING:
+        totals[code] += 1
+    return dict(zip(values, totals))
+
+  def rows(self, **criteria):
+    '''
+    the rows of the servers matching all criteria, each being an indexed
+    field and the value (or a list of values) it must have, e.g
+    status='ACTIVE' or flavor=['2', '3']. None matches servers without value.
+    '''
+    matched = None
+    for field, wanted in criteria.items():
+      if wanted is None or not isinstance(wanted, (list, tuple, set, frozenset)):
+        wanted = [wanted]
+      lookup = self._lookups.get(field)
+      if lookup is None:
+        lookup = self._lookups[field] = dict((value, code) for code, value
+                                             in enumerate(self.values(field)))
+      codes = set(MISSING if value is None else lookup.get('%s'%value)
+                  for value in wanted)
+      codes.discard(None)
+      column = self.column(field)
+      candidates = range(len(self)) if matched is None else matched
+      matched = [row for row in candidates if column[row] in codes]
+      if not matched:
+        break
+    return list(range(len(self))) if matched is None else matched
+
+  def query(self, lazy=False, **criteria):
+    '''
+    the servers matching all criteria (see rows), in the order they were
+    written
+    '''
+    for row in self.rows(**criteria):
+      yield self.server(row, lazy=lazy)
+
+  def close(self):
+    if self._map is not None:
+      self._map.close()
+      self._map = None
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _string(self, table, index):
+    ends = table['ends']
+    start = struct.unpack_from('<I', self._map, ends + 4 * (index - 1))[0] \
+      if index else 0
+    end = struct.unpack_from('<I', self._map, ends + 4 * index)[0]
+    return self._map[table['data'] + start:table['data'] + end]
+
+def read_jsonl(path, lazy=False):
+  '''
+  the servers of a JSONL snapshot, one at a time
+
+  Args:
+    path:
+      a file holding one server json per line [Required]
+    lazy:
+      if True, yield LazyServers [Optional]
+  '''
+  with open(path, 'rb') as lines:
+    for line in lines:
+      if line.strip():
+        yield Server.from_json(codec.loads(line), lazy=lazy)
+
+def _pack(code, values):
+  return struct.pack('<%d%s'%(len(values), code), *values)
+
+def _unpack(code, data):
+  unpacked = array(code)
+  getattr(unpacked, 'frombytes', getattr(unpacked, 'fromstring', None))(data)
+  if sys.byteorder != 'little':
+    unpacked.byteswap()
+  return unpacked
@@ -1,16 +1,120 @@
 import unittest
+import re
 import logging
-import urllib2
-from os import environ
+try:
+  import urllib2
+except ImportError:
+  import urllib.request as urllib2
+import time
+import pickle
+import requests
+import threading
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+from os import environ, listdir
 from copy import deepcopy
+from datetime import datetime, timedelta
 from traceback import format_exc
 from src.zabuza.openstack import User, Api, PasswordCredential, Token, Endpoint
-from src.zabuza.openstack import ServiceCatalog
-from src.zabuza.services.compute import Server
+from src.zabuza.openstack import ServiceCatalog, ConnectionPool, NO_REGION
+from src.zabuza.services.compute import Server, LazyServer
+from src.zabuza.cache import TokenCache, ResponseCache
+from src.zabuza.selection import LatencyAwareSelector
+from src.zabuza.retry import RetryPolicy, CircuitOpenError, retry_after
+from src.zabuza.metrics import InMemoryMetrics, PrometheusMetrics
+from src.zabuza.metrics import CallbackMetrics
+from src.zabuza import codec
+from src.zabuza.inventory import ServerInventory, ServerCollection
+from src.zabuza.daemon import ZabuzaDaemon, DaemonClient, DaemonError
+from src.zabuza.columns import numpy
+from src.zabuza.snapshot import SnapshotWriter, Snapshot, read_jsonl
+from src.zabuza.ratelimit import RateLimiter
+try:
+  import asyncio
+  from src.zabuza.aio import AsyncApi, AsyncUser, aiohttp
+except (ImportError, SyntaxError):
+  asyncio = aiohttp = None
 try:
   import json
 except ImportError:
   import simplejson as json
+try:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+  from urlparse import urlparse, parse_qs
+except ImportError:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+  from urllib.parse import urlparse, parse_qs
+
+class StandInHandler(BaseHTTPRequestHandler):
+  '''
+  replies to keystone and nova calls from the routes of its StandInServer
+  '''
+  protocol_version = 'HTTP/1.1'
+
+  def _reply(self):
+    length = int(self.headers.get('content-length') or 0)
+    body = self.rfile.read(length).decode('utf-8') if length else ''
+    parsed = urlparse(self.path)
+    self.server.calls.append({'method': self.command, 'path': parsed.path,
+      'query': parse_qs(parsed.query), 'body': body,
+      'client': self.client_address, 'headers': dict(self.headers)})
+    route = self.server.routes.get((self.command, parsed.path))
+    if callable(route):
+      route = route(self.server.calls[-1])
+    status, payload, headers = route or (404, {'itemNotFound': {}}, {})
+    data = json.dumps(payload) if payload is not None else ''
+    self.send_response(status)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data.encode('utf-8'))
+
+  do_GET = do_POST = do_DELETE = _reply
+
+  def log_message(self, *args):
+    pass
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+  '''
+  a local stand in for keystone and nova, routes map (method, path) to
+  (status, json payload, headers) or a callable returning that tuple
+  '''
+  daemon_threads = True
+
+  def __init__(self):
+    HTTPServer.__init__(self, ('127.0.0.1', 0), StandInHandler)
+    self.routes = {}
+    self.calls = []
+    self.url = 'http://127.0.0.1:%s'%self.server_address[1]
+    self.routes[('POST', '/v2.0/tokens')] = (200, self.access(), {})
+    self._thread = threading.Thread(target=self.serve_forever,
+      kwargs={'poll_interval': 0.01})
+    self._thread.daemon = True
+    self._thread.start()
+
+  def access(self, token_id='stand-in-token', expires='2999-01-01T00:00:00Z'):
+    return {'access': {
+      'token': {'id': token_id, 'expires': expires,
+                'issued_at': '2014-03-10T14:47:21.383780', 'tenant': {}},
+      'user': {'id': 'u1', 'name': 'foo', 'username': 'foo', 'roles': []},
+      'serviceCatalog': [{'type': 'compute', 'name': 'nova',
+        'endpoints': [{'id': 'e1', 'region': 'mars',
+          'publicURL': self.url + '/v2/t1'}]}]}}
+
+  def user(self, **kwargs):
+    return User(self.url + '/v2.0/tokens', username='foo', password='bar',
+      tenant_name='demo', **kwargs)
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
 
 class PasswordCredentialTest(unittest.TestCase):
   def setUp(self):
@@ -149,6 +253,66 @@ class ServiceCatalogTest(unittest.TestCase):
     self.assertTrue(isinstance(self.sc.get_endpoint_for(self.type), Endpoint))
     self.assertRaises(ValueError, self.sc.get_endpoint_for, 'nothing')
 
+  def multi_region_catalog(self, selector=None):
+    endpoints = [{'id': 'e%s'%i, 'region': region,
+                  'publicURL': 'http://nova-%s:8774/v2/t1'%i,
+                  'internalURL': 'http://internal-%s/v2/t1'%i}
+                 for i, region in enumerate(['mars', 'mars', 'venus'])]
+    return ServiceCatalog(selector=selector, service_catalog=[
+      {'endpoints': endpoints, 'type': 'compute', 'name': 'nova'}])
+
+  def test__region_and_interface_lookup(self):
+    sc = self.multi_region_catalog()
+    endpoint = sc.get_endpoint_for('compute', region='venus')
+    self.assertTrue(isinstance(endpoint, Endpoint))
+    self.assertEquals((endpoint.id, endpoint.region), ('e2', 'venus'))
+    self.assertEquals(endpoint.fetch_url(['servers'], interface='internal'),
+      'http://internal-2/v2/t1/servers')
+    self.assertEquals(len(sc.get_endpoints_for('compute', region='mars')), 2)
+    self.assertEquals(len(sc.get_endpoints_for('compute')), 3)
+    self.assertEquals(sc.regions('compute'), ['mars', 'venus'])
+    self.assertRaises(ValueError, sc.get_endpoint_for, 'compute', region='pluto')
+    self.assertRaises(ValueError, sc.get_endpoint_for, 'compute',
+      interface='admin')
+
+  def test__endpoints_without_a_region(self):
+    sc = ServiceCatalog(service_catalog=[{'type': 'compute', 'name': 'nova',
+      'endpoints': [{'id': 'e0', 'region': 'mars', 'publicURL': 'http://a/v2'},
+                    {'id': 'e1', 'publicURL': 'http://b/v2'}]}])
+    self.assertEquals(sc.regions('compute'), [None, 'mars'])
+    for _ in range(10):
+      self.assertEquals(sc.get_endpoint_for('compute', region=NO_REGION).id,
+                        'e1')
+    self.assertEquals(len(sc.get_endpoints_for('compute')), 2)
+    sc = pickle.loads(pickle.dumps(sc))
+    self.assertEquals(sc.get_endpoint_for('compute', region=NO_REGION).id, 'e1')
+
+  def test__services_sharing_urls(self):
+    endpoints = [{'id': 'e%s'%i, 'region': 'mars',
+                  'publicURL': 'http://nova-%s:8774/v2/t1'%i}
+                 for i in range(2)]
+    sc = ServiceCatalog(service_catalog=[
+      {'endpoints': deepcopy(endpoints), 'type': 'compute', 'name': 'nova'},
+      {'endpoints': deepcopy(endpoints), 'type': 'computev21',
+       'name': 'novav21'}])
+    for _ in range(10):
+      self.assertEquals(sc.get_endpoint_for('compute').type, 'compute')
+      self.assertEquals(sc.get_endpoint_for('computev21').name, 'novav21')
+
+  def test__latency_aware_selection(self):
+    selector = LatencyAwareSelector(explore=0, failure_threshold=2,
+      ejection_time=60)
+    sc = self.multi_region_catalog(selector=selector)
+    sc.record('http://nova-0:8774/v2/t1/servers/detail', 0.5)
+    sc.record('http://nova-1:8774/v2/t1/servers/abc', 0.1)
+    for _ in range(5):
+      self.assertEquals(sc.get_endpoint_for('compute', region='mars').id, 'e1')
+    sc.record('http://nova-1:8774/v2/t1/servers', 3.0, failed=True)
+    sc.record('http://nova-1:8774/v2/t1/servers', 3.0, failed=True)
+    self.assertTrue(selector.is_ejected('http://nova-1:8774/v2/t1'))
+    self.assertEquals(sc.get_endpoint_for('compute', region='mars').id, 'e0')
+    self.assertAlmostEquals(selector.latency('http://nova-1:8774/v2/t1'), 0.1)
+
 class ServerTest(unittest.TestCase):
 
   def setUp(self):
@@ -173,6 +337,1195 @@ class ServerTest(unittest.TestCase):
     server = Server.create_server_for_deployment('foo', 'bar', 'vaz')
     self.assertTrue(isinstance(server, Server))
 
+  def test__lazy_server_matches_eager_server(self):
+    data = json.loads(open('data/server.json').read())['server']
+    data['progress'] = 0
+    eager = Server.from_json(data)
+    lazy = Server.from_json(data, lazy=True)
+    self.assertTrue(isinstance(lazy, LazyServer))
+    self.assertEquals(lazy.status, eager.status)
+    #nothing but the fields read so far has been decoded
+    self.assertRaises(AttributeError, Server._host_id.__get__, lazy, LazyServer)
+    for attribute in Server.attributes:
+      self.assertEquals(getattr(lazy, attribute), getattr(eager, attribute))
+    lazy.status = 'DELETED'
+    self.assertEquals(lazy.status, 'DELETED')
+    self.assertEquals(lazy, eager)
+    restored = pickle.loads(pickle.dumps(lazy, 2))
+    self.assertEquals(restored.status, 'DELETED')
+    self.assertRaises(Exception, Server.from_json, {'name': 'no id'}, lazy=True)
+
+  def test__compact_representation(self):
+    data = json.loads(open('data/server.json').read())
+    server = Server.create_server(**data['server'])
+    self.assertFalse(hasattr(server, '__dict__'))
+    self.assertEquals(json.loads(repr(server))['host_id'], server.host_id)
+    for copied in [pickle.loads(pickle.dumps(server)),
+                   pickle.loads(pickle.dumps(server, 2)), deepcopy(server)]:
+      for attribute in Server.attributes:
+        self.assertEquals(getattr(copied, attribute), getattr(server, attribute))
+
+class ConnectionPoolTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'status': 'ACTIVE'}}, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (204, None, {})
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def test__connections_are_reused(self):
+    selector = LatencyAwareSelector()
+    api = Api(None, user=self.stand_in.user(endpoint_selector=selector))
+    for _ in range(5):
+      self.assertEquals(api.get_server_detail(server_id='abc').status, 'ACTIVE')
+    api.delete_server(server_id='abc')
+    clients = set(call['client'] for call in self.stand_in.calls)
+    self.assertEquals(len(self.stand_in.calls), 7)
+    self.assertEquals(len(clients), 1)
+    self.assertTrue(selector.latency(self.stand_in.url + '/v2/t1') > 0)
+    api.close()
+
+  def test__pool_is_shared_and_closable(self):
+    pool = ConnectionPool(pool_maxsize=2,
+      host_limits={self.stand_in.url: 4})
+    user = self.stand_in.user(pool=pool)
+    api, other_api = Api(None, user=user), Api(None, user=user)
+    self.assertTrue(api.user.pool is other_api.user.pool)
+    api.get_server_detail(server_id='abc')
+    session = pool.session
+    self.assertEquals(session.get_adapter(self.stand_in.url + '/v2')._pool_maxsize, 4)
+    #the user is shared, closing one api leaves the pool to the others
+    api.close()
+    self.assertTrue(pool.session is session)
+    user.close()
+    self.assertTrue(pool._session is None)
+    other_api.get_server_detail(server_id='abc')
+    self.assertTrue(pool.session is not session)
+    other_api.close()
+
+  def test__api_pool_is_its_own(self):
+    user = self.stand_in.user()
+    own_pool = ConnectionPool()
+    api, other_api = Api(None, user=user, pool=own_pool), Api(None, user=user)
+    api.get_server_detail(server_id='abc')
+    self.assertTrue(user.pool is not own_pool)
+    self.assertTrue(own_pool._session is not None)
+    self.assertTrue(user.pool._session is not None) #authenticated over it
+    other_api.get_server_detail(server_id='abc')
+    api.close()
+    self.assertTrue(own_pool._session is not None)
+    created = Api(self.stand_in.url + '/v2.0/tokens', username='foo',
+      password='bar', tenant_name='demo')
+    created.verify_credentials()
+    created.close()
+    self.assertTrue(created.user.pool._session is None)
+    own_pool.close()
+    user.close()
+
+class ServerPaginationTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    ids = ['s%02d'%i for i in range(7)]
+    def servers_detail(call):
+      limit = int(call['query'].get('limit', ['1000'])[0])
+      marker = call['query'].get('marker', [None])[0]
+      start = ids.index(marker) + 1 if marker else 0
+      page = ids[start:start + limit]
+      links = []
+      if start + limit < len(ids):
+        links.append({'rel': 'next', 'href': 'ignored'})
+      return (200, {'servers': [{'id': i, 'status': 'ACTIVE'} for i in page],
+                    'servers_links': links}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = servers_detail
+    self.api = Api(None, user=self.stand_in.user())
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def test__iter_servers_detail_follows_markers(self):
+    servers = list(self.api.iter_servers_detail(page_size=3))
+    self.assertEquals([s.id for s in servers], ['s%02d'%i for i in range(7)])
+    pages = [c for c in self.stand_in.calls if c['method'] == 'GET']
+    self.assertEquals(len(pages), 3)
+    self.assertEquals(pages[-1]['query']['marker'], ['s05'])
+
+  def test__streamed_listing(self):
+    servers = self.api.iter_servers_detail(page_size=3, stream=True,
+      status='ACTIVE')
+    self.assertEquals([s.id for s in servers], ['s%02d'%i for i in range(7)])
+    pages = [c for c in self.stand_in.calls if c['method'] == 'GET']
+    self.assertEquals([p['query'].get('marker') for p in pages],
+                      [None, ['s02'], ['s05']])
+    servers = self.api.iter_servers_detail(page_size=3, stream=True)
+    self.assertEquals(next(servers).id, 's00')
+    servers.close()
+
+  def test__lazy_listing(self):
+    servers = list(self.api.iter_servers_detail(page_size=5, lazy=True))
+    self.assertTrue(all(isinstance(s, LazyServer) for s in servers))
+    self.assertEquals(servers[0].status, 'ACTIVE')
+    page = self.api.get_servers_detail(lazy=True)
+    self.assertEquals([s.id for s in page], [s.id for s in servers])
+
+  def test__iter_servers_detail_prefetch_and_marker(self):
+    servers = self.api.iter_servers_detail(page_size=2, marker='s01',
+      status='ACTIVE', prefetch=True)
+    self.assertEquals([s.id for s in servers], ['s02', 's03', 's04', 's05', 's06'])
+    for call in self.stand_in.calls[1:]:
+      self.assertEquals(call['query']['status'], ['ACTIVE'])
+
+class RegionFanOutTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    access = self.stand_in.access()
+    access['access']['serviceCatalog'][0]['endpoints'] = [
+      {'id': 'e%s'%i, 'region': region,
+       'publicURL': '%s/v2/%s'%(self.stand_in.url, region)}
+      for i, region in enumerate(['mars', 'venus', 'pluto'])]
+    self.stand_in.routes[('POST', '/v2.0/tokens')] = (200, access, {})
+    def servers_detail(region, count):
+      def handle(call):
+        marker = call['query'].get('marker', [None])[0]
+        start = int(marker.split('-')[1]) + 1 if marker else 0
+        page = range(start, min(start + 2, count))
+        return (200, {'servers': [{'id': '%s-%s'%(region, i)} for i in page]}, {})
+      return handle
+    self.stand_in.routes[('GET', '/v2/mars/servers/detail')] = \
+      servers_detail('mars', 5)
+    self.stand_in.routes[('GET', '/v2/venus/servers/detail')] = \
+      servers_detail('venus', 2)
+    self.stand_in.routes[('GET', '/v2/pluto/servers/detail')] = (500, {}, {})
+    self.api = Api(None, user=self.stand_in.user(
+      retry_policy=RetryPolicy(max_retries=0)))
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def test__every_region_is_listed_and_tagged(self):
+    listing = self.api.iter_servers_detail_by_region(page_size=2, stream=True)
+    servers = list(listing)
+    self.assertEquals(sorted(s.id for s in servers),
+      ['mars-%s'%i for i in range(5)] + ['venus-0', 'venus-1'])
+    for server in servers:
+      self.assertEquals(server.region, server.id.split('-')[0])
+      self.assertEquals(server.endpoint.id, 'e0' if server.region == 'mars'
+                        else 'e1')
+    self.assertEquals(dict((r.key, r.value) for r in listing.report.by_status(
+      'done')), {'mars': 5, 'venus': 2})
+    self.assertEquals([r.key for r in listing.report.failures], ['pluto'])
+    self.assertEquals(len([c for c in self.stand_in.calls
+                           if c['path'] == '/v2.0/tokens']), 1)
+
+  def test__endpoints_without_a_region(self):
+    access = self.stand_in.access()
+    access['access']['serviceCatalog'][0]['endpoints'] = [
+      {'id': 'e0', 'region': 'mars',
+       'publicURL': '%s/v2/mars'%self.stand_in.url},
+      {'id': 'e1', 'publicURL': '%s/v2/venus'%self.stand_in.url}]
+    self.stand_in.routes[('POST', '/v2.0/tokens')] = (200, access, {})
+    listing = self.api.iter_servers_detail_by_region(page_size=2)
+    servers = list(listing)
+    self.assertEquals(dict((s.id, s.region) for s in servers),
+      dict([('venus-0', None), ('venus-1', None)] +
+           [('mars-%s'%i, 'mars') for i in range(5)]))
+    self.assertEquals(dict((r.key, r.value) for r in listing.report.by_status(
+      'done')), {None: 2, 'mars': 5})
+
+  def test__selected_regions(self):
+    listing = self.api.iter_servers_detail_by_region(regions=['venus', 'io'],
+      page_size=2)
+    self.assertEquals([s.id for s in listing], ['venus-0', 'venus-1'])
+    self.assertEquals([r.key for r in listing.report.failures], ['io'])
+    self.assertEquals(Server.create_server(id='a').region, None)
+
+class ShardedScanTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    names = ['web-1', 'web-2', 'db-1', 'Cache', '9lives', '_tmp', 'api']
+    self.servers = [{'id': 's%s'%i, 'name': name,
+                     'status': 'ERROR' if i % 3 == 0 else 'ACTIVE'}
+                    for i, name in enumerate(names)]
+    def servers_detail(call):
+      query = dict((key, values[0]) for key, values in call['query'].items())
+      if query.get('host') == 'down':
+        return (500, {}, {})
+      matched = [server for server in self.servers
+                 if re.match(query.get('name', ''), server['name'])
+                 and query.get('status', server['status']) == server['status']]
+      start = 0
+      if 'marker' in query:
+        start = [s['id'] for s in matched].index(query['marker']) + 1
+      limit = int(query.get('limit', 1000))
+      page = [dict(server) for server in matched[start:start + limit]]
+      if query.get('name') == '^[dw]':
+        #listed again after an update
+        for server in page:
+          server['updated'] = '2014-03-10T10:00:00Z'
+      return (200, {'servers': page}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = servers_detail
+    self.api = Api(None, user=self.stand_in.user(
+      retry_policy=RetryPolicy(max_retries=0)))
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def test__name_prefix_shards_list_every_server(self):
+    servers = self.api.get_servers_detail(shards=True, limit=1, workers=8)
+    self.assertEquals(sorted(s.id for s in servers),
+                      sorted(s['id'] for s in self.servers))
+    names = set(c['query']['name'][0] for c in self.stand_in.calls
+                if c['method'] == 'GET')
+    self.assertEquals(len(names), 37)
+    self.assertTrue('^a' in names)
+
+  def test__overlapping_shards_are_merged(self):
+    shards = [{'name': '^d', 'status': 'ACTIVE'}, {'name': '^w'},
+              {'name': '^[dw]'}]
+    servers = self.api.get_servers_detail(shards=shards, status=None)
+    self.assertEquals([s.id for s in servers], ['s2', 's0', 's1'])
+    self.assertEquals([s.updated for s in servers],
+                      ['2014-03-10T10:00:00Z'] * 3)
+    servers = self.api.get_servers_detail(shards=[{'name': '^w'}],
+      status='ERROR')
+    self.assertEquals([s.id for s in servers], ['s0'])
+
+  def test__invalid_or_failing_shards(self):
+    self.assertRaises(ValueError, self.api.get_servers_detail,
+      shards=[{'name': '^w'}], name='web')
+    self.assertRaises(ValueError, self.api.get_servers_detail,
+      shards=[{'image': 'i1'}])
+    self.assertRaises(Exception, self.api.get_servers_detail,
+      shards=[{'host': 'up'}, {'host': 'down'}])
+
+class BulkDeleteTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    for server_id in ['a', 'b', 'c']:
+      self.stand_in.routes[('DELETE', '/v2/t1/servers/%s'%server_id)] = \
+        (204, None, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/broken')] = (500, {}, {})
+    self.api = Api(None, user=self.stand_in.user())
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def test__delete_servers_reports_every_server(self):
+    servers = [Server(id='a'), Server(id='b')]
+    report = self.api.delete_servers(servers=servers,
+      server_ids=['b', 'c', 'gone', 'broken'], workers=4)
+    statuses = dict((result.key, result.status) for result in report)
+    self.assertEquals(statuses, {'a': 'deleted', 'b': 'deleted',
+      'c': 'deleted', 'gone': 'gone', 'broken': 'failed'})
+    self.assertFalse(report.ok)
+    self.assertEquals([r.key for r in report.failures], ['broken'])
+    deletes = [c for c in self.stand_in.calls if c['method'] == 'DELETE']
+    self.assertEquals(len(deletes), 5)
+
+  def test__delete_servers_sequentially(self):
+    report = self.api.delete_servers(server_ids=['a', 'b'])
+    self.assertTrue(report.ok)
+    self.assertEquals([r.key for r in report.by_status('deleted')], ['a', 'b'])
+
+class RetryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.replies = []
+    def reply(call):
+      return self.replies.pop(0)
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = reply
+    self.stand_in.routes[('POST', '/v2/t1/servers')] = reply
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (500, {}, {})
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def calls(self, method):
+    return len([c for c in self.stand_in.calls if c['method'] == method])
+
+  def test__idempotent_calls_are_retried(self):
+    api = Api(None, user=self.stand_in.user(
+      retry_policy=RetryPolicy(backoff=0.01)))
+    self.replies = [(503, {}, {'Retry-After': '0'}), (429, {}, {}),
+                    (200, {'server': {'id': 'abc'}}, {})]
+    self.assertEquals(api.get_server_detail(server_id='abc').id, 'abc')
+    self.assertEquals(self.calls('GET'), 3)
+    api.close()
+
+  def test__non_idempotent_calls_are_retried_only_if_rejected(self):
+    api = Api(None, user=self.stand_in.user(
+      retry_policy=RetryPolicy(backoff=0.01)))
+    server = Server.create_server_for_deployment('img', 1, 'node')
+    self.replies = [(429, {}, {'Retry-After': '0'}),
+                    (202, {'server': {'id': 'abc'}}, {})]
+    api.create_server(server)
+    self.assertEquals(server.id, 'abc')
+    self.replies = [(503, {}, {})]
+    self.assertRaises(Exception, api.create_server, server)
+    self.assertEquals(self.calls('POST') - 1, 3) #one authentication
+    api.close()
+
+  def test__circuit_breaker_fails_fast(self):
+    policy = RetryPolicy(max_retries=0, breaker_threshold=2,
+      breaker_reset=0.2)
+    api = Api(None, user=self.stand_in.user(retry_policy=policy))
+    api.verify_credentials()
+    for _ in range(2):
+      self.assertRaises(Exception, api.delete_server, server_id='abc')
+    self.assertRaises(CircuitOpenError, api.delete_server, server_id='abc')
+    self.assertEquals(self.calls('DELETE'), 2)
+    self.assertEquals(policy.breaker_for(self.stand_in.url).state, 'open')
+    time.sleep(0.25)
+    self.assertRaises(Exception, api.delete_server, server_id='abc')
+    self.assertEquals(self.calls('DELETE'), 3)
+    self.assertEquals(policy.breaker_for(self.stand_in.url).state, 'open')
+    api.close()
+
+  def test__retry_after(self):
+    class Reply(object):
+      def __init__(self, value):
+        self.headers = {'Retry-After': value}
+    self.assertEquals(retry_after(Reply('7')), 7.0)
+    self.assertEquals(retry_after(Reply('Wed, 21 Oct 2015 07:28:00 GMT')), 0.0)
+    self.assertEquals(retry_after(Reply('')), None)
+    policy = RetryPolicy(backoff=1, max_backoff=4)
+    self.assertTrue(0 <= policy.delay(0, True, error=
+      requests.exceptions.ConnectionError()) <= 1)
+    self.assertEquals(policy.delay(1, False, error=
+      requests.exceptions.ConnectionError()), None)
+    self.assertEquals(policy.delay(3, True, error=
+      requests.exceptions.ConnectionError()), None)
+
+class MetricsTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.replies = [(429, {}, {'Retry-After': '0'}),
+                    (200, {'server': {'id': 'abc'}}, {})]
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = \
+      lambda call: self.replies.pop(0)
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def test__requests_and_events_are_recorded(self):
+    metrics = InMemoryMetrics(buckets=(0.5, 5))
+    api = Api(None, user=self.stand_in.user(metrics=metrics))
+    api.get_server_detail(server_id='abc')
+    api.close()
+    snapshot = metrics.snapshot()
+    host = self.stand_in.url.split('//')[1]
+    series = dict((s['operation'], s) for s in snapshot['requests'])
+    self.assertEquals(sorted(series), ['authenticate', 'get_server_detail'])
+    detail = series['get_server_detail']
+    self.assertEquals((detail['host'], detail['method']), (host, 'GET'))
+    self.assertEquals(detail['statuses'], {429: 1, 200: 1})
+    self.assertEquals(detail['count'], 2)
+    self.assertEquals([bound for bound, _ in detail['buckets']],
+                      [0.5, 5, '+Inf'])
+    self.assertEquals(detail['buckets'][-1][1], 2)
+    self.assertTrue(detail['received'] > 0)
+    self.assertTrue(series['authenticate']['sent'] > 0)
+    events = dict((e['name'], e['count']) for e in snapshot['events'])
+    self.assertEquals(events, {'authenticate': 1, 'retry': 1})
+
+  def test__prometheus_and_callback_sinks(self):
+    metrics = PrometheusMetrics()
+    metrics.request('get_server_detail', 'nova:8774', 'GET', 200, 0.2,
+      received=10)
+    metrics.event('retry', operation='get_server_detail', host='nova:8774')
+    text = metrics.render()
+    labels = 'host="nova:8774",method="GET",operation="get_server_detail"'
+    self.assertTrue('zabuza_request_duration_seconds_bucket{%s,le="0.25"} 1'%
+      labels in text)
+    self.assertTrue('zabuza_request_duration_seconds_bucket{%s,le="0.1"} 0'%
+      labels in text)
+    self.assertTrue('zabuza_responses_total{%s,status="200"} 1'%labels in text)
+    self.assertTrue('zabuza_bytes_received_total{%s} 10'%labels in text)
+    self.assertTrue('zabuza_events_total{event="retry",host="nova:8774",'
+      'operation="get_server_detail"} 1' in text)
+
+    seen = []
+    metrics = CallbackMetrics(lambda kind, fields: seen.append((kind, fields)))
+    user = self.stand_in.user(metrics=metrics)
+    user.authenticate()
+    user.close()
+    self.assertEquals([kind for kind, _ in seen], ['event', 'request'])
+    self.assertEquals(seen[1][1]['status'], 200)
+
+class RateLimitTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc'}}, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (429, {},
+      {'Retry-After': '30'})
+    self.url = self.stand_in.url + '/v2/t1/servers/abc'
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def test__most_specific_limit_applies(self):
+    limiter = RateLimiter(rate=100, burst=2)
+    limiter.limit('post', rate=1)
+    limiter.limit(host='other:8774', rate=5, burst=1)
+    get = limiter.bucket_for('GET', self.url)
+    self.assertTrue(get is limiter.bucket_for('PUT', self.url))
+    self.assertEquals([get.reserve() for _ in range(2)], [0.0, 0.0])
+    self.assertTrue(0 < get.reserve() <= 0.01)
+    post = limiter.bucket_for('POST', self.url)
+    self.assertEquals(post.reserve(), 0.0)
+    self.assertTrue(0.9 < post.reserve() <= 1)
+    self.assertEquals(limiter.bucket_for('POST', 'http://other:8774/').rate, 5)
+    limiter.limit(rate=None)
+    self.assertEquals(limiter.bucket_for('GET', self.url), None)
+    self.assertEquals(limiter.acquire('GET', self.url), 0.0)
+    limiter = pickle.loads(pickle.dumps(limiter))
+    self.assertEquals(limiter.bucket_for('POST', self.url).reserve(), 0.0)
+
+  def test__shared_by_threads_and_apis_of_a_user(self):
+    metrics = InMemoryMetrics()
+    user = self.stand_in.user(metrics=metrics,
+      rate_limiter=RateLimiter(rate=20, burst=1))
+    apis = [Api(None, user=user, coalesce_reads=False) for _ in range(2)]
+    started = time.time()
+    threads = [threading.Thread(target=apis[i % 2].get_server_detail,
+      kwargs={'server_id': 'abc'}) for i in range(5)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    #the authentication and five reads, one every 50ms
+    self.assertTrue(time.time() - started >= 0.24)
+    waits = [e for e in metrics.snapshot()['events']
+             if e['name'] == 'rate_limit_wait']
+    self.assertEquals(sum(e['count'] for e in waits), 5)
+    self.assertTrue(sum(e['sum'] for e in waits) >= 0.24)
+    user.close()
+
+  def test__rejected_calls_hold_back_the_next_ones(self):
+    limiter = RateLimiter(rate=100)
+    user = self.stand_in.user(rate_limiter=limiter,
+      retry_policy=RetryPolicy(max_retries=0))
+    user.authenticate()
+    self.assertEquals(user.request('DELETE', self.url).status_code, 429)
+    self.assertTrue(29 < limiter.bucket_for('GET', self.url).reserve() <= 31)
+    user.close()
+
+class BulkCreateTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.created = []
+    def create(call):
+      body = json.loads(call['body'])['server']
+      self.created.append(body)
+      if body['name'].endswith('-2'):
+        return (500, {}, {})
+      if 'max_count' in body:
+        return (202, {'reservation_id': 'r-1'}, {})
+      return (202, {'server': {'id': 'id-' + body['name'],
+                               'adminPass': 'secret'}}, {})
+    self.stand_in.routes[('POST', '/v2/t1/servers')] = create
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = (200,
+      {'servers': [{'id': 'x1'}, {'id': 'x2'}]}, {})
+    self.api = Api(None, user=self.stand_in.user())
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def test__create_servers_from_list(self):
+    servers = [Server.create_server_for_deployment('img', 1, 'node-%s'%i)
+               for i in range(1, 5)]
+    report = self.api.create_servers(servers=servers,
+      user_data_file='data/userdata.sh', workers=3)
+    self.assertEquals([r.status for r in report],
+      ['created', 'failed', 'created', 'created'])
+    self.assertEquals(report.results[0].value.id, 'id-node-1')
+    self.assertEquals(report.results[0].value.admin_pass, 'secret')
+    self.assertEquals(len(report.failures), 1)
+    self.assertEquals(len(set(body['user_data'] for body in self.created)), 1)
+
+  def test__create_servers_from_template(self):
+    template = Server.create_server_for_deployment('img', 1, 'web',
+      metadata={'role': 'web'})
+    report = self.api.create_servers(template=template, count=3)
+    self.assertEquals(sorted(body['name'] for body in self.created),
+      ['web-1', 'web-2', 'web-3'])
+    self.assertEquals(len(report.succeeded), 2)
+    self.assertEquals(self.created[0]['metadata'], {'role': 'web'})
+    servers = [result.value for result in report]
+    servers[0].metadata['owner'] = 'ops'
+    self.assertEquals([s.metadata for s in servers[1:]], [{'role': 'web'}] * 2)
+    self.assertEquals(template.metadata, {'role': 'web'})
+
+  def test__create_servers_server_side(self):
+    template = Server.create_server_for_deployment('img', 1, 'db')
+    report = self.api.create_servers(template=template, min_count=2,
+      max_count=5)
+    self.assertEquals(self.created[0]['min_count'], 2)
+    self.assertEquals(self.created[0]['max_count'], 5)
+    self.assertEquals([r.value.id for r in report], ['x1', 'x2'])
+    listing = self.stand_in.calls[-1]
+    self.assertEquals(listing['query']['reservation_id'], ['r-1'])
+
+class TokenCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.directory = tempfile.mkdtemp()
+    self.cache = TokenCache(self.directory, min_ttl=60)
+
+  def tearDown(self):
+    self.stand_in.stop()
+    shutil.rmtree(self.directory)
+
+  def authentications(self):
+    return len([c for c in self.stand_in.calls if c['path'] == '/v2.0/tokens'])
+
+  def test__cached_user_skips_keystone(self):
+    user = self.stand_in.user(token_cache=self.cache)
+    self.assertFalse(user.is_authenticated())
+    user.authenticate()
+    cached_user = self.stand_in.user(token_cache=self.cache)
+    self.assertTrue(cached_user.is_authenticated())
+    self.assertEquals(str(cached_user.token), 'stand-in-token')
+    self.assertEquals(cached_user.endpoint_manager('compute').id, 'e1')
+    self.assertEquals(self.authentications(), 1)
+    self.assertEquals(len([f for f in listdir(self.directory)
+                           if f.startswith('.tmp')]), 0)
+
+  def test__expiring_entries_are_rejected(self):
+    soon = (datetime.utcnow() + timedelta(seconds=30)).isoformat()
+    self.stand_in.routes[('POST', '/v2.0/tokens')] = (200,
+      self.stand_in.access(expires=soon), {})
+    self.stand_in.user(token_cache=self.cache).authenticate()
+    self.assertFalse(self.stand_in.user(token_cache=self.cache).is_authenticated())
+    self.assertTrue(self.cache.load(self.stand_in.url + '/v2.0/tokens',
+      'foo', 'demo') is None)
+    self.assertTrue(TokenCache(self.directory, min_ttl=0).load(
+      self.stand_in.url + '/v2.0/tokens', 'foo', 'demo') is not None)
+
+  def test__entries_are_keyed_by_tenant_and_survive_corruption(self):
+    self.stand_in.user(token_cache=self.cache).authenticate()
+    other = User(self.stand_in.url + '/v2.0/tokens', username='foo',
+      password='bar', tenant_name='other', token_cache=self.cache)
+    self.assertFalse(other.is_authenticated())
+    for name in listdir(self.directory):
+      if name.endswith('.json'):
+        open('%s/%s'%(self.directory, name), 'w').write('{garbage')
+    self.assertFalse(self.stand_in.user(token_cache=self.cache).is_authenticated())
+
+class TokenRefreshTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.issued = []
+    def issue(call):
+      time.sleep(0.05) #long enough for concurrent callers to pile up
+      self.issued.append(json.loads(call['body']))
+      expires = datetime.utcnow() + timedelta(seconds=self.lifetime)
+      return (200, self.stand_in.access(token_id='t%s'%len(self.issued),
+        expires=expires.isoformat()), {})
+    self.stand_in.routes[('POST', '/v2.0/tokens')] = issue
+    self.lifetime = 3600
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def test__concurrent_callers_share_one_authentication(self):
+    user = self.stand_in.user()
+    threads = [threading.Thread(target=user.ensure_authenticated)
+               for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals(len(self.issued), 1)
+    self.assertEquals(str(user.token), 't1')
+
+  def test__token_is_refreshed_in_the_background(self):
+    self.lifetime = 0.6
+    user = self.stand_in.user(refresh_window=0.5)
+    user.MIN_REFRESH_INTERVAL = 0.05
+    user.authenticate()
+    deadline = time.time() + 5
+    while str(user.token) == 't1' and time.time() < deadline:
+      time.sleep(0.02)
+    user.close()
+    self.assertTrue(str(user.token) != 't1')
+    self.assertTrue(len(self.issued) >= 2)
+    self.assertTrue('passwordCredentials' in self.issued[-1]['auth'])
+
+  def test__refreshing_user_can_be_pickled(self):
+    user = self.stand_in.user(refresh_window=60)
+    user.authenticate()
+    restored = pickle.loads(pickle.dumps(user))
+    self.assertEquals(str(restored.token), 't1')
+    user.close()
+    restored.close()
+
+@unittest.skipIf(aiohttp is None, 'requires python 3.5+ and aiohttp')
+class AsyncApiTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'status': 'ACTIVE'}}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = (200,
+      {'servers': [{'id': 'abc'}, {'id': 'def'}]}, {})
+    self.stand_in.routes[('POST', '/v2/t1/servers')] = (202,
+      {'server': {'id': 'new', 'adminPass': 'secret'}}, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (204, None, {})
+    self.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(self.loop)
+    self.run = self.loop.run_until_complete
+    self.api = AsyncApi(None, user=AsyncUser(self.stand_in.url + '/v2.0/tokens',
+      username='foo', password='bar', tenant_name='demo'))
+
+  def tearDown(self):
+    self.run(self.api.close())
+    self.loop.close()
+    asyncio.set_event_loop(None)
+    self.stand_in.stop()
+
+  def test__concurrent_calls_share_authentication_and_models(self):
+    self.assertTrue(self.run(self.api.verify_credentials()))
+    servers = self.run(asyncio.gather(*[
+      self.api.get_server_detail(server_id='abc') for _ in range(20)]))
+    self.assertEquals(set(server.status for server in servers), set(['ACTIVE']))
+    self.assertTrue(isinstance(servers[0], Server))
+    authentications = [c for c in self.stand_in.calls
+                       if c['path'] == '/v2.0/tokens']
+    self.assertEquals(len(authentications), 1)
+    listing = self.run(self.api.get_servers_detail(limit=2))
+    self.assertEquals([server.id for server in listing], ['abc', 'def'])
+
+  def test__create_and_delete_servers(self):
+    server = Server.create_server_for_deployment('img', 1, 'node')
+    self.run(self.api.create_server(server))
+    self.assertEquals((server.id, server.admin_pass), ('new', 'secret'))
+    report = self.run(self.api.delete_servers(servers=[Server(id='abc')],
+      server_ids=['abc', 'missing'], workers=2))
+    statuses = dict((result.key, result.status) for result in report)
+    self.assertEquals(statuses, {'abc': 'deleted', 'missing': 'gone'})
+
+class ServerInventoryTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.fleet = {
+      'a': {'id': 'a', 'status': 'ACTIVE', 'updated': '2014-03-10T10:00:00Z'},
+      'b': {'id': 'b', 'status': 'BUILD', 'updated': '2014-03-10T11:00:00Z'},
+    }
+    self.changes = []
+    def servers_detail(call):
+      if 'changes-since' in call['query']:
+        return (200, {'servers': self.changes}, {})
+      return (200, {'servers': list(self.fleet.values())}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = servers_detail
+    self.api = Api(None, user=self.stand_in.user())
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def listings(self):
+    return [c['query'] for c in self.stand_in.calls
+            if c['path'] == '/v2/t1/servers/detail']
+
+  def test__refresh_fetches_only_changes(self):
+    inventory = ServerInventory(self.api, overlap=0)
+    changes = inventory.refresh()
+    self.assertEquals(sorted(changes['added']), ['a', 'b'])
+    self.assertEquals(inventory.watermark, datetime(2014, 3, 10, 11, 0, 0))
+    self.changes = [
+      {'id': 'b', 'status': 'ACTIVE', 'updated': '2014-03-10T12:00:00Z'},
+      {'id': 'a', 'status': 'DELETED', 'updated': '2014-03-10T12:30:00Z'},
+      {'id': 'c', 'status': 'BUILD', 'updated': '2014-03-10T12:45:00Z'},
+      {'id': 'z', 'status': 'DELETED', 'updated': '2014-03-10T12:45:00Z'}]
+    changes = inventory.refresh()
+    self.assertEquals(changes, {'added': ['c'], 'changed': ['b'],
+                                'removed': ['a']})
+    self.assertEquals(sorted(inventory.servers), ['b', 'c'])
+    self.assertEquals(inventory.get('b').status, 'ACTIVE')
+    self.assertEquals([s.id for s in inventory.query(status='BUILD')], ['c'])
+    self.assertFalse('a' in inventory)
+    self.assertEquals(self.listings()[-1]['changes-since'],
+      ['2014-03-10T11:00:00'])
+    self.assertEquals(inventory.watermark, datetime(2014, 3, 10, 12, 45, 0))
+
+  def test__changes_since_accepts_strings_and_datetimes(self):
+    self.api.get_servers_detail(changes_since='2014-03-10T11:00:00Z')
+    self.api.get_servers_detail(changes_since=datetime(2014, 3, 10, 11))
+    self.assertEquals(self.listings()[0]['changes-since'],
+      ['2014-03-10T11:00:00+00:00'])
+    self.assertEquals(self.listings()[1]['changes-since'],
+      ['2014-03-10T11:00:00'])
+
+class WaitForStatusTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.polls = [
+      [{'id': 'a', 'status': 'BUILD', 'updated': '2014-03-10T10:00:00Z'},
+       {'id': 'b', 'status': 'BUILD', 'updated': '2014-03-10T10:00:00Z'},
+       {'id': 'd', 'status': 'BUILD', 'updated': '2014-03-10T10:00:00Z'},
+       {'id': 'x', 'status': 'ACTIVE', 'updated': '2014-03-10T09:00:00Z'}],
+      [],
+      [{'id': 'a', 'status': 'ACTIVE', 'updated': '2014-03-10T10:05:00Z'}],
+      [{'id': 'b', 'status': 'ERROR', 'updated': '2014-03-10T10:06:00Z'},
+       {'id': 'd', 'status': 'DELETED', 'updated': '2014-03-10T10:06:00Z'}],
+    ]
+    def servers_detail(call):
+      return (200, {'servers': self.polls.pop(0) if self.polls else []}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = servers_detail
+    self.api = Api(None, user=self.stand_in.user())
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def listings(self):
+    return [c['query'] for c in self.stand_in.calls
+            if c['path'] == '/v2/t1/servers/detail']
+
+  def test__one_listing_per_cycle(self):
+    servers = [Server.create_server(id='a', status='BUILD'), 'b', 'c', 'd']
+    waited = [(server.id, server.status) for server in
+      self.api.wait_for_status(servers, interval=0.01)]
+    self.assertEquals(waited, [('c', 'DELETED'), ('a', 'ACTIVE'),
+                               ('b', 'ERROR'), ('d', 'DELETED')])
+    listings = self.listings()
+    self.assertEquals(len(listings), 4)
+    self.assertFalse('changes-since' in listings[0])
+    self.assertEquals(listings[1]['changes-since'], ['2014-03-10T09:59:59'])
+    self.assertEquals(listings[3]['changes-since'], ['2014-03-10T10:04:59'])
+
+  def test__backs_off_and_times_out(self):
+    delays = []
+    sleep, time.sleep = time.sleep, delays.append
+    try:
+      waiting = self.api.wait_for_status(['a'], timeout=60, interval=1,
+        backoff=2, max_interval=5)
+      self.assertEquals(next(waiting).id, 'a')
+    finally:
+      time.sleep = sleep
+    self.assertEquals(delays, [1, 2])
+
+    self.polls = [[{'id': 'a', 'status': 'BUILD'}]]
+    waiting = self.api.wait_for_status(['a'], timeout=0.05, interval=0.01)
+    self.assertRaises(Exception, list, waiting)
+
+class CodecTest(unittest.TestCase):
+
+  def tearDown(self):
+    codec.use()
+
+  def test__streamed_listing_across_chunk_boundaries(self):
+    document = {'servers': [
+        {'id': 'a"]}\\', 'nested': [1, {'x': None}], 'flag': True,
+         'name': u'caf\u00e9 [', 'value': -1.5e3},
+        {'id': 'b'}, {}],
+      'servers_links': [{'rel': 'next', 'href': 'x'}], 'total': 3}
+    body = json.dumps(document, indent=1).encode('utf-8')
+    for size in (1, 2, 7, len(body)):
+      listing = codec.StreamedListing(
+        [body[i:i + size] for i in range(0, len(body), size)], 'servers')
+      self.assertEquals(list(listing), document['servers'])
+      self.assertEquals(listing.count, 3)
+      self.assertEquals(listing.fields, {'total': 3,
+        'servers_links': document['servers_links']})
+    listing = codec.StreamedListing([b'{"servers": [{"id": "a"}, {"id"'],
+      'servers')
+    self.assertRaises(ValueError, list, listing)
+
+  def test__backends(self):
+    self.assertEquals(codec.use('json'), 'json')
+    self.assertEquals(codec.backend(), 'json')
+    self.assertEquals(codec.loads(b'{"a": [1]}'), {'a': [1]})
+    self.assertRaises(ValueError, codec.use, 'nope')
+    codec.register('traced', lambda data: ('traced', json.loads(data)),
+      json.dumps)
+    codec.use('traced')
+    self.assertEquals(codec.loads(b'1'), ('traced', 1))
+
+@unittest.skipIf(numpy is None, 'requires numpy')
+class ColumnsTest(unittest.TestCase):
+
+  def setUp(self):
+    def server(server_id, status, flavor, zone, created, updated=None):
+      return Server.create_server(id=server_id, status=status,
+        flavor={'id': flavor, 'links': []}, image='img',
+        availability_zone=zone, created=created, updated=updated)
+    self.collection = ServerCollection([
+      server('a', 'ACTIVE', '1', 'az1', '2014-03-10T10:00:00Z'),
+      server('b', 'ERROR', '2', 'az1', '2014-03-10T11:30:00.5Z',
+             '2014-03-11T00:00:00Z'),
+      server('c', 'ACTIVE', '2', None, '2014-03-10T14:00:00+02:00'),
+      server('d', 'BUILD', '1', 'az2', None),
+    ])
+
+  def test__columns(self):
+    columns = self.collection.to_columns()
+    order = numpy.argsort(columns['id'])
+    self.assertEquals(columns['id'][order].tolist(), ['a', 'b', 'c', 'd'])
+    self.assertEquals(columns['status'].categories, ['ACTIVE', 'BUILD', 'ERROR'])
+    self.assertEquals(columns['status'].counts(),
+                      {'ACTIVE': 2, 'BUILD': 1, 'ERROR': 1})
+    self.assertEquals(columns['flavor'].counts(), {'1': 2, '2': 2})
+    self.assertEquals(columns['availability_zone'].values()[order].tolist(),
+                      ['az1', 'az1', None, 'az2'])
+    self.assertEquals(columns['host_id'].counts(), {})
+    created = columns['created'][order]
+    self.assertEquals(created.dtype, numpy.dtype('datetime64[s]'))
+    self.assertEquals([str(value) for value in created],
+      ['2014-03-10T10:00:00', '2014-03-10T11:30:00', '2014-03-10T12:00:00',
+       'NaT'])
+    self.assertEquals(numpy.isnat(columns['updated']).sum(), 3)
+
+  def test__empty_query(self):
+    columns = self.collection.query(status='DELETED').to_columns()
+    self.assertEquals(columns['id'].dtype.kind, 'U')
+    self.assertEquals(len(columns['status']), 0)
+    self.assertEquals(columns['created'].dtype, numpy.dtype('datetime64[s]'))
+    records, _ = ServerCollection([]).to_arrays()
+    self.assertEquals((len(records), records.dtype['id'].kind), (0, 'U'))
+
+  def test__structured_array_of_a_query(self):
+    records, categories = self.collection.query(status='ACTIVE').to_arrays(
+      fields=('id', 'flavor', 'created'))
+    self.assertEquals(records.dtype.names, ('id', 'flavor', 'created'))
+    records.sort(order='id')
+    self.assertEquals(records['id'].tolist(), ['a', 'c'])
+    self.assertEquals([categories['flavor'][code] for code in records['flavor']],
+                      ['1', '2'])
+
+class DaemonTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'status': 'ACTIVE', 'hostId': 'h1',
+                  'tenantId': 't1'}}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = (200,
+      {'servers': [{'id': 'abc', 'tenantId': 't1'}, {'id': 'def'}]}, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (204, None, {})
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'zserver.sock')
+    self.daemon = ZabuzaDaemon(Api(None, user=self.stand_in.user()),
+      path=self.path)
+    self.serving = threading.Thread(target=self.daemon.serve)
+    self.serving.daemon = True
+    self.serving.start()
+
+  def tearDown(self):
+    with DaemonClient(self.path) as client:
+      client.call('stop')
+    self.serving.join(5)
+    self.stand_in.stop()
+    shutil.rmtree(self.directory)
+
+  def test__commands_share_one_authentication(self):
+    with DaemonClient(self.path) as client:
+      self.assertFalse(client.call('ping')['authenticated'])
+      server = Server.from_json(client.call('show', server_id='abc'))
+      self.assertEquals((server.id, server.host_id, server.tenant_id),
+                        ('abc', 'h1', 't1'))
+      servers = [Server.from_json(s) for s in client.call('list')]
+      self.assertEquals([(s.id, s.tenant_id) for s in servers],
+                        [('abc', 't1'), ('def', None)])
+      self.assertEquals(client.call('delete', server_ids=['abc']),
+                        [{'id': 'abc', 'status': 'deleted', 'error': None}])
+      self.assertTrue(client.call('ping')['authenticated'])
+      self.assertRaises(DaemonError, client.call, 'reboot')
+      self.assertRaises(DaemonError, client.call, 'show')
+    self.assertTrue(DaemonClient(self.path).available())
+    with DaemonClient(self.path) as client:
+      self.assertTrue(client.serves())
+      self.assertTrue(client.serves(auth_url=self.stand_in.url + '/v2.0/tokens',
+        username='foo', tenant_name='demo'))
+      self.assertFalse(client.serves(username='foo', tenant_name='prod'))
+      self.assertFalse(client.serves(username='bar'))
+      self.assertFalse(client.serves(auth_url='http://keystone/v2.0/tokens'))
+    self.assertFalse(DaemonClient(self.path + '.gone').serves())
+    self.assertEquals(len([c for c in self.stand_in.calls
+                           if c['path'] == '/v2.0/tokens']), 1)
+    self.assertEquals(os.stat(self.path).st_mode & 0o077, 0)
+    self.assertRaises(Exception, ZabuzaDaemon, None, path=self.path)
+
+  def test__importing_the_api_stays_cheap(self):
+    script = ('import sys; import src.zabuza.openstack; '
+              'print(sorted(set(["requests", "dateutil"]) & set(sys.modules)))')
+    output = subprocess.check_output([sys.executable, '-c', script],
+      cwd=os.path.dirname(os.path.abspath(__file__)))
+    self.assertEquals(output.strip(), b'[]')
+
+class SnapshotTest(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'servers.snap')
+    self.jsonl = os.path.join(self.directory, 'servers.jsonl')
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test__written_from_a_streamed_listing(self):
+    stand_in = StandInServer()
+    servers = [{'id': 's%02d'%i, 'status': 'ERROR' if i % 3 else 'ACTIVE',
+                'flavor': {'id': str(i % 2), 'links': []}, 'tenantId': 't1'}
+               for i in range(7)]
+    stand_in.routes[('GET', '/v2/t1/servers/detail')] = (200,
+      {'servers': servers[::-1]}, {})
+    api = Api(None, user=stand_in.user())
+    try:
+      with SnapshotWriter(self.path, jsonl_path=self.jsonl) as writer:
+        self.assertEquals(writer.write_all(api.iter_servers_detail(stream=True)), 7)
+        self.assertEquals(os.listdir(self.directory)[0][:5], '.tmp-')
+    finally:
+      api.close()
+      stand_in.stop()
+    self.assertEquals([s.id for s in read_jsonl(self.jsonl)],
+                      ['s%02d'%i for i in range(6, -1, -1)])
+    with Snapshot(self.path) as snapshot:
+      self.assertEquals(len(snapshot), 7)
+      server = snapshot.get('s04')
+      self.assertEquals((server.id, server.status, server.tenant_id),
+                        ('s04', 'ERROR', 't1'))
+      self.assertEquals(snapshot.get('s04', lazy=True).flavor['id'], '0')
+      self.assertEquals(snapshot.get('s07'), None)
+      self.assertFalse('a' in snapshot)
+      self.assertEquals(snapshot.counts('status'), {'ACTIVE': 3, 'ERROR': 4})
+      self.assertEquals(snapshot.counts('host_id'), {})
+      self.assertEquals([s.id for s in snapshot.query(status='ACTIVE',
+        flavor=['1', '2'])], ['s03'])
+      self.assertEquals(len(snapshot.rows(host_id=None)), 7)
+      self.assertEquals(snapshot.rows(status='DELETED'), [])
+      self.assertRaises(ValueError, snapshot.rows, addresses='x')
+
+  def test__failed_writes_leave_nothing_behind(self):
+    def servers():
+      yield Server.create_server(id='a', status='ACTIVE')
+      raise IOError('connection lost')
+    try:
+      with SnapshotWriter(self.path, jsonl_path=self.jsonl) as writer:
+        writer.write_all(servers())
+    except IOError:
+      pass
+    self.assertEquals(os.listdir(self.directory), [])
+    with open(self.path, 'wb') as truncated:
+      truncated.write(b'ZBZSNAP1{')
+    self.assertRaises(ValueError, Snapshot, self.path)
+
+class ServerCollectionTest(unittest.TestCase):
+
+  def setUp(self):
+    def server(server_id, status, host, zone, metadata=None):
+      return Server.create_server(id=server_id, status=status, hostId=host,
+        availability_zone=zone, metadata=metadata, tenantId='t1',
+        flavor={'id': '1', 'links': []}, image='img')
+    self.collection = ServerCollection([
+      server('a', 'ERROR', 'h1', 'nova-1', {'role': 'db'}),
+      server('b', 'ERROR', 'h2', 'nova-2', {'role': 'db'}),
+      server('c', 'ACTIVE', 'h1', 'nova-2', {'role': 'web', 'owner': 'x'}),
+      server('d', 'SHUTOFF', 'h1', 'nova-2')])
+
+  def ids(self, query):
+    return sorted(server.id for server in query)
+
+  def test__indexed_queries(self):
+    query = self.collection.query
+    self.assertEquals(self.ids(query(status='ERROR', host_id='h1')), ['a'])
+    self.assertEquals(self.ids(query(availability_zone='nova-2',
+      metadata={'role': 'db'})), ['b'])
+    self.assertEquals(self.ids(query(status=['ERROR', 'SHUTOFF'])
+      .where(host_id='h1')), ['a', 'd'])
+    self.assertEquals(self.ids(query(has_metadata='owner')), ['c'])
+    self.assertEquals(len(query(flavor='1', image='img', tenant_id='t1')), 4)
+    self.assertEquals(self.ids(query(host_id='h1', name=None)), ['a', 'c', 'd'])
+    self.assertEquals(len(query(status='BUILD')), 0)
+    self.assertEquals(self.collection.values('host_id'), {'h1': 3, 'h2': 1})
+
+  def test__indexes_follow_changes(self):
+    server = self.collection['a']
+    server.status = 'ACTIVE'
+    server.metadata = {'role': 'web'}
+    self.collection.add(server)
+    self.assertEquals(self.ids(self.collection.query(status='ERROR')), ['b'])
+    self.assertEquals(self.ids(self.collection.query(metadata={'role': 'web'})),
+      ['a', 'c'])
+    self.collection.remove('c')
+    self.assertEquals(self.ids(self.collection.query(status='ACTIVE')), ['a'])
+    self.assertEquals(self.collection.values('status')['ACTIVE'], 1)
+    self.collection.remove('a')
+    self.assertFalse('ACTIVE' in self.collection.values('status'))
+
+class ResponseCacheTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'status': 'ACTIVE'}}, {})
+    self.stand_in.routes[('DELETE', '/v2/t1/servers/abc')] = (204, None, {})
+    self.cache = ResponseCache(ttl=60, max_size=2)
+    self.api = Api(None, user=self.stand_in.user(), detail_cache=self.cache)
+
+  def tearDown(self):
+    self.api.close()
+    self.stand_in.stop()
+
+  def fetches(self):
+    return len([c for c in self.stand_in.calls
+                if c['method'] == 'GET' and c['path'] == '/v2/t1/servers/abc'])
+
+  def test__details_are_cached_until_deleted(self):
+    first = self.api.get_server_detail(server_id='abc')
+    second = self.api.get_server_detail(server_id='abc')
+    self.assertEquals(first, second)
+    self.assertFalse(first is second)
+    self.assertEquals(self.fetches(), 1)
+    self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+    self.api.delete_server(server_id='abc')
+    self.api.get_server_detail(server_id='abc')
+    self.assertEquals(self.fetches(), 2)
+    self.api.invalidate_server('abc')
+    self.api.get_server_detail(server_id='abc', lazy=True)
+    self.assertEquals(self.fetches(), 3)
+
+  def test__deletes_drop_details_cached_from_every_endpoint(self):
+    access = self.stand_in.access()
+    access['access']['serviceCatalog'][0]['endpoints'] = [
+      {'id': 'e%s'%i, 'region': 'mars',
+       'publicURL': '%s/v2/%s'%(self.stand_in.url, tenant)}
+      for i, tenant in enumerate(['t1', 't2'])]
+    self.stand_in.routes[('POST', '/v2.0/tokens')] = (200, access, {})
+    self.stand_in.routes[('GET', '/v2/t2/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'status': 'ACTIVE'}}, {})
+    self.stand_in.routes[('DELETE', '/v2/t2/servers/abc')] = (204, None, {})
+    class Alternating(object):
+      calls = 0
+      def select(self, urls):
+        Alternating.calls += 1
+        return sorted(urls)[Alternating.calls % 2]
+      def record(self, url, elapsed, failed=False):
+        pass
+    cache = ResponseCache(ttl=60)
+    api = Api(None, detail_cache=cache,
+      user=self.stand_in.user(endpoint_selector=Alternating()))
+    api.get_server_detail(server_id='abc')
+    api.get_server_detail(server_id='abc')
+    self.assertEquals(len(cache), 2)
+    api.delete_server(server_id='abc')
+    self.assertEquals(len(cache), 0)
+    api.close()
+
+  def test__cached_details_are_not_shared(self):
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = (200,
+      {'server': {'id': 'abc', 'metadata': {'role': 'db'},
+                  'addresses': {'private': [{'addr': '10.0.0.1'}]}}}, {})
+    for lazy in (False, True):
+      first = self.api.get_server_detail(server_id='abc', lazy=lazy)
+      first.metadata['role'] = 'web'
+      first.addresses['private'].append({'addr': '10.0.0.2'})
+      again = self.api.get_server_detail(server_id='abc', lazy=lazy)
+      self.assertEquals(again.metadata, {'role': 'db'})
+      self.assertEquals(len(again.addresses['private']), 1)
+    self.assertEquals(self.fetches(), 1)
+
+  def test__ttl_and_lru_eviction(self):
+    cache = ResponseCache(ttl=0.05, max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    self.assertEquals((cache.get('a'), cache.get('b'), cache.get('c')),
+      (1, None, 3))
+    self.assertEquals(cache.stats()['evictions'], 1)
+    time.sleep(0.06)
+    self.assertTrue(cache.get('a') is None)
+    self.assertEquals(cache.stats()['hits'], 3)
+
+class ReadCoalescingTest(unittest.TestCase):
+
+  def setUp(self):
+    self.stand_in = StandInServer()
+    self.release = threading.Event()
+    def slow_detail(call):
+      self.release.wait(5)
+      return (200, {'server': {'id': 'abc', 'status': 'ACTIVE'}}, {})
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = slow_detail
+
+  def tearDown(self):
+    self.stand_in.stop()
+
+  def fetch_concurrently(self, api, count):
+    api.verify_credentials()
+    results = []
+    threads = [threading.Thread(target=lambda:
+      results.append(api.get_server_detail(server_id='abc')))
+      for _ in range(count)]
+    for thread in threads:
+      thread.start()
+    time.sleep(0.2)
+    self.release.set()
+    for thread in threads:
+      thread.join()
+    api.close()
+    return results
+
+  def gets(self):
+    return len([c for c in self.stand_in.calls if c['method'] == 'GET'])
+
+  def test__identical_gets_share_one_call(self):
+    api = Api(None, user=self.stand_in.user())
+    results = self.fetch_concurrently(api, 6)
+    self.assertEquals([server.status for server in results], ['ACTIVE'] * 6)
+    self.assertEquals(self.gets(), 1)
+    self.assertEquals((api.reads.calls, api.reads.shared), (1, 5))
+
+  def test__shared_reads_hand_out_separate_servers(self):
+    self.stand_in.routes[('GET', '/v2/t1/servers/abc')] = lambda call: (
+      self.release.wait(5) and (200, {'server': {'id': 'abc',
+        'metadata': {'role': 'db'}}}, {}))
+    api = Api(None, user=self.stand_in.user())
+    first, second = self.fetch_concurrently(api, 2)
+    self.assertEquals(api.reads.shared, 1)
+    self.assertFalse(first.metadata is second.metadata)
+    first.metadata['role'] = 'web'
+    self.assertEquals(second.metadata, {'role': 'db'})
+
+  def test__filters_with_several_values(self):
+    self.release.set()
+    self.stand_in.routes[('GET', '/v2/t1/servers/detail')] = (200,
+      {'servers': [{'id': 'abc'}]}, {})
+    api = Api(None, user=self.stand_in.user())
+    servers = api.get_servers_detail(status=['ACTIVE', 'ERROR'])
+    self.assertEquals([s.id for s in servers], ['abc'])
+    self.assertEquals(self.stand_in.calls[-1]['query']['status'],
+                      ['ACTIVE', 'ERROR'])
+    api._get_url(self.stand_in.url + '/v2/t1/servers/detail',
+      parameters={'status': {'a': 1}})
+    api.close()
+
+  def test__coalescing_can_be_disabled(self):
+    api = Api(None, user=self.stand_in.user(), coalesce_reads=False)
+    self.fetch_concurrently(api, 3)
+    self.assertEquals(self.gets(), 3)
+
 class ApiTest(unittest.TestCase):
 
   def setUp(self):
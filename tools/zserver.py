@@ -4,8 +4,8 @@ full fledged command like client for managing server
 import getpass
 import optparse
 from os import environ
-from zabuza.openstack import Api, User, PasswordCredential
 from zabuza.services.compute import Server
+from zabuza.daemon import DaemonClient, DEFAULT_SOCKET
 
 ########################################
 #     Utility Functions and Globals
@@ -31,30 +31,27 @@ def options_parser():
     default=None)
   parser.add_option('-n', '--name', help='compute server name', dest='name',
     default=None)
+  parser.add_option('--token-cache',
+    help='directory to cache tokens in between runs (Optional)',
+    dest='tokencache', default=environ.get('ZABUZA_TOKEN_CACHE') or None)
+  parser.add_option('-s', '--server-id', help='id of a server to delete, '
+    'can be repeated', dest='server_ids', action='append', default=[])
+  parser.add_option('-c', '--count', help='number of servers to create',
+    dest='count', type='int', default=1)
+  parser.add_option('--daemon', action='store_true', dest='daemon',
+    default=False, help='stay resident, serving commands of later runs over '
+    'a unix socket so they skip authentication (Optional)')
+  parser.add_option('--socket', help='unix socket of the daemon (Optional)',
+    dest='socket', default=environ.get('ZABUZA_SOCKET') or DEFAULT_SOCKET)
 
   opts, args = parser.parse_args()
   options_dict = {}
-  #now, parse out options in 'logical' order
-  if not opts.user:
-    raise Exception('you must specify a user account for authentication')
-  else:
-    options_dict['user'] = opts.user
-
-  if not opts.password:
-    password = getpass.getpass('enter password for %s: '%opts.user)
-    options_dict['password'] = password
-  else:
-    options_dict['password'] = opts.password
-
-  if not opts.adminurl:
-    raise Exception('you must specify an admin url endpoint for authentication')
-  else:
-    options_dict['adminurl'] = opts.adminurl
-
-  if not opts.tenant:
-    raise Exception('you must specify a tenant')
-  else:
-    options_dict['tenant'] = opts.tenant
+  #now, parse out options in 'logical' order, credentials are checked once
+  #we know they are needed (they are not when a daemon is running)
+  options_dict['user'] = opts.user
+  options_dict['password'] = opts.password
+  options_dict['adminurl'] = opts.adminurl
+  options_dict['tenant'] = opts.tenant
 
   supported_operations = ['create', 'read', 'update', 'delete']
   if opts.operation not in supported_operations:
@@ -68,9 +65,33 @@ def options_parser():
     options_dict['flavor'] = opts.flavor
   if opts.name:
     options_dict['name'] = opts.name
+  options_dict['count'] = opts.count
+  options_dict['server_ids'] = opts.server_ids
+  if opts.tokencache:
+    options_dict['tokencache'] = opts.tokencache
+  options_dict['daemon'] = opts.daemon
+  options_dict['socket'] = opts.socket
 
   return options_dict
 
+def require_credentials(options):
+  '''
+  ensures the options needed to authenticate are there, asking for the
+  password if it was not given
+  '''
+  if not options.get('user'):
+    raise Exception('you must specify a user account for authentication')
+
+  if not options.get('password'):
+    options['password'] = getpass.getpass('enter password for %s: '%
+      options['user'])
+
+  if not options.get('adminurl'):
+    raise Exception('you must specify an admin url endpoint for authentication')
+
+  if not options.get('tenant'):
+    raise Exception('you must specify a tenant')
+
 def great_expectations(expects, reality):
   '''
   ensures that expectations match reality :-)
@@ -87,11 +108,21 @@ def authenticator(options):
   authenticates with api
   '''
   global user
+  #imported here, runs served by a daemon never need them
+  from zabuza.openstack import User
+  from zabuza.cache import TokenCache
+  require_credentials(options)
+  token_cache = None
+  if options.get('tokencache'):
+    token_cache = TokenCache(options['tokencache'])
   user = User(options['adminurl'],
     username=options.get('user'),
     password=options.get('password'),
-    tenant_name=options.get('tenant'))
-  user.authenticate()
+    tenant_name=options.get('tenant'),
+    token_cache=token_cache,
+    refresh_window=300 if options.get('daemon') else None)
+  if not user.is_authenticated():
+    user.authenticate()
 
 
 ##################################
@@ -99,6 +130,7 @@ def authenticator(options):
 ##################################
 def create(options):
   global user
+  from zabuza.openstack import Api
   expects = ['image', 'flavor', 'name']
   reality, issue = great_expectations(expects, options)
   if not reality:
@@ -112,9 +144,72 @@ def create(options):
     kwargs['compute_type'] = options.get('computetype')
   kwargs['key_name'] = options.get('keyname')
 
-  result = api.create_server(server, **kwargs)
+  if options.get('count', 1) > 1:
+    report = api.create_servers(template=server, count=options['count'],
+      **kwargs)
+    for result in report:
+      print result.value if result.error is None else result
+  else:
+    api.create_server(server, **kwargs)
+    print server
 
-  print result
+def read(options):
+  global user
+  from zabuza.openstack import Api
+  api = Api(options['adminurl'], user=user)
+  for server in api.iter_servers_detail(name=options.get('name')):
+    print server
+
+def delete(options):
+  global user
+  from zabuza.openstack import Api
+  if not options.get('server_ids'):
+    raise Exception('you must specify a server id')
+  api = Api(options['adminurl'], user=user)
+  report = api.delete_servers(server_ids=options['server_ids'], workers=4)
+  for result in report:
+    print result
+
+def serve(options):
+  '''
+  keeps the authenticated user warm, serving later runs over a unix socket
+  '''
+  global user
+  from zabuza.openstack import Api
+  from zabuza.daemon import ZabuzaDaemon
+  daemon = ZabuzaDaemon(Api(options['adminurl'], user=user),
+    path=options['socket'])
+  print 'serving on %s'%daemon.path
+  try:
+    daemon.serve()
+  except KeyboardInterrupt:
+    pass
+
+def delegate(client, options):
+  '''
+  runs the operation in a daemon started with --daemon
+  '''
+  if options['operation'] == 'create':
+    expects = ['image', 'flavor', 'name']
+    reality, issue = great_expectations(expects, options)
+    if not reality:
+      raise Exception('you must specify a(n) %s'%issue)
+    servers = client.call('create', image=options['image'],
+      flavor=options['flavor'], name=options['name'],
+      count=options.get('count', 1))
+  elif options['operation'] == 'read':
+    servers = client.call('list', name=options.get('name'))
+  elif options['operation'] == 'delete':
+    if not options.get('server_ids'):
+      raise Exception('you must specify a server id')
+    for result in client.call('delete', server_ids=options['server_ids']):
+      print '%(id)s: %(status)s'%result + (' (%(error)s)'%result
+        if result['error'] else '')
+    return
+  else:
+    raise NotImplementedError #unsupported by api
+  for server in servers:
+    print server if 'error' in server else Server.from_json(server)
 
 #################################
 #          Action Switch
@@ -124,16 +219,24 @@ def executor(options):
   determines what operation you want to execute and then delegates it to
   method implementing said interface
   '''
+  if not options['daemon']:
+    #a daemon acting as another user, tenant or keystone is not used
+    with DaemonClient(options['socket']) as client:
+      if client.serves(auth_url=options.get('adminurl'),
+          username=options.get('user'), tenant_name=options.get('tenant')):
+        delegate(client, options)
+        return
   authenticator(options)
-  if options['operation'] == 'create':
+  if options['daemon']:
+    serve(options)
+  elif options['operation'] == 'create':
     create(options)
   elif options['operation'] == 'read':
-    #TODO ready stuff
-    pass
+    read(options)
   elif options['operation'] == 'update':
     raise NotImplementedError #unsupported by api
   elif options['operation'] == 'delete':
-    raise NotImplementedError #unsupported by api
+    delete(options)
 
 if __name__ == '__main__':
   executor(options_parser())